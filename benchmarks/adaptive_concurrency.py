@@ -0,0 +1,127 @@
+"""Compare fixed concurrency levels with utils.concurrency.AdaptiveLimiter against a throttling server.
+
+The local fake server accepts up to `capacity` requests at a time and answers the rest with 429,
+every request in flight (the rejected ones too) slows all the others down. The capacity changes
+between the phases of a run, like a shared API whose other clients come and go:
+    python -m benchmarks.adaptive_concurrency --capacities 16,48,8 --phase-seconds 5
+"""
+
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests import Session, adapters
+
+from utils.concurrency import THROTTLING_STATUS_CODES, AdaptiveLimiter
+
+
+class ThrottlingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, capacities: list, phase_seconds: float, base_latency: float):
+        super().__init__(("127.0.0.1", 0), ThrottlingHandler)
+        self.capacities = capacities
+        self.phase_seconds = phase_seconds
+        self.base_latency = base_latency
+        self.in_flight = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        phase = int((time.monotonic() - self.started_at) / self.phase_seconds)
+        return self.capacities[min(phase, len(self.capacities) - 1)]
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server._lock:
+            server.in_flight += 1
+            in_flight, capacity = server.in_flight, server.capacity
+        try:
+            if in_flight > capacity:
+                # rejecting costs the server too, just less than serving
+                time.sleep(server.base_latency / 2)
+                status = 429
+            else:
+                time.sleep(server.base_latency * (1 + in_flight / capacity))
+                status = 200
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def run(url: str, limiter: AdaptiveLimiter, workers: int, duration: float, report_interval: float) -> dict:
+    counts = {"ok": 0, "throttled": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    local = threading.local()
+
+    def _work():
+        local.session = Session()
+        local.session.mount("http://", adapters.HTTPAdapter(pool_maxsize=1))
+        while time.monotonic() < deadline:
+            with limiter.slot() as slot:
+                r = local.session.get(url)
+                if r.status_code in THROTTLING_STATUS_CODES:
+                    slot.throttle()
+            with lock:
+                counts[r.ok and "ok" or "throttled"] += 1
+        local.session.close()
+
+    threads = [threading.Thread(target=_work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    while report_interval and limiter.enabled and time.monotonic() < deadline:
+        time.sleep(report_interval)
+        print(f"    {limiter.report()}")
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def report(name: str, counts: dict, duration: float):
+    print(
+        f"{name:>10}: goodput={counts['ok'] / duration:.1f} req/s, "
+        f"ok={counts['ok']}, throttled={counts['throttled']} "
+        f"({counts['throttled'] / max(counts['ok'] + counts['throttled'], 1):.0%})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capacities", default="16,48,8", help="server capacity of every phase, comma separated")
+    parser.add_argument("--phase-seconds", type=float, default=5.0)
+    parser.add_argument("--base-latency", type=float, default=0.02, help="seconds per request of an idle server")
+    parser.add_argument("--fixed", default="4,8,16,32,64,128", help="fixed concurrency levels to compare")
+    parser.add_argument("--workers", type=int, default=128, help="client threads, the upper bound of the limit")
+    parser.add_argument("--report-interval", type=float, default=0, help="seconds between the limiter reports")
+    args = parser.parse_args()
+
+    capacities = [int(c) for c in args.capacities.split(",")]
+    duration = args.phase_seconds * len(capacities)
+    runs = [
+        (f"fixed {level}", AdaptiveLimiter("fixed", max_limit=int(level), enabled=False))
+        for level in args.fixed.split(",")
+    ]
+    runs.append(("adaptive", AdaptiveLimiter("adaptive", initial=8, max_limit=args.workers)))
+
+    for name, limiter in runs:
+        server = ThrottlingServer(capacities, args.phase_seconds, args.base_latency)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        counts = run(url, limiter, min(args.workers, limiter.max_limit), duration, args.report_interval)
+        server.shutdown()
+        server.server_close()
+        report(name, counts, duration)
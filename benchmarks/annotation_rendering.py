@@ -0,0 +1,83 @@
+"""Time the annotation of a search result with many detected objects, the way product_search_cli renders it.
+
+Compares a drawing context and a font lookup per box (before), the single context and cached font
+of utils.image.draw_bounding_boxes_on_image and the JSON overlay of utils.image.bounding_boxes_overlay,
+with and without the PNG encoding of the annotated image the UI sends back:
+    python -m benchmarks.annotation_rendering --boxes 10,50,200 --size 1024
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+import numpy as np
+import PIL.Image as Image
+import PIL.ImageDraw as ImageDraw
+import PIL.ImageFont as ImageFont
+
+from utils.image import (
+    bounding_boxes_overlay,
+    draw_bounding_box_on_image,
+    draw_bounding_boxes_on_image,
+    encode_image_as_png_str,
+)
+
+
+def search_result(n_boxes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 1, (n_boxes, 2, 2))
+    boxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    captions = [[f"{idx} - Chair / {score:.4f}"] for idx, score in enumerate(rng.uniform(0.5, 1, n_boxes), 1)]
+    return boxes, captions
+
+
+def per_box(image: Image.Image, boxes, captions):
+    """draw_bounding_boxes_on_image as it was, a new Draw and font lookup for every box."""
+    for box, display_str_list in zip(boxes, captions):
+        try:
+            font = ImageFont.truetype("arial.ttf", 12)
+        except IOError:
+            font = ImageFont.load_default()
+        draw_bounding_box_on_image(image, *box, "green", 2, display_str_list, draw=ImageDraw.Draw(image), font=font)
+    return image
+
+
+def shared(image: Image.Image, boxes, captions):
+    draw_bounding_boxes_on_image(image, boxes=boxes, display_str_list_list=captions, color="green", thickness=2)
+    return image
+
+
+def overlay(image: Image.Image, boxes, captions):
+    return bounding_boxes_overlay(image.size, boxes=boxes, display_str_list_list=captions, color="green", thickness=2)
+
+
+def timed(fn, image: Image.Image, boxes, captions, encode: bool, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        copy = image.copy()
+        start = time.perf_counter()
+        result = fn(copy, boxes, captions)
+        if encode:
+            isinstance(result, dict) and json.dumps(result) or encode_image_as_png_str(result)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", default="10,50,200", help="numbers of boxes to compare, comma separated")
+    parser.add_argument("--size", type=int, default=1024, help="longest side of the image")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (args.size * 3 // 4, args.size, 3), np.uint8))
+    for n_boxes in (int(n) for n in args.boxes.split(",")):
+        boxes, captions = search_result(n_boxes)
+        before, after = per_box(image.copy(), boxes, captions), shared(image.copy(), boxes, captions)
+        assert before.tobytes() == after.tobytes(), "the renderings differ"
+        print(f"{n_boxes} boxes on {image.width}x{image.height}:")
+        for name, fn in (("per box (before)", per_box), ("shared draw", shared), ("JSON overlay", overlay)):
+            render = timed(fn, image, boxes, captions, encode=False, repeat=args.repeat)
+            encoded = timed(fn, image, boxes, captions, encode=True, repeat=args.repeat)
+            print(f"{name:>20}: render {render * 1000:8.2f} ms, with encoding {encoded * 1000:8.2f} ms")
@@ -0,0 +1,301 @@
+"""End to end throughput of the import, the bulk import and the search against the stand-ins of benchmarks.fakes.
+
+import_assets.run_job reads the product ids from a FakeConnection, their masterdata and images from
+the FakeAssetsServer and streams the images into the in-memory bucket of the FakeStorageServer,
+bulk_import_product_sets indexes the bulk import files with the Vision stand-in and
+get_similar_products searches it. Every phase reports its items/s, bytes/s, latency percentiles
+and the peak RSS of this process so far (the stand-ins run in a process of their own):
+    python -m benchmarks.end_to_end --products 2000 --latency 0.01 --throttle-rate 0.01 --error-rate 0.01
+
+`--rerun` imports the same products again, unchanged since the first run, `--report` writes the results as JSON.
+`--variants 4` makes groups of 4 products share their images (`--own-urls` each under its own URL),
+DEDUPLICATE_ASSETS=True compares the import storing them once for all.
+`--photos 512 --near-duplicates 1` serves JPEG photos, the last shot of a product a near duplicate of its first one,
+PRUNE_NEAR_DUPLICATES=True measures the import pruning them.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pathlib import Path
+
+import grpc
+import requests
+
+from benchmarks.fakes import FakeConnection, running_fakes
+from benchmarks.query_preprocessing import photo_like
+from utils.metrics import Metrics
+
+# finer than utils.metrics.LATENCY_BUCKETS, from 0.5 ms up by 25%
+BUCKETS = tuple(0.0005 * 1.25**idx for idx in range(50)) + (math.inf,)
+
+PROJECT_ID = "benchmark"
+PROJECT_REGION = "europe-west1"
+STORAGE_BUCKET_ID = "benchmark-assets"
+
+
+def peak_rss_mib() -> float:
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(metrics: Metrics, name: str, fn):
+    @wraps(fn)
+    def _timed(*args, **kwargs):
+        with metrics.time(name):
+            return fn(*args, **kwargs)
+
+    return _timed
+
+
+def timed_async(metrics: Metrics, name: str, fn):
+    @wraps(fn)
+    async def _timed(*args, **kwargs):
+        with metrics.time(name):
+            return await fn(*args, **kwargs)
+
+    return _timed
+
+
+def server_stats(url: str) -> dict:
+    return requests.get(f"{url}/_stats").json()
+
+
+def stats_delta(before: dict, after: dict) -> dict:
+    return {key: value - before.get(key, 0) for key, value in after.items() if value - before.get(key, 0)}
+
+
+def latencies(metrics: Metrics) -> dict:
+    return {
+        name: {"count": histogram["count"], **{q: histogram[f"{q}_s"] for q in ("p50", "p95", "p99")}}
+        for name, histogram in metrics.snapshot().items()
+    }
+
+
+def run_import(import_assets, endpoints: dict, use_async: bool) -> dict:
+    metrics = Metrics(BUCKETS)
+    # the stages are looked up in the module by run_job, so they can be timed from outside
+    stages = {"select_assets": "metadata", "transfer_asset": "transfer", "process_async": "product"}
+    originals = {name: getattr(import_assets, name) for name in stages}
+    for name, stage in stages.items():
+        wrapper = name == "process_async" and timed_async or timed
+        setattr(import_assets, name, wrapper(metrics, stage, originals[name]))
+    assets_before, storage_before = server_stats(endpoints["assets"]), server_stats(endpoints["storage"])
+
+    start = time.perf_counter()
+    try:
+        files = import_assets.run_job(use_async=use_async)
+    finally:
+        for name, fn in originals.items():
+            setattr(import_assets, name, fn)
+    elapsed = time.perf_counter() - start
+
+    rows = sum(len(fpath.read_text().splitlines()) for fpath in files)
+    assets = stats_delta(assets_before, server_stats(endpoints["assets"]))
+    storage = stats_delta(storage_before, server_stats(endpoints["storage"]))
+    return {
+        "seconds": elapsed,
+        "rows": rows,
+        "rows_per_s": rows / elapsed,
+        "downloaded_bytes_per_s": assets.get("bytes_out", 0) / elapsed,
+        "uploaded_bytes_per_s": storage.get("bytes_in", 0) / elapsed,
+        "uploaded_objects": storage.get("objects", 0),
+        "peak_rss_mib": peak_rss_mib(),
+        "latency": latencies(metrics),
+        "assets_api": assets,
+        # the instrumentation of the import itself
+        "metrics": json.loads(import_assets.IMPORT_METRICS_FILE.read_text()),
+        "files": files,
+    }
+
+
+def run_bulk_import(gcs_client, search_client, bulk_import_product_sets, upload_to_storage, files: list) -> dict:
+    metrics = Metrics(BUCKETS)
+    rows = 0
+    start = time.perf_counter()
+    for fpath in files:
+        with metrics.time("upload"), fpath.open("rb") as f:
+            gcs_url = upload_to_storage(gcs_client, STORAGE_BUCKET_ID, f, fpath.name)
+        with metrics.time("import"):
+            bulk_import_product_sets(search_client, PROJECT_ID, PROJECT_REGION, gcs_url)
+        rows += len(fpath.read_text().splitlines())
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "rows": rows,
+        "rows_per_s": rows / elapsed,
+        "peak_rss_mib": peak_rss_mib(),
+        "latency": latencies(metrics),
+    }
+
+
+def run_search(search_client, annotation_client, get_similar_products, searches: int, threads: int) -> dict:
+    from utils.image import encode_query_image
+
+    content = encode_query_image(photo_like(1024, 768), max_side=1024, image_format="JPEG", quality=85)
+    metrics = Metrics(BUCKETS)
+
+    def _search(_):
+        with metrics.time("search"):
+            result = get_similar_products(
+                search_client=search_client,
+                annotation_client=annotation_client,
+                project_id=PROJECT_ID,
+                location=PROJECT_REGION,
+                product_set_id="bahag_products",
+                product_category="homegoods-v2",
+                image=content,
+            )
+        assert result["matches"], result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(_search, range(searches)))
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "searches": searches,
+        "searches_per_s": searches / elapsed,
+        "sent_bytes_per_s": searches * len(content) / elapsed,
+        "peak_rss_mib": peak_rss_mib(),
+        "latency": latencies(metrics),
+    }
+
+
+def print_phase(name: str, result: dict, items: str) -> None:
+    count = result.get(items, result.get("rows"))
+    rates = [f"{result[f'{items}_per_s']:.1f} {items}/s"]
+    for key, label in (("downloaded", "down"), ("uploaded", "up"), ("sent", "sent")):
+        if f"{key}_bytes_per_s" in result:
+            rates.append(f"{result[f'{key}_bytes_per_s'] / 1024**2:.1f} MiB/s {label}")
+    rates.append(f"peak RSS {result['peak_rss_mib']:.0f} MiB")
+    print(f"{name}: {count} {items} in {result['seconds']:.2f}s, {', '.join(rates)}")
+    for stage, latency in result["latency"].items():
+        print(
+            f"{stage:>12}: {latency['count']:>6}, p50 {latency['p50'] * 1000:7.1f} ms, "
+            f"p95 {latency['p95'] * 1000:7.1f} ms, p99 {latency['p99'] * 1000:7.1f} ms"
+        )
+    if "assets_api" in result:
+        statuses = sorted(
+            (key.removeprefix("status_"), n) for key, n in result["assets_api"].items() if "status_" in key
+        )
+        print(f"{'assets API':>12}: {', '.join(f'{n} x {status}' for status, n in statuses)}")
+    if "uploaded_objects" in result:
+        print(f"{'bucket':>12}: {result['uploaded_objects']} objects written")
+    if pruned := result.get("metrics", {}).get("counters", {}).get("prune.rows"):
+        print(f"{'pruned':>12}: {pruned} near duplicate rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--assets", type=int, default=3, help="product shots per product")
+    parser.add_argument("--asset-kib", type=int, default=256, help="size of every product shot")
+    parser.add_argument("--variants", type=int, default=1, help="consecutive products sharing their product shots")
+    parser.add_argument("--own-urls", action="store_true", help="the shared product shots have a URL per product")
+    parser.add_argument("--photos", type=int, default=0, help="side of JPEG product shots instead of random bytes")
+    parser.add_argument("--near-duplicates", type=int, default=0, help="near duplicate product shots per product")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds of an assets API or CDN request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="assets API and CDN requests answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="... and with 429")
+    parser.add_argument("--storage-latency", type=float, default=0.005, help="seconds of a storage upload request")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="seconds of a product ids page of the DB")
+    parser.add_argument("--index-latency", type=float, default=0.0001, help="seconds of indexing a reference image")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="seconds of a search of the Vision API")
+    parser.add_argument("--threads", type=int, default=32, help="threads of every import stage")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the asyncio import engine")
+    parser.add_argument("--concurrency", type=int, default=256, help="products in flight of the asyncio engine")
+    parser.add_argument("--rerun", action="store_true", help="import the unchanged products again")
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--search-threads", type=int, default=8)
+    parser.add_argument("--report", type=Path, help="JSON file of the results")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+
+    fakes = running_fakes(
+        assets={
+            "assets": args.assets,
+            "asset_size": args.asset_kib * 1024,
+            "variants": args.variants,
+            "shared_urls": not args.own_urls,
+            "photos": args.photos,
+            "near_duplicates": args.near_duplicates,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "throttle_rate": args.throttle_rate,
+        },
+        storage={"latency": args.storage_latency},
+        vision={"index_latency": args.index_latency, "search_latency": args.search_latency},
+    )
+    with fakes as endpoints, tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = Path(tmp_dir)
+        os.environ.update(
+            BAHAG_BASE_API_URL=endpoints["assets"],
+            ASSETS_API_USER="benchmark",
+            ASSETS_API_PASSWORD="benchmark",
+            ASSETS_TOKEN_CACHE_DIR=str(out_dir),
+            STORAGE_EMULATOR_HOST=endpoints["storage"],
+            STORAGE_BUCKET_ID=STORAGE_BUCKET_ID,
+            GCP_SA_JSON="",
+            METADATA_THREADS=str(args.threads),
+            TRANSFER_THREADS=str(args.threads),
+            ASYNC_CONCURRENCY=str(args.concurrency),
+            QUEUE_REPORT_INTERVAL="0",
+            METADATA_CACHE="off",
+            ASSETS_MANIFEST=str(out_dir / "assets_manifest.sqlite"),
+            IMPORT_JOURNAL=str(out_dir / "import_journal.sqlite"),
+            IMPORT_METRICS_FILE=str(out_dir / "import_metrics.json"),
+        )
+        # the import and the clients read their settings at import
+        from google.cloud import vision
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+        from google.cloud.vision_v1.services.product_search.transports import ProductSearchGrpcTransport
+
+        import import_assets
+        from utils.google_cloud import (
+            bulk_import_product_sets,
+            gcs_client,
+            get_similar_products,
+            grpc_channel_options,
+            upload_to_storage,
+        )
+
+        logging.getLogger().setLevel(args.log_level)
+        product_ids = [str(bahag_id) for bahag_id in range(10_000_000, 10_000_000 + args.products)]
+        import_assets.db_connect = lambda: FakeConnection(product_ids, args.page_latency)
+        import_assets.OUT_CSV_FILE = out_dir / import_assets.OUT_CSV_FILE.name
+
+        channel = grpc.insecure_channel(endpoints["vision"], options=grpc_channel_options())
+        search_client = vision.ProductSearchClient(transport=ProductSearchGrpcTransport(channel=channel))
+        annotation_client = vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+        engine = args.use_async and "asyncio" or "threads"
+        print(
+            f"{os.cpu_count()} CPUs, {args.products} products of {args.assets} x {args.asset_kib} KiB assets, "
+            f"{args.latency * 1000:g} ms latency, {args.error_rate:.1%} errors, {args.throttle_rate:.1%} throttled"
+        )
+        results = {"import": run_import(import_assets, endpoints, args.use_async)}
+        print_phase(f"import ({engine})", results["import"], "rows")
+        if args.rerun:
+            results["rerun"] = run_import(import_assets, endpoints, args.use_async)
+            print_phase(f"unchanged import ({engine})", results["rerun"], "rows")
+        results["bulk_import"] = run_bulk_import(
+            gcs_client(), search_client, bulk_import_product_sets, upload_to_storage, results["import"].pop("files")
+        )
+        print_phase("bulk import", results["bulk_import"], "rows")
+        results["search"] = run_search(
+            search_client, annotation_client, get_similar_products, args.searches, args.search_threads
+        )
+        print_phase("search", results["search"], "searches")
+        results.get("rerun", {}).pop("files", None)
+        channel.close()
+
+    if args.report:
+        args.report.write_text(json.dumps({"args": vars(args) | {"report": str(args.report)}, **results}, indent=2))
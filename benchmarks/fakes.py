@@ -0,0 +1,415 @@
+"""Local stand-ins of the services the import and the search talk to, injected by their settings:
+
+- FakeAssetsServer, BAHAG_BASE_API_URL: the OAuth and masterdata endpoints of the assets API
+  and the image CDN, with a latency and rates of errors (500) and throttled (429) responses.
+- FakeStorageServer, STORAGE_EMULATOR_HOST: the upload endpoints of the GCS JSON API (media,
+  multipart and resumable) into an in-memory bucket, for the storage client and AsyncStorageUploader.
+- vision_stand_in: ProductSearch.ImportProductSets, indexing the bulk import files of the in-memory bucket,
+  and ImageAnnotator.BatchAnnotateImages, for the real Vision clients on an insecure channel.
+- FakeConnection, replacing import_assets.db_connect: the product ids of the Postgres query.
+
+running_fakes starts all the servers but the connection in a process of their own,
+so their CPU time and memory aren't counted as the benchmarked code's.
+"""
+
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent import futures
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import grpc
+from google.cloud import vision
+from google.longrunning import operations_pb2
+from google.rpc import status_pb2
+from PIL import ImageEnhance
+
+from benchmarks.query_preprocessing import photo_like
+
+MASTERDATA_PATH = re.compile(r"/v1/assets-masterdata/2/(\w+)/assets/articlenumbers/(\w+)")
+CDN_PATH = re.compile(r"/cdn/([\w-]+)\.jpg")
+UPLOAD_PATH = re.compile(r"/upload/storage/v1/b/([^/]+)/o")
+CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Local HTTP server answering `throttle_rate` of the requests with 429 and `error_rate` with 500,
+    all of them after `latency` seconds. GET /_stats returns the request counts as JSON.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, handler, latency: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0, seed=0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, **counts) -> None:
+        with self._lock:
+            self.stats.update(counts)
+
+    def injected_status(self):
+        """429, 500 or None for a request to be served."""
+        time.sleep(self.latency)
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 500
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def reply(self, status: int, body: bytes = b"", headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(**{"requests": 1, f"status_{status}": 1, "bytes_out": len(body)})
+
+    def reply_json(self, data, status: int = 200, headers: dict = None) -> None:
+        self.reply(status, json.dumps(data).encode(), {"Content-Type": "application/json", **(headers or {})})
+
+    def reply_stats(self) -> bool:
+        if self.path != "/_stats":
+            return False
+        with self.server._lock:
+            body = json.dumps(self.server.stats).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+
+class FakeAssetsServer(FakeServer):
+    """The assets API and its CDN: every product has `assets` product shots of `asset_size` random bytes,
+    each with its own URL and ETag.
+
+    The products in groups of `variants` consecutive ids share their product shots,
+    under the same URLs or, without `shared_urls`, each under a URL of its own.
+    With `photos` the shots are JPEG photos of that side instead, the last `near_duplicates` ones
+    of a product are its first one slightly cropped and brightened.
+    """
+
+    def __init__(
+        self,
+        assets: int = 3,
+        asset_size: int = 256 * 1024,
+        variants: int = 1,
+        shared_urls: bool = True,
+        photos: int = 0,
+        near_duplicates: int = 0,
+        **kwargs,
+    ):
+        super().__init__(AssetsHandler, **kwargs)
+        self.assets = assets
+        self.asset = os.urandom(asset_size)
+        self.variants = variants
+        self.shared_urls = shared_urls
+        self.photos = photos
+        self.near_duplicates = near_duplicates
+
+    def content(self, name: str) -> bytes:
+        """The product shot, its first bytes tell it from the others."""
+        image = name.rsplit("-", 1)[0]
+        if self.photos:
+            return self.photo(image)
+        return image.encode() + self.asset[len(image) :]
+
+    @functools.lru_cache(maxsize=4096)
+    def photo(self, image: str) -> bytes:
+        group, idx = map(int, image.split("_"))
+        near_duplicate = idx >= self.assets - self.near_duplicates
+        photo = photo_like(self.photos, self.photos, seed=group * self.assets + (not near_duplicate and idx or 0))
+        if near_duplicate:
+            margin = self.photos // 100
+            photo = ImageEnhance.Brightness(photo.crop((margin, margin, self.photos, self.photos))).enhance(1.05)
+        buffer = io.BytesIO()
+        photo.save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+
+    def image_name(self, bahag_id: str, idx: int) -> str:
+        image = f"{int(bahag_id) // self.variants}_{idx}"
+        return self.shared_urls and image or f"{image}-{bahag_id}"
+
+    def masterdata(self, bahag_id: str) -> dict:
+        return {
+            "sap_number": bahag_id,
+            "result": [
+                {
+                    "type": "PRODUCT_IMAGE",
+                    "asset": {
+                        "sub_type": "Product Shot",
+                        "image_derivatives": [
+                            {
+                                "media_type": media_type,
+                                "name": name,
+                                "url": f"{self.url}/cdn/{self.image_name(bahag_id, idx)}.jpg",
+                            }
+                            for media_type in ("IMAGE_JPG", "IMAGE_PNG")
+                            for name in ("prod_large_square", "prod_small", "prod_thumbnail")
+                        ],
+                    },
+                }
+                for idx in range(self.assets)
+            ],
+        }
+
+
+class AssetsHandler(FakeHandler):
+    def do_POST(self):
+        self.read_body()
+        if self.path != "/oauth2/accesstoken":
+            return self.reply(404)
+        self.reply_json({"access_token": uuid.uuid4().hex, "expires_in": 3600})
+
+    def do_GET(self):
+        if self.reply_stats():
+            return
+        if status := self.server.injected_status():
+            return self.reply(status)
+        path = urlsplit(self.path).path
+        if match := MASTERDATA_PATH.fullmatch(path):
+            return self.reply_json(self.server.masterdata(match.group(2)))
+        if match := CDN_PATH.fullmatch(path):
+            etag = f'"{match.group(1)}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self.reply(304, headers={"ETag": etag})
+            headers = {"Content-Type": "image/jpeg", "ETag": etag, "Last-Modified": "Mon, 05 Oct 2026 10:00:00 GMT"}
+            return self.reply(200, self.server.content(match.group(1)), headers)
+        self.reply(404)
+
+
+class FakeStorageServer(FakeServer):
+    """The uploads of the GCS JSON API into an in-memory bucket, see `blob` for reading the objects back."""
+
+    def __init__(self, **kwargs):
+        super().__init__(StorageHandler, **kwargs)
+        self.blobs = {}
+        self.uploads = {}
+
+    def blob(self, bucket_id: str, name: str) -> bytes:
+        return self.blobs.get((bucket_id, name))
+
+    def store(self, bucket_id: str, name: str, data: bytes) -> dict:
+        with self._lock:
+            self.blobs[(bucket_id, name)] = bytes(data)
+            self.stats.update(objects=1, bytes_in=len(data))
+        return {"kind": "storage#object", "bucket": bucket_id, "name": name, "size": str(len(data)), "generation": "1"}
+
+
+class StorageHandler(FakeHandler):
+    def do_POST(self):
+        body = self.read_body()
+        if status := self.server.injected_status():
+            return self.reply(status)
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if not (match := UPLOAD_PATH.fullmatch(url.path)):
+            return self.reply(404)
+        bucket_id = match.group(1)
+        upload_type = query.get("uploadType")
+        if upload_type == "media":
+            return self.reply_json(self.server.store(bucket_id, query["name"], body))
+        if upload_type == "multipart":
+            # metadata and data parts of a multipart/related body
+            boundary = self.headers["Content-Type"].split("boundary=")[1].strip('"').encode()
+            metadata, data = (part.split(b"\r\n\r\n", 1)[1] for part in body.split(b"--" + boundary)[1:3])
+            return self.reply_json(self.server.store(bucket_id, json.loads(metadata)["name"], data[:-2]))
+        if upload_type == "resumable":
+            name = query.get("name") or json.loads(body)["name"]
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = (bucket_id, name, bytearray())
+            location = f"{self.server.url}{url.path}?uploadType=resumable&upload_id={upload_id}"
+            return self.reply_json({}, headers={"Location": location})
+        self.reply(400)
+
+    def do_PUT(self):
+        body = self.read_body()
+        if status := self.server.injected_status():
+            return self.reply(status)
+        upload_id = parse_qs(urlsplit(self.path).query).get("upload_id", [None])[0]
+        if upload_id not in self.server.uploads:
+            return self.reply(404)
+        bucket_id, name, data = self.server.uploads[upload_id]
+        data += body
+        total = CONTENT_RANGE.fullmatch(self.headers.get("Content-Range", "")).group(3)
+        if total != "*" and len(data) == int(total):
+            del self.server.uploads[upload_id]
+            return self.reply_json(self.server.store(bucket_id, name, data))
+        # the chunks received so far
+        self.reply(308, headers=data and {"Range": f"bytes=0-{len(data) - 1}"} or {})
+
+    def do_GET(self):
+        if not self.reply_stats():
+            self.reply(404)
+
+
+def vision_stand_in(storage: FakeStorageServer, index_latency: float = 0.0, search_latency: float = 0.0):
+    """gRPC server of ImportProductSets, taking `index_latency` seconds per reference image of the bulk import
+    file in `storage`, and BatchAnnotateImages, returning the indexed products after `search_latency` seconds.
+    """
+    indexed = []
+
+    def import_product_sets(request_bytes: bytes, context) -> bytes:
+        request = vision.ImportProductSetsRequest.deserialize(request_bytes)
+        bucket_id, name = request.input_config.gcs_source.csv_file_uri.removeprefix("gs://").split("/", 1)
+        if (csv_file := storage.blob(bucket_id, name)) is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"No {name} in {bucket_id}")
+        rows = [line.split(",") for line in csv_file.decode().splitlines()]
+        time.sleep(index_latency * len(rows))
+        indexed.extend(row[3] for row in rows)
+        response = vision.ImportProductSetsResponse(
+            reference_images=[
+                {"name": f"{request.parent}/products/{row[3]}/referenceImages/{idx}", "uri": row[0]}
+                for idx, row in enumerate(rows)
+            ],
+            statuses=[status_pb2.Status(code=0)] * len(rows),
+        )
+        # done already, the client doesn't poll the operation
+        operation = operations_pb2.Operation(name=f"{request.parent}/operations/{uuid.uuid4().hex}", done=True)
+        operation.response.Pack(vision.ImportProductSetsResponse.pb(response))
+        return operation.SerializeToString()
+
+    def batch_annotate_images(request_bytes: bytes, context) -> bytes:
+        time.sleep(search_latency)
+        request = vision.BatchAnnotateImagesRequest.deserialize(request_bytes)
+        responses = []
+        for image_request in request.requests:
+            products = indexed[: image_request.features[0].max_results] or ["123"]
+            result = vision.ProductSearchResults.GroupedResult(
+                bounding_poly={
+                    "normalized_vertices": [{"x": 0.1, "y": 0.2}, {"x": 0.6, "y": 0.2}, {"x": 0.6, "y": 0.9}]
+                },
+                results=[
+                    {"product": {"name": f"projects/p/locations/l/products/{product}"}, "score": 0.9}
+                    for product in products
+                ],
+                object_annotations=[{"name": "Chair", "score": 0.95}],
+            )
+            responses.append({"product_search_results": {"product_grouped_results": [result]}})
+        return vision.BatchAnnotateImagesResponse.serialize(vision.BatchAnnotateImagesResponse(responses=responses))
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=8), options=[("grpc.max_receive_message_length", 256 * 1024**2)]
+    )
+    server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "google.cloud.vision.v1.ProductSearch",
+                {"ImportProductSets": grpc.unary_unary_rpc_method_handler(import_product_sets)},
+            ),
+            grpc.method_handlers_generic_handler(
+                "google.cloud.vision.v1.ImageAnnotator",
+                {"BatchAnnotateImages": grpc.unary_unary_rpc_method_handler(batch_annotate_images)},
+            ),
+        ]
+    )
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    return server, port
+
+
+class FakeConnection:
+    """psycopg2 connection whose (named) cursors return the `product_ids` rows, `page_latency` seconds a page."""
+
+    def __init__(self, product_ids, page_latency: float = 0.0):
+        self.product_ids = product_ids
+        self.page_latency = page_latency
+
+    def cursor(self, name: str = None):
+        return FakeCursor(self.product_ids, self.page_latency)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeCursor:
+    itersize = 2000
+
+    def __init__(self, product_ids, page_latency: float):
+        self.product_ids = product_ids
+        self.page_latency = page_latency
+        self._rows = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def execute(self, query: str, vars=None) -> None:
+        self._rows = ((bahag_id,) for bahag_id in self.product_ids)
+
+    def fetchmany(self, size: int) -> list:
+        time.sleep(self.page_latency)
+        return list(itertools.islice(self._rows, size))
+
+
+def serve_fakes(conn, options: dict) -> None:
+    assets = FakeAssetsServer(**options["assets"])
+    storage = FakeStorageServer(**options["storage"])
+    vision_server, vision_port = vision_stand_in(storage, **options["vision"])
+    for server in (assets, storage):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send({"assets": assets.url, "storage": storage.url, "vision": f"127.0.0.1:{vision_port}"})
+    # until the benchmark is done
+    conn.recv()
+    vision_server.stop(None)
+    for server in (assets, storage):
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def running_fakes(assets: dict = None, storage: dict = None, vision: dict = None):
+    """Runs the assets, storage and Vision stand-ins in a new process, yields their endpoints:
+    {"assets": base url, "storage": base url, "vision": host:port}.
+
+    Args:
+        assets: FakeAssetsServer kwargs.
+        storage: FakeStorageServer kwargs.
+        vision: vision_stand_in kwargs.
+    """
+    # spawned, a forked child would inherit the gRPC state of this process
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    options = {"assets": assets or {}, "storage": storage or {}, "vision": vision or {}}
+    process = context.Process(target=serve_fakes, args=(child_conn, options), daemon=True)
+    process.start()
+    try:
+        yield conn.recv()
+    finally:
+        conn.send(None)
+        process.join(10)
@@ -0,0 +1,74 @@
+"""Cold-start cost of the entry points: the wall time of `python -c "import <module>"` and,
+from `python -X importtime`, the heaviest packages each one imports:
+    python -m benchmarks.import_time --repeat 5 --max-seconds 1.0
+
+Nothing is called, the entry points run their code under `if __name__ == "__main__"`.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = [
+    "list_product_sets",
+    "delete_product_set",
+    "vision_bulk_index",
+    "import_assets",
+    "import_index_pipeline",
+    "product_search_cli",
+    "product_search_ui",
+    "search_service",
+]
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def wall_time(module: str, env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def heaviest_imports(module: str, env: dict, top: int = 4):
+    """The direct imports of the module by their cumulative time in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, check=True, capture_output=True
+    )
+    children = []
+    # the imports are listed after the ones they import, indented by 2 spaces per level
+    for line in result.stderr.decode().splitlines():
+        if not (match := IMPORTTIME_LINE.match(line)):
+            continue
+        _, cumulative, indent, name = match.groups()
+        if not indent and name == module:
+            return sorted(children, reverse=True)[:top]
+        if not indent:
+            children = []
+        elif len(indent) == 2:
+            children.append((int(cumulative) / 1e6, name))
+    return []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=5, help="imports timed per module, the fastest one counts")
+    parser.add_argument("--max-seconds", type=float, help="exit with 1 if an import takes longer")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    interpreter = min(wall_time("sys", env) for _ in range(args.repeat))
+    print(f"interpreter start: {interpreter:.3f}s, the times below don't include it")
+    too_slow = []
+    for module in args.modules:
+        seconds = min(wall_time(module, env) for _ in range(args.repeat)) - interpreter
+        heaviest = ", ".join(f"{name} {cumulative:.2f}s" for cumulative, name in heaviest_imports(module, env))
+        print(f"{module:>22}: {seconds:6.3f}s ({heaviest})")
+        if args.max_seconds and seconds > args.max_seconds:
+            too_slow.append(module)
+    if too_slow:
+        print(f"Slower than {args.max_seconds}s: {', '.join(too_slow)}")
+        sys.exit(1)
@@ -0,0 +1,74 @@
+"""Compare serving concurrent UI users one at a time, concurrently and micro-batched (utils.batching.MicroBatcher).
+
+Every user searches `--queries` images one after another, a search request takes `--request-latency`
+seconds plus `--image-latency` per image of its batch, the way batch_annotate_images does, and at most
+`--workers` requests are in flight (the search quota):
+    python -m benchmarks.micro_batching --users 1,4,16,32
+"""
+
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.batching import MicroBatcher
+
+
+def batch_search(request_latency: float, image_latency: float, images: list) -> list:
+    time.sleep(request_latency + image_latency * len(images))
+    return [{"bboxes": [], "matches": {}, "image": image} for image in images]
+
+
+def run(search, users: int, queries: int):
+    def user(user_id: int):
+        latencies = []
+        for query in range(queries):
+            start = time.perf_counter()
+            result = search((user_id, query))
+            assert result["image"] == (user_id, query), "a result went to another user"
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        latencies = [latency for user_latencies in executor.map(user, range(users)) for latency in user_latencies]
+    elapsed = time.perf_counter() - start
+    return users * queries / elapsed, statistics.median(latencies), statistics.quantiles(latencies, n=20)[-1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,4,16,32", help="numbers of concurrent users to compare, comma separated")
+    parser.add_argument("--queries", type=int, default=10, help="searches per user")
+    parser.add_argument("--request-latency", type=float, default=0.2)
+    parser.add_argument("--image-latency", type=float, default=0.01)
+    parser.add_argument("--workers", type=int, default=4, help="search requests in flight")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-wait", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fn = partial(batch_search, args.request_latency, args.image_latency)
+    lock = threading.Lock()
+
+    def one_at_a_time(image):
+        with lock:
+            return fn([image])[0]
+
+    for users in (int(u) for u in args.users.split(",")):
+        print(f"{users} users:")
+        modes = [
+            ("one at a time (before)", None, None),
+            ("concurrent", 1, 0.0),
+            ("micro-batched", args.batch_size, args.max_wait),
+        ]
+        for name, batch_size, max_wait in modes:
+            if batch_size is None:
+                qps, p50, p95 = run(one_at_a_time, users, args.queries)
+                batch_info = ""
+            else:
+                with MicroBatcher(fn, max_batch_size=batch_size, max_wait=max_wait, workers=args.workers) as batcher:
+                    qps, p50, p95 = run(batcher, users, args.queries)
+                batch_info = f", {batcher.stats['items'] / batcher.stats['batches']:.1f} images per request"
+            print(f"{name:>24}: {qps:7.1f} queries/s, p50 {p50 * 1000:6.0f} ms, p95 {p95 * 1000:6.0f} ms{batch_info}")
@@ -0,0 +1,70 @@
+"""Compare LIMIT/OFFSET paging with the streaming cursor used by import_assets.get_bahag_products.
+
+Runs against a local SQLite stand-in of "PIM_query20_5":
+    python -m benchmarks.product_ids_pagination --rows 2000000 --batch-size 10000
+"""
+
+import argparse
+import sqlite3
+import statistics
+import time
+
+from utils.db import iter_pages
+
+
+def create_table(conn: sqlite3.Connection, rows: int):
+    conn.execute('CREATE TABLE "PIM_query20_5" ("Variant_product" TEXT)')
+    conn.executemany(
+        'INSERT INTO "PIM_query20_5" VALUES (?)', ((f"{i:08d}",) for i in range(10_000_000, 10_000_000 + rows))
+    )
+    conn.commit()
+
+
+def offset_pages(conn: sqlite3.Connection, batch_size: int):
+    page = 1
+    while True:
+        skip = (page - 1) * batch_size
+        sql = f'SELECT q205."Variant_product" FROM "PIM_query20_5" q205 LIMIT {batch_size} OFFSET {skip};'
+        result_set = conn.execute(sql).fetchall()
+        if not result_set:
+            break
+        yield list(sum(result_set, ()))
+        page += 1
+
+
+def streamed_pages(conn: sqlite3.Connection, batch_size: int):
+    cur = conn.cursor()
+    cur.execute('SELECT q205."Variant_product" FROM "PIM_query20_5" q205;')
+    yield from iter_pages(cur, batch_size=batch_size)
+
+
+def measure(pages) -> list:
+    latencies = []
+    start = time.perf_counter()
+    for _ in pages:
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    return latencies
+
+
+def report(name: str, latencies: list):
+    tenth = max(len(latencies) // 10, 1)
+    print(
+        f"{name:>10}: pages={len(latencies)} total={sum(latencies):.2f}s "
+        f"first 10%={statistics.mean(latencies[:tenth]) * 1e3:.2f}ms "
+        f"median={statistics.median(latencies) * 1e3:.2f}ms "
+        f"last 10%={statistics.mean(latencies[-tenth:]) * 1e3:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    create_table(conn, args.rows)
+    report("offset", measure(offset_pages(conn, args.batch_size)))
+    report("streamed", measure(streamed_pages(conn, args.batch_size)))
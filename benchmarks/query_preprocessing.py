@@ -0,0 +1,114 @@
+"""Compare the query image encodings of product_search_cli against a local Vision stand-in.
+
+A gRPC server implements ImageAnnotator.BatchAnnotateImages: it waits for the request to
+arrive over a link of `--bandwidth-mbps`, decodes the image like the service does and returns
+a product search result. The real ImageAnnotatorClient calls it with a 4000x3000 photo-like
+image encoded by utils.image.encode_query_image:
+    python -m benchmarks.query_preprocessing --bandwidth-mbps 50 --repeat 3
+"""
+
+import argparse
+import io
+import statistics
+import time
+from concurrent import futures
+
+import grpc
+import numpy as np
+import PIL.Image as Image
+from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+
+from utils.image import encode_image_as_png_str, encode_query_image
+
+MODES = [
+    ("PNG full size (before)", None),
+    ("PNG 1024", {"max_side": 1024, "image_format": "PNG"}),
+    ("JPEG 1024 q85", {"max_side": 1024, "image_format": "JPEG", "quality": 85}),
+    ("WEBP 1024 q80", {"max_side": 1024, "image_format": "WEBP", "quality": 80}),
+    ("JPEG 640 q85", {"max_side": 640, "image_format": "JPEG", "quality": 85}),
+    ("JPEG full size q90", {"max_side": 0, "image_format": "JPEG", "quality": 90}),
+]
+
+
+def photo_like(width: int = 4000, height: int = 3000, seed: int = 0) -> Image.Image:
+    """Smooth shapes with some sensor noise, compressing about as well as a photo."""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)).resize(
+        (width, height), Image.Resampling.BICUBIC
+    )
+    noise = rng.normal(0, 6, (height, width, 3))
+    return Image.fromarray(np.clip(np.asarray(coarse) + noise, 0, 255).astype(np.uint8))
+
+
+def stand_in(bandwidth_mbps: float):
+    def batch_annotate_images(request_bytes: bytes, context) -> bytes:
+        time.sleep(len(request_bytes) * 8 / (bandwidth_mbps * 1e6))
+        request = vision.BatchAnnotateImagesRequest.deserialize(request_bytes)
+        for image_request in request.requests:
+            Image.open(io.BytesIO(image_request.image.content)).load()
+        result = vision.ProductSearchResults.GroupedResult(
+            bounding_poly={"normalized_vertices": [{"x": 0.1, "y": 0.2}, {"x": 0.6, "y": 0.2}, {"x": 0.6, "y": 0.9}]},
+            results=[{"product": {"name": "projects/p/locations/l/products/123"}, "score": 0.9}],
+            object_annotations=[{"name": "Chair", "score": 0.95}],
+        )
+        response = vision.BatchAnnotateImagesResponse(
+            responses=[{"product_search_results": {"product_grouped_results": [result]}}] * len(request.requests)
+        )
+        return vision.BatchAnnotateImagesResponse.serialize(response)
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=4), options=[("grpc.max_receive_message_length", 256 * 1024**2)]
+    )
+    handler = grpc.unary_unary_rpc_method_handler(batch_annotate_images)
+    server.add_generic_rpc_handlers(
+        [
+            grpc.method_handlers_generic_handler(
+                "google.cloud.vision.v1.ImageAnnotator", {"BatchAnnotateImages": handler}
+            )
+        ]
+    )
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    return server, port
+
+
+def search(client: vision.ImageAnnotatorClient, content: bytes):
+    """Same request as utils.google_cloud.get_similar_products, which needs the credentials at import."""
+    product_set = vision.ProductSearchClient.product_set_path("project", "europe-west1", "bahag_products")
+    image_context = vision.ImageContext(
+        product_search_params=vision.ProductSearchParams(product_set=product_set, product_categories=["homegoods-v2"])
+    )
+    response = client.product_search(vision.Image(content=content), image_context=image_context, max_results=10)
+    return response.product_search_results.product_grouped_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--bandwidth-mbps", type=float, default=50.0, help="uplink to the Vision API")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    server, port = stand_in(args.bandwidth_mbps)
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    client = vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+    image = photo_like(args.width, args.height)
+    print(f"{args.width}x{args.height} image, {args.bandwidth_mbps:g} Mbit/s uplink")
+    for name, options in MODES:
+        encode_times, total_times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            content = options and encode_query_image(image, **options) or encode_image_as_png_str(image)
+            encoded = time.perf_counter()
+            results = search(client, content)
+            encode_times.append(encoded - start)
+            total_times.append(time.perf_counter() - start)
+        assert results[0].results, results
+        print(
+            f"{name:>24}: encode {statistics.median(encode_times) * 1000:7.0f} ms, "
+            f"payload {len(content) / 1024:8.0f} KiB, end-to-end {statistics.median(total_times) * 1000:7.0f} ms"
+        )
+    channel.close()
+    server.stop(None)
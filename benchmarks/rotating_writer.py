@@ -0,0 +1,71 @@
+"""Compare the line buffered RotatingTextWriter with its buffered mode and batched write_many.
+
+Writes bulk import like CSV lines into a temporary directory, rolling over by line count
+and by size, and checks all the modes produce the same parts:
+    python -m benchmarks.rotating_writer --lines 3000000
+"""
+
+import argparse
+import hashlib
+import tempfile
+import time
+from pathlib import Path
+
+from utils.output import RotatingTextWriter
+
+
+def csv_lines(n_lines: int) -> list:
+    return [
+        f"gs://bucket/{i}_product_image_{i}.jpg,,bahag_products,{i},homegoods-v2,bahag_product,'type=product_image',\n"
+        for i in range(10_000_000, 10_000_000 + n_lines)
+    ]
+
+
+def digest(out_dir: Path) -> str:
+    sha256 = hashlib.sha256()
+    for fpath in sorted(out_dir.iterdir()):
+        sha256.update(fpath.name.encode())
+        sha256.update(fpath.read_bytes())
+    return sha256.hexdigest()
+
+
+def run(lines: list, out_dir: Path, batch_size: int = None, **kwargs):
+    start = time.perf_counter()
+    with RotatingTextWriter(out_dir / "bulk.csv", **kwargs) as writer:
+        if batch_size:
+            for idx in range(0, len(lines), batch_size):
+                writer.write_many(lines[idx : idx + batch_size])
+        else:
+            for line in lines:
+                writer.write(line)
+    return time.perf_counter() - start, writer.rollover_count + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=3_000_000)
+    parser.add_argument("--max-lines", type=int, default=20_000)
+    parser.add_argument("--max-size-b", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--buffer-size", type=int, default=1024 * 1024)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    lines = csv_lines(args.lines)
+    modes = [
+        ("line buffered", {}),
+        ("buffered", {"buffer_size": args.buffer_size}),
+        ("write_many", {"buffer_size": args.buffer_size, "batch_size": args.batch_size}),
+    ]
+    for limit_name, limit in (
+        ("max_lines", {"max_lines": args.max_lines}),
+        ("max_size_b", {"max_size_b": args.max_size_b}),
+    ):
+        digests = set()
+        for name, kwargs in modes:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                elapsed, parts = run(lines, Path(tmp_dir), **limit, **kwargs)
+                digests.add(digest(Path(tmp_dir)))
+            print(
+                f"{limit_name:>10} {name:>13}: {elapsed:.2f}s, {args.lines / elapsed / 1e6:.2f}M lines/s, {parts} parts"
+            )
+        print(f"{limit_name:>10} outputs identical: {len(digests) == 1}")
@@ -0,0 +1,101 @@
+"""Load test search_service.py against a local Vision stand-in, no Google Cloud project needed.
+
+The service runs in uvicorn with its channels pointed at the gRPC stand-in of benchmarks.query_preprocessing,
+`--users` clients upload a photo-like JPEG (or send its URL) and search as fast as they get the answers:
+    python -m benchmarks.search_service --users 1,8,32 --requests 200 --channels 4
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import time
+
+import httpx
+import uvicorn
+from fastapi import Response
+
+from benchmarks.query_preprocessing import photo_like, stand_in
+
+
+async def start_service(app) -> tuple:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, serving, server.servers[0].sockets[0].getsockname()[1]
+
+
+async def load(base_url: str, users: int, requests: int, jpeg: bytes, image_url: str = None):
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def user(client: httpx.AsyncClient):
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            if image_url:
+                response = await client.post("/search", data={"url": image_url})
+            else:
+                response = await client.post("/search", files={"image": ("query.jpg", jpeg, "image/jpeg")})
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code != 200
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        await asyncio.gather(*(user(client) for _ in range(users)))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, statistics.median(latencies), statistics.quantiles(latencies, n=20)[-1], errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,8,32", help="numbers of concurrent clients to compare, comma separated")
+    parser.add_argument("--requests", type=int, default=200, help="searches per run")
+    parser.add_argument("--channels", type=int, default=4, help="gRPC channels of the service")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--bandwidth-mbps", type=float, default=1000.0, help="uplink to the Vision stand-in")
+    parser.add_argument("--url", action="store_true", help="send the URL of the image instead of uploading it")
+    args = parser.parse_args()
+
+    grpc_server, grpc_port = stand_in(args.bandwidth_mbps)
+    os.environ.update(
+        VISION_API_ENDPOINT=f"127.0.0.1:{grpc_port}",
+        VISION_API_INSECURE="True",
+        SEARCH_CHANNELS=str(args.channels),
+        PROJECT_ID="project",
+        PROJECT_REGION="europe-west1",
+    )
+    # the service reads its settings at import
+    import search_service
+
+    buffer = io.BytesIO()
+    photo_like(args.width, args.height).save(buffer, format="JPEG", quality=90)
+    jpeg = buffer.getvalue()
+
+    # the service fetches the URL from a route of its own app serving the image
+    search_service.app.add_api_route("/benchmark.jpg", lambda: Response(jpeg, media_type="image/jpeg"))
+
+    async def main():
+        # the clients run on the event loop of the service, as another process would on a CPU of the machine
+        server, serving, port = await start_service(search_service.app)
+        base_url = f"http://127.0.0.1:{port}"
+        image_url = args.url and f"{base_url}/benchmark.jpg" or None
+        print(f"{args.width}x{args.height} JPEG of {len(jpeg) / 1024:.0f} KiB, {args.channels} channels")
+        for users in (int(u) for u in args.users.split(",")):
+            qps, p50, p95, errors = await load(base_url, users, args.requests, jpeg, image_url)
+            print(
+                f"{users:>4} users: {qps:5.1f} req/s, p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, {errors} errors"
+            )
+
+        async with httpx.AsyncClient() as client:
+            latency = (await client.get(f"{base_url}/metrics")).json()["latency"]
+        for stage, histogram in latency.items():
+            print(f"{stage:>12}: p50 {histogram['p50_s'] * 1000:6.1f} ms, p95 {histogram['p95_s'] * 1000:6.1f} ms")
+        server.should_exit = True
+        await serving
+
+    asyncio.run(main())
+    grpc_server.stop(None)
@@ -0,0 +1,121 @@
+"""Measure how the import scales with the number of shard processes (import_assets.py --local-shards N).
+
+Every process runs the threaded pipeline of utils.pipeline over its utils.sharding.Shard of the products:
+the metadata stage parses an API like JSON document (holding the GIL, the ceiling of a single process)
+after a simulated request latency, the transfer stage hashes the asset bytes and the bulk import lines
+are written into the shard's own files, merged into the final parts at the end:
+    python -m benchmarks.sharded_import --products 20000 --processes 1,2,4
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+from utils.output import RotatingTextWriter
+from utils.pipeline import Pipeline, Stage
+from utils.sharding import Shard
+
+ASSET = os.urandom(64 * 1024)
+
+
+def api_document(bahag_id: str, n_assets: int = 40) -> str:
+    return json.dumps(
+        {
+            "sap_number": bahag_id,
+            "result": [
+                {
+                    "type": "PRODUCT_IMAGE",
+                    "asset": {
+                        "sub_type": "Product Shot",
+                        "image_derivatives": [
+                            {"media_type": media_type, "name": name, "url": f"https://cdn/{bahag_id}/{idx}/{name}"}
+                            for media_type in ("IMAGE_JPG", "IMAGE_PNG")
+                            for name in ("prod_large_square", "prod_small", "prod_thumbnail")
+                        ],
+                    },
+                }
+                for idx in range(n_assets)
+            ],
+        }
+    )
+
+
+def select(latency: float, bahag_id: str):
+    time.sleep(latency)
+    api_data = json.loads(api_document(bahag_id))
+    return [
+        {"bahag_id": bahag_id, "url": img["url"]}
+        for item in api_data["result"]
+        for img in item["asset"]["image_derivatives"]
+        if img["media_type"] == "IMAGE_JPG" and img["name"] == "prod_large_square"
+    ][:3]
+
+
+def transfer(latency: float, asset: dict):
+    time.sleep(latency)
+    return [{**asset, "sha256": hashlib.sha256(ASSET).hexdigest()}]
+
+
+def run_shard(shard: Shard, products: int, out_file: Path, threads: int, latency: float) -> None:
+    pipeline = Pipeline(
+        source=(bahag_id for bahag_id in map(str, range(10_000_000, 10_000_000 + products)) if shard.owns(bahag_id)),
+        stages=[
+            Stage("metadata", partial(select, latency), workers=threads),
+            Stage("transfer", partial(transfer, latency), workers=threads),
+        ],
+        report_interval=0,
+    )
+    with RotatingTextWriter(shard.path(out_file), max_lines=20_000, buffer_size=1024 * 1024) as writer:
+        for entry in pipeline:
+            writer.write(f"{entry['url']},,bahag_products,{entry['bahag_id']},{entry['sha256']}\n")
+
+
+def merge(count: int, out_file: Path) -> int:
+    with RotatingTextWriter(out_file, max_lines=20_000, buffer_size=1024 * 1024) as writer:
+        for index in range(count):
+            for fpath in RotatingTextWriter(Shard(index, count).path(out_file)).parts():
+                writer.write_many(fpath.read_text().splitlines(keepends=True))
+    return writer.total_lines_written
+
+
+def run(processes: int, products: int, out_dir: Path, threads: int, latency: float):
+    out_file = out_dir / "bulk.csv"
+    start = time.perf_counter()
+    shards = [
+        multiprocessing.Process(target=run_shard, args=(Shard(index, processes), products, out_file, threads, latency))
+        for index in range(processes)
+    ]
+    for shard in shards:
+        shard.start()
+    for shard in shards:
+        shard.join()
+    imported = time.perf_counter() - start
+    lines = merge(processes, out_file)
+    return imported, time.perf_counter() - start - imported, lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=20_000)
+    parser.add_argument("--processes", default="1,2,4", help="shard process counts to compare, comma separated")
+    parser.add_argument("--threads", type=int, default=16, help="threads of every stage in every process")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds of a simulated request")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    baseline = None
+    for processes in (int(p) for p in args.processes.split(",")):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imported, merged, lines = run(processes, args.products, Path(tmp_dir), args.threads, args.latency)
+        rate = args.products / imported
+        baseline = baseline or rate / processes
+        print(
+            f"{processes:>3} processes: {imported:.2f}s, {rate:.0f} products/s, speedup {rate / baseline:.2f}x "
+            f"({rate / baseline / processes:.0%} efficiency), merge of {lines} lines {merged:.2f}s"
+        )
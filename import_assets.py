@@ -1,23 +1,66 @@
+import argparse
+import asyncio
+import io
 import logging
+import multiprocessing
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import closing, nullcontext
 from distutils.util import strtobool
-from io import BytesIO
+from functools import partial
 from pathlib import Path
+from typing import AsyncIterator, Callable, List
 
 import psycopg2
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from utils.assets_api import BahagAssetsAPI  # noqa: E402
-from utils.google_cloud import GCS_CLIENT, upload_to_storage  # noqa: E402
-from utils.output import RotatingTextWriter  # noqa: E402
+from utils.assets_api import NOT_MODIFIED, AssetsUnavailable, AsyncBahagAssetsAPI, BahagAssetsAPI  # noqa: E402
+from utils.cache import DiskCache, TwoTierCache  # noqa: E402
+from utils.concurrency import AdaptiveLimiter, AsyncAdaptiveLimiter  # noqa: E402
+from utils.db import iter_pages  # noqa: E402
+from utils.google_cloud import AsyncStorageUploader, StorageUploader, is_retryable  # noqa: E402
+from utils.image import hamming_distance, image_fingerprint  # noqa: E402
+from utils.journal import ImportJournal  # noqa: E402
+from utils.manifest import AssetManifest  # noqa: E402
+from utils.metrics import Metrics  # noqa: E402
+from utils.output import AsyncRotatingTextWriter, RotatingTextWriter  # noqa: E402
+from utils.pipeline import Pipeline, Stage  # noqa: E402
+from utils.sharding import Shard  # noqa: E402
+from utils.transfer import (  # noqa: E402
+    CHUNK_SIZE_UNIT,
+    AsyncByteBudget,
+    AsyncSingleFlight,
+    ByteBudget,
+    CappedStream,
+    Digest,
+    FileTooBig,
+    SingleFlight,
+    capped_chunks,
+)
 
 logging.basicConfig(level=logging.INFO, format="%(name)s - %(asctime)s %(levelname)s:%(message)s")
 logger = logging.getLogger(__name__)
 
 N_THREADS = os.cpu_count() * 8
+METADATA_THREADS = int(os.environ.get("METADATA_THREADS", N_THREADS))
+TRANSFER_THREADS = int(os.environ.get("TRANSFER_THREADS", N_THREADS))
+# seconds between the pipeline queue depth and metrics log lines
+QUEUE_REPORT_INTERVAL = float(os.environ.get("QUEUE_REPORT_INTERVAL", 60))
+
+# asyncio engine, a single thread with up to ASYNC_CONCURRENCY products in flight
+ASYNC_IMPORT = bool(strtobool(os.environ.get("ASYNC_IMPORT", "False")))
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", 1000))
+
+# AIMD limits of the requests in flight to the metadata API, the CDN and the bucket,
+# the stage threads (or ASYNC_CONCURRENCY) are only the upper bound then
+ADAPTIVE_CONCURRENCY = bool(strtobool(os.environ.get("ADAPTIVE_CONCURRENCY", "True")))
+INITIAL_CONCURRENCY = int(os.environ.get("INITIAL_CONCURRENCY", 8))
 
 POSTGRES_SERVER = os.environ.get("POSTGRES_SERVER")
 POSTGRES_USER = os.environ.get("POSTGRES_USER")
@@ -39,35 +82,135 @@ PROCESS_MOODSHOTS_ONLY = bool(strtobool(os.environ.get("PROCESS_MOODSHOTS_ONLY",
 SAVE_MOODSHOTS = bool(strtobool(os.environ.get("SAVE_MOODSHOTS", "False")))
 OUT_MOOD_SHOTS_FILE = OUT_DIR / "test_mood_shots.out"
 
+# skip the assets unchanged since the previous run, see utils.manifest
+INCREMENTAL_IMPORT = bool(strtobool(os.environ.get("INCREMENTAL_IMPORT", "True")))
+ASSETS_MANIFEST = Path(os.environ.get("ASSETS_MANIFEST", OUT_DIR / "assets_manifest.sqlite"))
+
+# opt-in: identical images (e.g. of the colour variants of an article) are stored once, named by the sha256
+# of their contents, and all their bulk import rows point to that file; incremental runs only revalidate
+# a url already transferred for another product, see transfer_asset.
+# The name is only known once the whole file is read, so every asset is buffered in memory (up to
+# MAX_ASSET_SIZE each, within MAX_INFLIGHT_BYTES) instead of streamed in TRANSFER_CHUNK_SIZE chunks
+DEDUPLICATE_ASSETS = bool(strtobool(os.environ.get("DEDUPLICATE_ASSETS", "False")))
+# contents stored by the run that are shared without asking the manifest, all a `--full` run knows about
+RECENT_CONTENTS = 100_000
+
+# `--prune-near-duplicates` (or PRUNE_NEAR_DUPLICATES=True) writes no bulk import row for the images of a product
+# within NEAR_DUPLICATE_DISTANCE bits of the perceptual hash of a better one (more pixels, then more bytes),
+# e.g. the same shot slightly cropped or retouched; the hashes are computed by HASH_PROCESSES worker processes
+# and kept in the manifest
+PRUNE_NEAR_DUPLICATES = bool(strtobool(os.environ.get("PRUNE_NEAR_DUPLICATES", "False")))
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_DISTANCE", 8))
+HASH_PROCESSES = int(os.environ.get("HASH_PROCESSES", os.cpu_count()))
+
+# assets masterdata cache, "use" it, only "refresh" it or turn it "off"
+METADATA_CACHE = os.environ.get("METADATA_CACHE", "use")
+METADATA_CACHE_FILE = Path(os.environ.get("METADATA_CACHE_FILE", OUT_DIR / "assets_metadata_cache.sqlite"))
+METADATA_CACHE_TTL = float(os.environ.get("METADATA_CACHE_TTL", 6 * 3600))
+METADATA_CACHE_NEGATIVE_TTL = float(os.environ.get("METADATA_CACHE_NEGATIVE_TTL", 3600))
+METADATA_CACHE_MAX_SIZE = int(os.environ.get("METADATA_CACHE_MAX_SIZE", 1024**3))
+
+# progress of the run, checkpointed every IMPORT_CHECKPOINT_EVERY finished products,
+# `--resume` (or IMPORT_RESUME=True) continues an interrupted run from the last checkpoint
+IMPORT_RESUME = bool(strtobool(os.environ.get("IMPORT_RESUME", "False")))
+IMPORT_JOURNAL = Path(os.environ.get("IMPORT_JOURNAL", OUT_DIR / "import_journal.sqlite"))
+IMPORT_CHECKPOINT_EVERY = int(os.environ.get("IMPORT_CHECKPOINT_EVERY", 1000))
+
+# counters, byte totals and latency histograms of the DB, metadata API, download, upload
+# and bulk file writer calls of a run, written as JSON at its end, see utils.metrics
+IMPORT_METRICS_FILE = Path(os.environ.get("IMPORT_METRICS_FILE", OUT_DIR / "import_metrics.json"))
+
+# `--shard i/N` (or IMPORT_SHARD="i/N") imports only the i-th of N partitions of the products,
+# with its own bulk import files, manifest, metadata cache and journal in OUTPUT/shard_i_of_N/
+IMPORT_SHARD = Shard.parse(os.environ.get("IMPORT_SHARD", "0/1"))
+
 # https://cloud.google.com/vision/product-search/docs/csv-format
 LINES_PER_OUT_FILE = 20_000
+# the bulk import files are written in blocks of this size, fsync'ed once complete
+WRITE_BUFFER_SIZE = 1024 * 1024
 PRODUCT_CATEGORY = os.environ.get("PRODUCT_CATEGORY", "homegoods-v2")
 PRODUCT_SET = "bahag_products"
 
+MAX_ASSET_SIZE = 1024 * 1024 * 20 - 1
+TRANSFER_CHUNK_SIZE = 4 * CHUNK_SIZE_UNIT
+# upper limit of the asset bytes held in memory by all the transfers together
+MAX_INFLIGHT_BYTES = int(os.environ.get("MAX_INFLIGHT_BYTES", 256 * 1024 * 1024))
+TRANSFER_BUDGET = ByteBudget(MAX_INFLIGHT_BYTES)
+
+_DONE = object()
+
 
 def db_connect():
     conn = psycopg2.connect(host=POSTGRES_SERVER, database=POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD)
     return conn
 
 
-def get_bahag_products(batch_size: int = 10_000, page: int = 1):
+def get_bahag_products(batch_size: int = 10_000, prefetch: int = 1, metrics: Metrics = None):
     logger.info(f"Getting products with batch size: {batch_size}")
-    with db_connect().cursor() as cur:
-        while True:
-            skip = (page - 1) * batch_size
-            sql = f'SELECT q205."Variant_product" FROM "PIM_query20_5" q205 LIMIT {batch_size} OFFSET {skip};'
-            cur.execute(query=sql)
-            result_set = cur.fetchall()
-            if not result_set:
-                break
-            yield list(sum(result_set, ()))
-            logger.info(f"Fetched {skip + len(result_set)} items")
-            page += 1
+    metrics = metrics or Metrics()
+    conn = db_connect()
+    try:
+        # a named cursor is server-side, so postgres streams the result set
+        # instead of re-scanning all the previous rows for every LIMIT/OFFSET page
+        with conn.cursor(name="bahag_products") as cur:
+            cur.itersize = batch_size
+            cur.execute(query='SELECT q205."Variant_product" FROM "PIM_query20_5" q205;')
+            fetched = 0
+            # the time the import waits for a page, the prefetched ones come at no wait
+            waiting_since = time.perf_counter()
+            for batch in iter_pages(cur, batch_size=batch_size, prefetch=prefetch):
+                metrics.observe("db.page", time.perf_counter() - waiting_since)
+                metrics.count("db.rows", len(batch))
+                fetched += len(batch)
+                yield batch
+                logger.info(f"Fetched {fetched} items")
+                waiting_since = time.perf_counter()
+    finally:
+        conn.close()
+
+
+def unfinished_products(journal: ImportJournal, shard: Shard = IMPORT_SHARD, metrics: Metrics = None):
+    """The product id batches of the shard, without the products finished before the last checkpoint."""
+    with closing(get_bahag_products(metrics=metrics)) as products:
+        for batch in products:
+            yield journal.unfinished([bahag_id for bahag_id in batch if shard.owns(bahag_id)])
+
+
+def concurrency_limiters(metadata_max: int, transfer_max: int, limiter_class=AdaptiveLimiter) -> dict:
+    """Limiters of the metadata, download and upload calls, fixed at the max values if not ADAPTIVE_CONCURRENCY."""
+    return {
+        name: limiter_class(
+            name,
+            initial=INITIAL_CONCURRENCY,
+            max_limit=max_limit,
+            # the transfer latency depends on the file size more than on the load
+            latency_tolerance=name == "metadata" and 2.5 or None,
+            # the uploaders throttle the slot on every retry, a retriable error escaping the last one too
+            is_throttling=name == "upload" and is_retryable or None,
+            enabled=ADAPTIVE_CONCURRENCY,
+        )
+        for name, max_limit in (("metadata", metadata_max), ("download", transfer_max), ("upload", transfer_max))
+    }
+
+
+def metadata_cache(mode: str = METADATA_CACHE, shard: Shard = IMPORT_SHARD):
+    if mode == "off":
+        return
+    return TwoTierCache(
+        maxsize=100_000,
+        ttl=METADATA_CACHE_TTL,
+        negative_ttl=METADATA_CACHE_NEGATIVE_TTL,
+        disk=DiskCache(shard.path(METADATA_CACHE_FILE), ttl=METADATA_CACHE_TTL, max_size_b=METADATA_CACHE_MAX_SIZE),
+        read=mode == "use",
+    )
 
 
 def get_assets_info(client: BahagAssetsAPI, bahag_id: str, country_code: str = "de", language_id: str = "de-DE"):
     api_data = client.get_assets_data(bahag_id=bahag_id, country_code=country_code, language_id=language_id)
+    return parse_assets_info(api_data)
+
 
+def parse_assets_info(api_data: dict):
     if not api_data:
         return
 
@@ -84,8 +227,34 @@ def get_assets_info(client: BahagAssetsAPI, bahag_id: str, country_code: str = "
     return result
 
 
-def process(assets_client: BahagAssetsAPI, bahag_id: str):
-    item_assets = get_assets_info(client=assets_client, bahag_id=bahag_id)
+def fetch_metadata(assets_client: BahagAssetsAPI, bahag_id: str):
+    """Metadata only stage for warming the cache up."""
+    try:
+        return assets_client.get_assets_data(bahag_id=bahag_id) and [] or None
+    except AssetsUnavailable:
+        return None
+
+
+def select_assets(assets_client: BahagAssetsAPI, bahag_id: str, journal: ImportJournal = None):
+    """Metadata stage: get the product assets and pick the ones to be imported.
+
+    The product is added to the journal with one output per asset, see per_asset. Without a definitive answer
+    of the API it isn't journaled at all, so a resumed run imports it again.
+    """
+    try:
+        assets = pick_assets(bahag_id, get_assets_info(client=assets_client, bahag_id=bahag_id))
+    except AssetsUnavailable:
+        return None
+    if journal:
+        journal.add(bahag_id, assets and len(assets) or 0)
+    return assets
+
+
+def pick_assets(bahag_id: str, item_assets: dict):
+    """Returns None if the product isn't suitable, otherwise a list of asset dicts.
+
+    Mood shots are only passed on if "SAVE_MOODSHOTS" is set.
+    """
     if not item_assets:
         logger.warning(f"No API data for id={bahag_id}")
         return
@@ -102,7 +271,7 @@ def process(assets_client: BahagAssetsAPI, bahag_id: str):
             logger.warning(f"No mood shots for id={bahag_id}")
             return
 
-    result = {"bulk_entries": [], "moodshot_entries": []}
+    assets = []
 
     for asset in item_assets["images"]:
         asset_url = asset["url"]
@@ -112,78 +281,893 @@ def process(assets_client: BahagAssetsAPI, bahag_id: str):
             logger.warning(f"No url for id={bahag_id}, type={asset_type}")
             continue
 
-        if asset_type == "mood_shot":
-            ms_entry = f"{bahag_id},{asset_url}\n"
-            result["moodshot_entries"].append(ms_entry)
+        if asset_type == "mood_shot" and not SAVE_MOODSHOTS:
             continue
 
-        file_data = assets_client.get_asset_file(asset_url)
+        assets.append({"bahag_id": bahag_id, "asset_type": asset_type, "url": asset_url})
+
+    return assets
+
+
+def is_too_big(asset: dict, filesize: int) -> bool:
+    if filesize > MAX_ASSET_SIZE:
+        logger.warning(f"File too big (>20MB) for id={asset['bahag_id']}, url: {asset['url']}")
+        return True
+    return False
+
+
+def asset_bucket_filename(asset: dict) -> str:
+    return f"{asset['bahag_id']}_{asset['asset_type']}_{asset['filename']}"
+
+
+def content_bucket_filename(digest: Digest, filename: str) -> str:
+    """Bucket name of the asset contents, the same for every product sharing them."""
+    return f"sha256/{digest.hexdigest()}{Path(filename).suffix.lower()}"
+
+
+def stored_content(manifest: AssetManifest, remote_fname: str):
+    """gs:// url of the contents if the manifest has them stored already, None otherwise."""
+    gcs_url = f"gs://{STORAGE_BUCKET_ID}/{remote_fname}"
+    return manifest.has_gcs_url(gcs_url) and gcs_url or None
+
 
-        if not file_data:
+def bulk_entry(asset: dict, gcs_url: str, fingerprint: dict = None) -> dict:
+    """The bulk import row of the asset, with the perceptual hash, pixels and size of its image if known."""
+    return {"gcs_url": gcs_url, "bahag_id": asset["bahag_id"], "asset_type": asset["asset_type"], **(fingerprint or {})}
+
+
+def unchanged_entry(asset: dict, cached: dict, file_data):
+    """Bulk entry from the manifest if the CDN says the asset hasn't changed since, None otherwise."""
+    if not cached or not file_data:
+        return
+    if file_data is NOT_MODIFIED or (file_data[3]["etag"] and file_data[3]["etag"] == cached["etag"]):
+        fingerprint = cached["phash"] and {field: cached[field] for field in ("phash", "pixels", "size")}
+        return bulk_entry(asset, cached["gcs_url"], fingerprint)
+
+
+def record_transfer(
+    manifest: AssetManifest, asset: dict, validators: dict, digest: Digest, gcs_url: str, fingerprint: dict = None
+) -> None:
+    manifest.put(
+        bahag_id=asset["bahag_id"],
+        url=asset["url"],
+        gcs_url=gcs_url,
+        etag=validators["etag"],
+        last_modified=validators["last_modified"],
+        size=digest.size,
+        sha256=digest.hexdigest(),
+        filename=asset["filename"],
+        phash=fingerprint and fingerprint["phash"],
+        pixels=fingerprint and fingerprint["pixels"],
+    )
+
+
+def prune_near_duplicates(entries: list, max_distance: int = NEAR_DUPLICATE_DISTANCE) -> tuple:
+    """(entries, count of the pruned ones) without the images of the product within max_distance bits
+    of the perceptual hash of a better one, more pixels and then more bytes are better.
+
+    The entries without a hash (mood shots, assets that aren't images) are all kept, in their order.
+    """
+    best_first = sorted(entries, key=lambda entry: (entry.get("pixels") or 0, entry.get("size") or 0), reverse=True)
+    kept_hashes, pruned = [], set()
+    for entry in best_first:
+        if not entry.get("phash"):
             continue
+        phash = int(entry["phash"], 16)
+        if any(hamming_distance(phash, kept) <= max_distance for kept in kept_hashes):
+            pruned.add(id(entry))
+        else:
+            kept_hashes.append(phash)
+    return [entry for entry in entries if id(entry) not in pruned], len(pruned)
+
+
+def hash_processes(prune: bool):
+    """Worker processes computing the perceptual hashes, None without prune."""
+    if not prune:
+        return
+    # spawned, forking the threads of the running import isn't safe
+    return ProcessPoolExecutor(HASH_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+
+def record_shared(manifest: AssetManifest, asset: dict, shared: dict) -> None:
+    """Manifest entry of the asset pointing to the file transferred for another product with the same url."""
+    fields = ("url", "gcs_url", "etag", "last_modified", "size", "sha256", "filename", "phash", "pixels")
+    manifest.put(**{field: shared[field] for field in fields}, bahag_id=asset["bahag_id"])
+
+
+def revalidated(manifest: AssetManifest, asset: dict, incremental: bool, deduplicate: bool, hashed: bool) -> tuple:
+    """(manifest entry of the asset, entry of its url transferred for another product) to revalidate with the CDN.
+
+    If hashed, the entries without a perceptual hash don't count, the asset is downloaded again to get one.
+    """
+    if not incremental:
+        return None, None
+    cached = manifest.get(asset["bahag_id"], asset["url"])
+    shared = not cached and deduplicate and manifest.get_by_url(asset["url"]) or None
+    if hashed:
+        return cached and cached["phash"] and cached or None, shared and shared["phash"] and shared or None
+    return cached, shared
+
+
+def upload_asset(uploader: StorageUploader, file, remote_fname: str, size: int) -> str:
+    # files up to a chunk are sent in a single request, bigger or unknown size ones chunk by chunk
+    if 0 < size <= TRANSFER_CHUNK_SIZE:
+        return uploader.upload(STORAGE_BUCKET_ID, file.read(), remote_fname)
+    return uploader.upload_stream(STORAGE_BUCKET_ID, iter(partial(file.read, TRANSFER_CHUNK_SIZE), b""), remote_fname)
+
+
+def store_content(
+    dedup: SingleFlight,
+    manifest: AssetManifest,
+    uploader: StorageUploader,
+    content: bytes,
+    remote_fname: str,
+    incremental: bool,
+    metrics: Metrics,
+) -> str:
+    """Upload the contents under their content-addressed name, unless they're stored (or being stored) already."""
+    gcs_url = incremental and stored_content(manifest, remote_fname)
+    shared = bool(gcs_url)
+    if not gcs_url:
+        gcs_url, shared = dedup.run(
+            remote_fname,
+            partial(upload_asset, uploader, io.BytesIO(content), remote_fname, len(content)),
+        )
+    if shared:
+        metrics.count("dedup.content")
+    return gcs_url
+
+
+def transfer_asset(
+    assets_client: BahagAssetsAPI,
+    manifest: AssetManifest,
+    uploader: StorageUploader,
+    asset: dict,
+    incremental: bool = True,
+    metrics: Metrics = None,
+    dedup: SingleFlight = None,
+    hashes: Executor = None,
+):
+    """Transfer stage: stream the asset file from the CDN straight into the bucket,
+    mood shots are passed through as they are.
+
+    If incremental, the download is conditional on the manifest entry of the asset
+    and the unchanged assets are neither downloaded nor uploaded again.
+    With dedup the file is read whole and stored under the hash of its contents, once for all the products,
+    a url transferred for another product is revalidated with the CDN like an own one.
+    With hashes (worker processes) the file is read whole too and its entry gets the fingerprint of the image
+    for prune_near_duplicates.
+    """
+    if asset["asset_type"] == "mood_shot":
+        return [asset]
+
+    metrics = metrics or Metrics()
+    cached, shared = revalidated(manifest, asset, incremental, bool(dedup), bool(hashes))
+    with assets_client.stream_asset_file(asset["url"], validators=cached or shared) as file_data:
+        if entry := unchanged_entry(asset, cached or shared, file_data):
+            if shared:
+                record_shared(manifest, asset, shared)
+                metrics.count("dedup.url")
+            return [entry]
+
+        if not file_data or file_data is NOT_MODIFIED or is_too_big(asset, file_data[1]):
+            return []
+
+        filename, filesize, raw, validators = file_data
+        asset = {**asset, "filename": filename}
+        digest = Digest()
+        stream = CappedStream(raw, max_size=MAX_ASSET_SIZE, digest=digest)
+        fingerprint = None
+        try:
+            if dedup or hashes:
+                with TRANSFER_BUDGET.reserve(filesize or MAX_ASSET_SIZE):
+                    content = b"".join(iter(partial(stream.read, TRANSFER_CHUNK_SIZE), b""))
+                    # hashed while it's uploaded
+                    hashing = hashes and hashes.submit(image_fingerprint, content)
+                    if dedup:
+                        gcs_url = store_content(
+                            dedup,
+                            manifest,
+                            uploader,
+                            content,
+                            content_bucket_filename(digest, filename),
+                            incremental,
+                            metrics,
+                        )
+                    else:
+                        fname = asset_bucket_filename(asset)
+                        gcs_url = upload_asset(uploader, io.BytesIO(content), fname, len(content))
+                    if hashing:
+                        with metrics.time("phash"):
+                            fingerprint = hashing.result()
+            else:
+                with TRANSFER_BUDGET.reserve(0 < filesize <= TRANSFER_CHUNK_SIZE and filesize or TRANSFER_CHUNK_SIZE):
+                    gcs_url = upload_asset(uploader, stream, asset_bucket_filename(asset), filesize)
+        except FileTooBig:
+            is_too_big(asset, MAX_ASSET_SIZE + 1)
+            return []
+
+    record_transfer(manifest, asset, validators, digest, gcs_url, fingerprint)
+    return [bulk_entry(asset, gcs_url, fingerprint)]
+
+
+def per_asset(transfer: Callable, asset: dict):
+    """Transfer stage wrapper passing every asset on with its (maybe empty) entries,
+    so the writer can tell when all the assets of a product are transferred.
+    The entries are None if the asset is unavailable for now, the product isn't finished then.
+    """
+    try:
+        return [(asset, transfer(asset))]
+    except AssetsUnavailable:
+        return [(asset, None)]
+
+
+async def content_chunks(content: bytes) -> AsyncIterator[bytes]:
+    for start in range(0, len(content), TRANSFER_CHUNK_SIZE):
+        yield content[start : start + TRANSFER_CHUNK_SIZE]
+
+
+async def upload_content(uploader: AsyncStorageUploader, content: bytes, remote_fname: str) -> str:
+    if len(content) <= TRANSFER_CHUNK_SIZE:
+        return await uploader.upload(STORAGE_BUCKET_ID, content, remote_fname)
+    return await uploader.upload_stream(STORAGE_BUCKET_ID, content_chunks(content), remote_fname, size=len(content))
+
+
+async def store_content_async(
+    dedup: AsyncSingleFlight,
+    manifest: AssetManifest,
+    uploader: AsyncStorageUploader,
+    content: bytes,
+    remote_fname: str,
+    incremental: bool,
+) -> str:
+    """Same as store_content, the asyncio way."""
+    gcs_url = incremental and stored_content(manifest, remote_fname)
+    shared = bool(gcs_url)
+    if not gcs_url:
+        gcs_url, shared = await dedup.run(remote_fname, partial(upload_content, uploader, content, remote_fname))
+    if shared:
+        uploader.metrics.count("dedup.content")
+    return gcs_url
 
-        filename, filesize, content = file_data
 
-        if filesize >= 1024 * 1024 * 20:
-            logger.warning(f"File too big (>20MB) for id={bahag_id}, url: {asset_url}")
+async def transfer_asset_async(
+    assets_client: AsyncBahagAssetsAPI,
+    uploader: AsyncStorageUploader,
+    budget: AsyncByteBudget,
+    manifest: AssetManifest,
+    asset: dict,
+    incremental: bool = True,
+    dedup: AsyncSingleFlight = None,
+    hashes: Executor = None,
+):
+    cached, shared = revalidated(manifest, asset, incremental, bool(dedup), bool(hashes))
+    async with assets_client.stream_asset_file(
+        asset["url"], chunk_size=TRANSFER_CHUNK_SIZE, validators=cached or shared
+    ) as file_data:
+        if entry := unchanged_entry(asset, cached or shared, file_data):
+            if shared:
+                record_shared(manifest, asset, shared)
+                uploader.metrics.count("dedup.url")
+            return entry
+
+        if not file_data or file_data is NOT_MODIFIED or is_too_big(asset, file_data[1]):
+            return
+
+        filename, filesize, chunks, validators = file_data
+        asset = {**asset, "filename": filename}
+        digest = Digest()
+        chunks = capped_chunks(chunks, max_size=MAX_ASSET_SIZE, digest=digest)
+        fingerprint = None
+        try:
+            if dedup or hashes:
+                async with budget.reserve(filesize or MAX_ASSET_SIZE):
+                    content = b"".join([chunk async for chunk in chunks])
+                    hashing = hashes and asyncio.get_running_loop().run_in_executor(hashes, image_fingerprint, content)
+                    if dedup:
+                        gcs_url = await store_content_async(
+                            dedup, manifest, uploader, content, content_bucket_filename(digest, filename), incremental
+                        )
+                    else:
+                        gcs_url = await upload_content(uploader, content, asset_bucket_filename(asset))
+                    if hashing:
+                        with uploader.metrics.time("phash"):
+                            fingerprint = await hashing
+            elif 0 < filesize <= TRANSFER_CHUNK_SIZE:
+                async with budget.reserve(filesize):
+                    gcs_url = await uploader.upload(
+                        bucket_id=STORAGE_BUCKET_ID,
+                        content=b"".join([chunk async for chunk in chunks]),
+                        remote_fname=asset_bucket_filename(asset),
+                    )
+            else:
+                async with budget.reserve(2 * TRANSFER_CHUNK_SIZE):
+                    gcs_url = await uploader.upload_stream(
+                        bucket_id=STORAGE_BUCKET_ID,
+                        chunks=chunks,
+                        remote_fname=asset_bucket_filename(asset),
+                        size=filesize or None,
+                    )
+        except FileTooBig:
+            is_too_big(asset, MAX_ASSET_SIZE + 1)
+            return
+
+    record_transfer(manifest, asset, validators, digest, gcs_url, fingerprint)
+    return bulk_entry(asset, gcs_url, fingerprint)
+
+
+async def process_async(
+    assets_client: AsyncBahagAssetsAPI,
+    uploader: AsyncStorageUploader,
+    budget: AsyncByteBudget,
+    manifest: AssetManifest,
+    bahag_id: str,
+    incremental: bool = True,
+    dedup: AsyncSingleFlight = None,
+    hashes: Executor = None,
+):
+    """All the pipeline stages for a single product, the asyncio way."""
+    api_data = await assets_client.get_assets_data(bahag_id=bahag_id)
+    assets = pick_assets(bahag_id, parse_assets_info(api_data))
+    if assets is None:
+        return
+
+    entries = []
+
+    for asset in assets:
+        if asset["asset_type"] == "mood_shot":
+            entries.append(asset)
             continue
 
-        bucket_filename = f"{bahag_id}_{asset_type}_{filename}"
-        gcs_url = upload_to_storage(
-            client=GCS_CLIENT, bucket_id=STORAGE_BUCKET_ID, file=BytesIO(content), remote_fname=bucket_filename
+        entry = await transfer_asset_async(
+            assets_client, uploader, budget, manifest, asset, incremental=incremental, dedup=dedup, hashes=hashes
         )
+        if entry:
+            entries.append(entry)
 
-        bulk_entry = {"gcs_url": gcs_url, "bahag_id": bahag_id, "asset_type": asset_type}
+    return entries
 
-        result["bulk_entries"].append(bulk_entry)
 
-    return result
+def remove_stale_bulk_files(out_csv_file: Path = OUT_CSV_FILE) -> None:
+    # the writer appends, the parts of a previous run would mix with the new ones
+    for fpath in out_csv_file.parent.glob(f"{out_csv_file.stem}*{out_csv_file.suffix}"):
+        logger.info(f"Removing {fpath.name} of a previous run")
+        fpath.unlink()
+
+
+def open_journal(resume: bool, shard: Shard = IMPORT_SHARD) -> ImportJournal:
+    journal = ImportJournal(shard.path(IMPORT_JOURNAL))
+    if not resume:
+        journal.reset()
+    return journal
+
+
+def restore_bulk_files(
+    journal: ImportJournal,
+    bulk_file: RotatingTextWriter,
+    on_bulk_file: Callable[[Path], None] = None,
+    ms_file: RotatingTextWriter = None,
+) -> None:
+    """Continue the bulk import files (and the mood shots file) from the last checkpoint,
+    or start them anew without one.
+    """
+    state = journal.writer_state()
+    if ms_file:
+        # a fresh writer's state is an empty file
+        ms_file.restore(state and state.get("mood_shots") or ms_file.state(0))
+    if not state:
+        remove_stale_bulk_files(bulk_file.first_file)
+        return
+    bulk_file.restore(state)
+    logger.info(
+        f"Resuming after {bulk_file.total_lines_written} item rows written in {bulk_file.rollover_count + 1} files"
+    )
+    # the finished parts may not have been handled before the interruption
+    for fpath in on_bulk_file and bulk_file.files or ():
+        on_bulk_file(fpath)
+
+
+def checkpoint_outputs(bulk_file: RotatingTextWriter, ms_file: RotatingTextWriter = None) -> dict:
+    """Flush the output files, returns the state for the journal, see restore_bulk_files."""
+    state = bulk_file.checkpoint()
+    if ms_file:
+        state["mood_shots"] = ms_file.checkpoint()
+    return state
+
+
+async def checkpoint_outputs_async(bulk_file: AsyncRotatingTextWriter, ms_file: AsyncRotatingTextWriter = None) -> dict:
+    state = await bulk_file.checkpoint()
+    if ms_file:
+        state["mood_shots"] = await ms_file.checkpoint()
+    return state
+
+
+def bulk_csv_line(bulk_entry: dict, csv_lines_saved: int) -> str:
+    if csv_lines_saved > 0 and not csv_lines_saved % 1_000_000:
+        product_set = f"{PRODUCT_SET}_{str(csv_lines_saved).rstrip('0')}"
+    else:
+        product_set = PRODUCT_SET
+    item = (
+        bulk_entry["gcs_url"],
+        "",
+        product_set,
+        bulk_entry["bahag_id"],
+        PRODUCT_CATEGORY,
+        "bahag_product",
+        f"'type={bulk_entry['asset_type']}'",
+        "",
+    )
+    return f"{','.join(item)}\n"
+
+
+def renumber_csv_line(line: str, csv_lines_saved: int) -> str:
+    """Line of another bulk import file, with the product set of its position in this one."""
+    # the gcs url is the only field that could contain a comma
+    gcs_url, _, _, bahag_id, _, _, labels, _ = line.rstrip("\n").rsplit(",", 7)
+    entry = {"gcs_url": gcs_url, "bahag_id": bahag_id, "asset_type": labels.removeprefix("'type=").removesuffix("'")}
+    return bulk_csv_line(entry, csv_lines_saved)
+
+
+def merge_shards(count: int, on_bulk_file: Callable[[Path], None] = None) -> List[Path]:
+    """Merge the bulk import files of all the shards into parts of LINES_PER_OUT_FILE lines, as one run writes."""
+    remove_stale_bulk_files()
+    with RotatingTextWriter(
+        OUT_CSV_FILE, max_lines=LINES_PER_OUT_FILE, on_rollover=on_bulk_file, buffer_size=WRITE_BUFFER_SIZE
+    ) as bulk_file:
+        for index in range(count):
+            for fpath in RotatingTextWriter(Shard(index, count).path(OUT_CSV_FILE)).parts():
+                with fpath.open(encoding="utf8", newline="") as shard_file:
+                    lines = [
+                        renumber_csv_line(line, bulk_file.total_lines_written + idx)
+                        for idx, line in enumerate(shard_file)
+                    ]
+                bulk_file.write_many(lines)
+    logger.info(f"Merged {count} shards, {bulk_file.total_lines_written} item rows in {len(bulk_file.files)} files.")
+    merge_mood_shots(count)
+    return bulk_file.files
+
+
+def merge_mood_shots(count: int) -> None:
+    """Concatenate the mood shot files of the shards, in their order, into the one of a single run."""
+    shard_files = [fpath for index in range(count) if (fpath := Shard(index, count).path(OUT_MOOD_SHOTS_FILE)).exists()]
+    if not shard_files:
+        return
+    with OUT_MOOD_SHOTS_FILE.open(mode="wb") as ms_file:
+        for fpath in shard_files:
+            with fpath.open(mode="rb") as shard_file:
+                shutil.copyfileobj(shard_file, ms_file)
+    logger.info(f"Merged the mood shots of {len(shard_files)} shards into {OUT_MOOD_SHOTS_FILE.name}")
+
+
+def write_metrics_report(metrics: Metrics, path: Path, **extra) -> None:
+    logger.info(metrics.report())
+    try:
+        metrics.write_report(path, **extra)
+        logger.info(f"Metrics report written to {path}")
+    except OSError as e:
+        logger.warning(f"Can't write the metrics report to {path}: {e}")
+
+
+def run_shards_locally(count: int, args: List[str], merge: bool = True) -> None:
+    """Run this script as `count` local processes, a shard each, and merge their bulk import files."""
+    shards = [
+        subprocess.Popen([sys.executable, __file__, *args, "--shard", str(Shard(index, count))])
+        for index in range(count)
+    ]
+    failed = [str(Shard(index, count)) for index, shard in enumerate(shards) if shard.wait()]
+    if failed:
+        raise RuntimeError(f"Shards {', '.join(failed)} have failed, rerun them with --resume")
+    if merge:
+        merge_shards(count)
 
 
-def run_job():
+def run_job(
+    use_async: bool = ASYNC_IMPORT,
+    incremental: bool = INCREMENTAL_IMPORT,
+    metadata_cache_mode: str = METADATA_CACHE,
+    on_bulk_file: Callable[[Path], None] = None,
+    resume: bool = IMPORT_RESUME,
+    shard: Shard = IMPORT_SHARD,
+    metrics_file: Path = IMPORT_METRICS_FILE,
+    prune: bool = PRUNE_NEAR_DUPLICATES,
+) -> List[Path]:
+    """Import the assets and write the bulk import files, returns their paths.
+
+    Args:
+        on_bulk_file: Called with every bulk import file as soon as it's complete,
+            from the writing thread (or event loop), so it must not block.
+        resume: Skip the products finished by the interrupted previous run and continue its bulk import files.
+        shard: Import only this partition of the products, into the shard's own files.
+        metrics_file: Where the JSON metrics report of the run is written (in the shard's directory).
+        prune: Write no rows for the near duplicate images of a product, see prune_near_duplicates.
+    """
+    if use_async:
+        return asyncio.run(
+            run_job_async(
+                incremental=incremental,
+                metadata_cache_mode=metadata_cache_mode,
+                on_bulk_file=on_bulk_file,
+                resume=resume,
+                shard=shard,
+                metrics_file=metrics_file,
+                prune=prune,
+            )
+        )
+
+    metrics = Metrics()
+    limiters = concurrency_limiters(METADATA_THREADS, TRANSFER_THREADS)
+    with (
+        metadata_cache(metadata_cache_mode, shard) or nullcontext() as cache,
+        BahagAssetsAPI(
+            user=ASSETS_API_USER,
+            password=ASSETS_API_PASSWORD,
+            base_url=BAHAG_BASE_API_URL,
+            metadata_cache=cache,
+            metadata_limiter=limiters["metadata"],
+            download_limiter=limiters["download"],
+            metrics=metrics,
+        ) as assets_client,
+        StorageUploader(max_connections=TRANSFER_THREADS, limiter=limiters["upload"], metrics=metrics) as uploader,
+        AssetManifest(shard.path(ASSETS_MANIFEST)) as manifest,
+        open_journal(resume, shard) as journal,
+        hash_processes(prune) or nullcontext() as hashes,
+    ):
+        metadata_stage = Stage(
+            "metadata", partial(select_assets, assets_client, journal=journal), workers=METADATA_THREADS
+        )
+        transfer = partial(
+            transfer_asset,
+            assets_client,
+            manifest,
+            uploader,
+            incremental=incremental,
+            metrics=metrics,
+            dedup=DEDUPLICATE_ASSETS and SingleFlight(remember=RECENT_CONTENTS) or None,
+            hashes=hashes,
+        )
+        pipeline = Pipeline(
+            source=(bahag_id for batch in unfinished_products(journal, shard, metrics) for bahag_id in batch),
+            stages=[metadata_stage, Stage("transfer", partial(per_asset, transfer), workers=TRANSFER_THREADS)],
+            report_interval=QUEUE_REPORT_INTERVAL,
+            reporters=[*limiters.values(), metrics],
+        )
+        with (
+            RotatingTextWriter(
+                shard.path(OUT_CSV_FILE),
+                max_lines=LINES_PER_OUT_FILE,
+                on_rollover=on_bulk_file,
+                buffer_size=WRITE_BUFFER_SIZE,
+            ) as bulk_file,
+            SAVE_MOODSHOTS
+            and RotatingTextWriter(shard.path(OUT_MOOD_SHOTS_FILE), buffer_size=WRITE_BUFFER_SIZE)
+            or nullcontext() as ms_file,
+        ):
+            restore_bulk_files(journal, bulk_file, on_bulk_file, ms_file)
+            # the entries of a product are held back until all its assets are transferred,
+            # a checkpoint must not cut a product whose other assets are still in flight.
+            # A product with an unavailable asset is neither written nor journaled, a resumed run imports it again
+            ready, unavailable = {}, set()
+            for asset, entries in pipeline:
+                bahag_id = asset["bahag_id"]
+                if entries is None:
+                    unavailable.add(bahag_id)
+                ready.setdefault(bahag_id, []).extend(entries or ())
+                if not journal.done(bahag_id, finished=bahag_id not in unavailable):
+                    continue
+                entries = ready.pop(bahag_id)
+                if bahag_id in unavailable:
+                    unavailable.discard(bahag_id)
+                    metrics.count("products.unavailable")
+                    continue
+                if prune:
+                    entries, pruned = prune_near_duplicates(entries)
+                    metrics.count("prune.rows", pruned)
+                written = bulk_file.total_lines_written
+                with metrics.time("csv.write"):
+                    for entry in entries:
+                        if entry["asset_type"] == "mood_shot":
+                            ms_file.write(f"{entry['bahag_id']},{entry['url']}\n")
+                            continue
+                        bulk_file.write(bulk_csv_line(entry, bulk_file.total_lines_written))
+                metrics.count("csv.rows", bulk_file.total_lines_written - written)
+                if journal.uncommitted >= IMPORT_CHECKPOINT_EVERY:
+                    with metrics.time("csv.checkpoint"):
+                        journal.commit(checkpoint_outputs(bulk_file, ms_file))
+            journal.commit(checkpoint_outputs(bulk_file, ms_file))
+
+    if cache:
+        logger.info(f"Metadata cache stats: {cache.stats}")
+    for limiter in limiters.values():
+        logger.info(limiter.report())
+    write_metrics_report(
+        metrics,
+        shard.path(metrics_file),
+        engine="threads",
+        shard=str(shard),
+        products=pipeline.fed_count,
+        suitable_products=metadata_stage.accepted,
+        rows=bulk_file.total_lines_written,
+        files=len(bulk_file.files),
+        pruned_rows=metrics.counters.get("prune.rows", 0),
+    )
+    logger.info(
+        f"Done, saved {metadata_stage.accepted} suitable items out of {pipeline.fed_count} in total,\n"
+        f"{bulk_file.total_lines_written} item rows written in {bulk_file.rollover_count + 1} files."
+    )
+    if prune:
+        logger.info(f"{metrics.counters.get('prune.rows', 0)} near duplicate rows pruned.")
+    if unavailable := metrics.counters.get("products.unavailable"):
+        logger.warning(f"{unavailable} products were unavailable and not written, import them with --resume.")
+    return bulk_file.files
+
+
+def warm_metadata_cache(metadata_cache_mode: str = "use", shard: Shard = IMPORT_SHARD):
+    """Fetch the assets metadata of all the products (of the shard) into the cache, without transferring anything."""
+    metrics = Metrics()
+    limiters = concurrency_limiters(METADATA_THREADS, TRANSFER_THREADS)
+    with (
+        metadata_cache(metadata_cache_mode, shard) as cache,
+        BahagAssetsAPI(
+            user=ASSETS_API_USER,
+            password=ASSETS_API_PASSWORD,
+            base_url=BAHAG_BASE_API_URL,
+            metadata_cache=cache,
+            metadata_limiter=limiters["metadata"],
+            metrics=metrics,
+        ) as assets_client,
+    ):
+        metadata_stage = Stage("metadata", partial(fetch_metadata, assets_client), workers=METADATA_THREADS)
+        pipeline = Pipeline(
+            source=(
+                bahag_id for batch in get_bahag_products(metrics=metrics) for bahag_id in batch if shard.owns(bahag_id)
+            ),
+            stages=[metadata_stage],
+            report_interval=QUEUE_REPORT_INTERVAL,
+            reporters=[limiters["metadata"], metrics],
+        )
+        for _ in pipeline:
+            pass
+
+    logger.info(metrics.report())
+    logger.info(
+        f"Done, metadata of {metadata_stage.accepted} out of {pipeline.fed_count} items cached, stats: {cache.stats}"
+    )
+
+
+async def run_job_async(
+    incremental: bool = INCREMENTAL_IMPORT,
+    metadata_cache_mode: str = METADATA_CACHE,
+    on_bulk_file: Callable[[Path], None] = None,
+    resume: bool = IMPORT_RESUME,
+    shard: Shard = IMPORT_SHARD,
+    metrics_file: Path = IMPORT_METRICS_FILE,
+    prune: bool = PRUNE_NEAR_DUPLICATES,
+) -> List[Path]:
     total_count = 0
     processed_count = 0
-    with BahagAssetsAPI(
-        user=ASSETS_API_USER, password=ASSETS_API_PASSWORD, base_url=BAHAG_BASE_API_URL
-    ) as assets_client:
-        with RotatingTextWriter(OUT_CSV_FILE, max_lines=LINES_PER_OUT_FILE) as bulk_file:
-            for batch in get_bahag_products():
-                total_count += len(batch)
-                with ThreadPoolExecutor(max_workers=N_THREADS) as pool:
-                    futures = (pool.submit(process, assets_client, bahag_id) for bahag_id in batch)
-                    for future in as_completed(futures):
-                        result = future.result()
-                        if result:
-                            for bulk_entry in result["bulk_entries"]:
-                                csv_lines_saved = bulk_file.total_lines_written
-                                if csv_lines_saved > 0 and not csv_lines_saved % 1_000_000:
-                                    product_set = f"{PRODUCT_SET}_{str(csv_lines_saved).rstrip('0')}"
-                                else:
-                                    product_set = PRODUCT_SET
-                                item = (
-                                    bulk_entry["gcs_url"],
-                                    "",
-                                    product_set,
-                                    bulk_entry["bahag_id"],
-                                    PRODUCT_CATEGORY,
-                                    "bahag_product",
-                                    f"'type={bulk_entry['asset_type']}'",
-                                    "",
-                                )
-                                bulk_file.write(f"{','.join(item)}\n")
-
-                            if SAVE_MOODSHOTS:
-                                with OUT_MOOD_SHOTS_FILE.open(mode="at", newline="") as ms_file:
-                                    for mood_shot_entry in result["moodshot_entries"]:
-                                        ms_file.write(mood_shot_entry)
-
-                            processed_count += 1
+    # bounds the products in flight, so the memory doesn't grow with the catalog
+    in_flight = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    results = asyncio.Queue(maxsize=ASYNC_CONCURRENCY)
+    budget = AsyncByteBudget(MAX_INFLIGHT_BYTES)
+    limiters = concurrency_limiters(ASYNC_CONCURRENCY, ASYNC_CONCURRENCY, limiter_class=AsyncAdaptiveLimiter)
+    metrics = Metrics()
+    dedup = DEDUPLICATE_ASSETS and AsyncSingleFlight(remember=RECENT_CONTENTS) or None
 
+    async def _report():
+        while True:
+            await asyncio.sleep(QUEUE_REPORT_INTERVAL)
+            for reporter in [*limiters.values(), metrics]:
+                logger.info(reporter.report())
+
+    async def _write(bulk_file, ms_file, journal):
+        nonlocal processed_count
+        while (result := await results.get()) is not _DONE:
+            bahag_id, entries = result
+            if entries is not None:
+                if prune:
+                    entries, pruned = prune_near_duplicates(entries)
+                    metrics.count("prune.rows", pruned)
+                lines = []
+                with metrics.time("csv.write"):
+                    for entry in entries:
+                        if entry["asset_type"] == "mood_shot":
+                            await ms_file.write(f"{entry['bahag_id']},{entry['url']}\n")
+                            continue
+                        lines.append(bulk_csv_line(entry, bulk_file.total_lines_written + len(lines)))
+                    await bulk_file.write_many(lines)
+                metrics.count("csv.rows", len(lines))
+                processed_count += 1
+            journal.add(bahag_id, 0)
+            if journal.uncommitted >= IMPORT_CHECKPOINT_EVERY:
+                with metrics.time("csv.checkpoint"):
+                    journal.commit(await checkpoint_outputs_async(bulk_file, ms_file))
+        journal.commit(await checkpoint_outputs_async(bulk_file, ms_file))
+
+    cache = metadata_cache(metadata_cache_mode, shard)
+    async with (
+        AsyncBahagAssetsAPI(
+            user=ASSETS_API_USER,
+            password=ASSETS_API_PASSWORD,
+            base_url=BAHAG_BASE_API_URL,
+            max_connections=ASYNC_CONCURRENCY,
+            metadata_cache=cache,
+            metadata_limiter=limiters["metadata"],
+            download_limiter=limiters["download"],
+            metrics=metrics,
+        ) as assets_client,
+        AsyncStorageUploader(
+            max_connections=ASYNC_CONCURRENCY, limiter=limiters["upload"], metrics=metrics
+        ) as uploader,
+        AsyncRotatingTextWriter(
+            shard.path(OUT_CSV_FILE),
+            max_lines=LINES_PER_OUT_FILE,
+            on_rollover=on_bulk_file,
+            buffer_size=WRITE_BUFFER_SIZE,
+        ) as bulk_file,
+        SAVE_MOODSHOTS
+        and AsyncRotatingTextWriter(shard.path(OUT_MOOD_SHOTS_FILE), buffer_size=WRITE_BUFFER_SIZE)
+        or nullcontext() as ms_file,
+    ):
+        hashes = hash_processes(prune)
+        manifest = AssetManifest(shard.path(ASSETS_MANIFEST))
+        journal = open_journal(resume, shard)
+        restore_bulk_files(journal, bulk_file, on_bulk_file, ms_file)
+
+        async def _process(bahag_id):
+            try:
+                entries = await process_async(
+                    assets_client,
+                    uploader,
+                    budget,
+                    manifest,
+                    bahag_id,
+                    incremental=incremental,
+                    dedup=dedup,
+                    hashes=hashes,
+                )
+                await results.put((bahag_id, entries))
+            except AssetsUnavailable:
+                # neither written nor journaled, a resumed run imports it again
+                metrics.count("products.unavailable")
+            finally:
+                in_flight.release()
+
+        reporter = QUEUE_REPORT_INTERVAL and asyncio.create_task(_report())
+        try:
+            async with asyncio.TaskGroup() as writer:
+                writer.create_task(_write(bulk_file, ms_file, journal))
+                with closing(unfinished_products(journal, shard, metrics)) as products:
+                    async with asyncio.TaskGroup() as tasks:
+                        # the DB cursor is blocking, so the pages are fetched in a thread,
+                        # a page may be empty when resuming
+                        while (batch := await asyncio.to_thread(next, products, None)) is not None:
+                            total_count += len(batch)
+                            for bahag_id in batch:
+                                await in_flight.acquire()
+                                tasks.create_task(_process(bahag_id))
+                await results.put(_DONE)
+        finally:
+            if reporter:
+                reporter.cancel()
+            manifest.close()
+            journal.close()
+            if cache:
+                cache.close()
+            if hashes:
+                hashes.shutdown()
+
+    if cache:
+        logger.info(f"Metadata cache stats: {cache.stats}")
+    for limiter in limiters.values():
+        logger.info(limiter.report())
+    write_metrics_report(
+        metrics,
+        shard.path(metrics_file),
+        engine="asyncio",
+        shard=str(shard),
+        products=total_count,
+        suitable_products=processed_count,
+        rows=bulk_file.total_lines_written,
+        files=len(bulk_file.files),
+        pruned_rows=metrics.counters.get("prune.rows", 0),
+    )
     logger.info(
         f"Done, saved {processed_count} suitable items out of {total_count} in total,\n"
         f"{bulk_file.total_lines_written} item rows written in {bulk_file.rollover_count + 1} files."
     )
+    if prune:
+        logger.info(f"{metrics.counters.get('prune.rows', 0)} near duplicate rows pruned.")
+    if unavailable := metrics.counters.get("products.unavailable"):
+        logger.warning(f"{unavailable} products were unavailable and not written, import them with --resume.")
+    return bulk_file.files
 
 
 if __name__ == "__main__":
-    run_job()
+    parser = argparse.ArgumentParser(description="Import the product assets and prepare the bulk import files.")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=ASYNC_IMPORT,
+        help="run the asyncio import engine instead of the threaded pipeline",
+    )
+    parser.add_argument(
+        "--full",
+        dest="incremental",
+        action="store_false",
+        default=INCREMENTAL_IMPORT,
+        help="transfer all the assets again, ignoring the manifest of the previous runs",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        choices=("use", "refresh", "off"),
+        default=METADATA_CACHE,
+        help="use the assets metadata cache, only refresh it or turn it off",
+    )
+    parser.add_argument(
+        "--warm-metadata-cache",
+        action="store_true",
+        help="only fetch the assets metadata of all the products into the cache",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=IMPORT_RESUME,
+        help="continue the interrupted previous run from its last checkpoint",
+    )
+    parser.add_argument(
+        "--prune-near-duplicates",
+        dest="prune",
+        action="store_true",
+        default=PRUNE_NEAR_DUPLICATES,
+        help="write no rows for the near duplicate images of a product",
+    )
+    parser.add_argument(
+        "--shard",
+        type=Shard.parse,
+        default=IMPORT_SHARD,
+        help="import only the i-th of N partitions of the products, as i/N",
+    )
+    parser.add_argument(
+        "--local-shards",
+        type=int,
+        metavar="N",
+        help="run N local processes, a shard each, and merge their bulk import files",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        type=int,
+        metavar="N",
+        help="only merge the bulk import files of N finished shards",
+    )
+    args = parser.parse_args()
+    if args.warm_metadata_cache and args.metadata_cache == "off":
+        parser.error("--warm-metadata-cache needs the metadata cache on")
+    if args.local_shards and args.shard.count > 1:
+        parser.error("--local-shards runs all the shards itself, without --shard")
+    if args.merge_shards:
+        merge_shards(args.merge_shards)
+    elif args.local_shards:
+        run_shards_locally(
+            args.local_shards,
+            [
+                *(args.use_async and ["--async"] or []),
+                *(not args.incremental and ["--full"] or []),
+                *(args.resume and ["--resume"] or []),
+                *(args.prune and ["--prune-near-duplicates"] or []),
+                *(args.warm_metadata_cache and ["--warm-metadata-cache"] or []),
+                f"--metadata-cache={args.metadata_cache}",
+            ],
+            merge=not args.warm_metadata_cache,
+        )
+    elif args.warm_metadata_cache:
+        warm_metadata_cache(metadata_cache_mode=args.metadata_cache, shard=args.shard)
+    else:
+        run_job(
+            use_async=args.use_async,
+            incremental=args.incremental,
+            metadata_cache_mode=args.metadata_cache,
+            resume=args.resume,
+            shard=args.shard,
+            prune=args.prune,
+        )
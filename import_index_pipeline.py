@@ -1,58 +1,116 @@
+import hashlib
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Empty, Queue
 import sys
-import time
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from import_assets import OUT_DIR  # noqa: E402
+from import_assets import ASSETS_MANIFEST, OUT_DIR  # noqa: E402
 from import_assets import run_job as prepare_bulk_import  # noqa: E402
-from utils.google_cloud import GCS_CLIENT, VISION_CLIENT, bulk_import_product_sets, upload_to_storage  # noqa: E402
+from utils.bulk_import import BulkImportScheduler  # noqa: E402
+from utils.google_cloud import (  # noqa: E402
+    download_from_storage,
+    gcs_client,
+    upload_to_storage,
+    vision_client,
+)
 
 logging.basicConfig(level=logging.INFO, format="%(name)s - %(asctime)s %(levelname)s:%(message)s")
 logger = logging.getLogger(__name__)
 
 # setup in Dockerfile
 LOGFILE_PATH = Path("import_index_pipeline.log")
+# metrics report of the import, uploaded along with the log file
+METRICS_REPORT_PATH = LOGFILE_PATH.with_name("import_metrics.json")
 
 PROJECT_ID = os.environ.get("PROJECT_ID")
 PROJECT_REGION = os.environ.get("PROJECT_REGION")
 BULK_CSV_BUCKET_ID = os.environ.get("BULK_CSV_BUCKET_ID", "vision-product-search-csv")
 
+# bulk import operations running at once, their names are kept in the bucket
+# so a restarted job reattaches to them instead of importing the files again
+BULK_IMPORT_CONCURRENCY = int(os.environ.get("BULK_IMPORT_CONCURRENCY", 4))
+BULK_IMPORT_POLL_INTERVAL = float(os.environ.get("BULK_IMPORT_POLL_INTERVAL", 30))
+BULK_IMPORT_SUBMIT_INTERVAL = float(os.environ.get("BULK_IMPORT_SUBMIT_INTERVAL", 10))
+BULK_IMPORT_STATE = OUT_DIR / "bulk_import_operations.json"
+
+
+def upload_state(state_file: Path):
+    with state_file.open("rb") as f:
+        upload_to_storage(client=gcs_client(), bucket_id=BULK_CSV_BUCKET_ID, file=f, remote_fname=state_file.name)
+
+
+def ship_bulk_file(scheduler: BulkImportScheduler, fpath: Path):
+    """Upload a finished bulk import file and schedule its import."""
+    with fpath.open(encoding="utf8") as f:
+        remote_csv_uri = upload_to_storage(
+            bucket_id=BULK_CSV_BUCKET_ID, client=gcs_client(), file=f, remote_fname=fpath.name
+        )
+    with fpath.open("rb") as f:
+        scheduler.add(remote_csv_uri, version=hashlib.file_digest(f, "sha256").hexdigest())
+
 
 if __name__ == "__main__":
     logger.info("Starting import and indexing pipeline. Getting assets.")
     try:
-        prepare_bulk_import()
-        logger.info("Assets saved and bulk import files prepared. Starting indexing job.")
-        files_to_index = list()
-        for fpath in OUT_DIR.glob("*.csv"):
-            remote_csv_uri = upload_to_storage(
+        # the container disk doesn't outlive the job, the assets manifest
+        # and the bulk import operations are kept in the bucket
+        for state_file in (ASSETS_MANIFEST, BULK_IMPORT_STATE):
+            download_from_storage(
+                client=gcs_client(),
                 bucket_id=BULK_CSV_BUCKET_ID,
-                client=GCS_CLIENT,
-                file=fpath.open(encoding="utf8"),
-                remote_fname=fpath.name,
+                remote_fname=state_file.name,
+                local_path=state_file,
             )
-            files_to_index.append(remote_csv_uri)
-        
-        for remote_csv in files_to_index:
-            bulk_import_product_sets(
-                client=VISION_CLIENT, project_id=PROJECT_ID, location=PROJECT_REGION, csv_bulk_gcs_uri=remote_csv
+        scheduler = BulkImportScheduler(
+            client=vision_client(),
+            project_id=PROJECT_ID,
+            location=PROJECT_REGION,
+            state_file=BULK_IMPORT_STATE,
+            max_running=BULK_IMPORT_CONCURRENCY,
+            poll_interval=BULK_IMPORT_POLL_INTERVAL,
+            submit_interval=BULK_IMPORT_SUBMIT_INTERVAL,
+            checkpoint=upload_state,
+        )
+        # every bulk import file is indexed while the next ones are still being written,
+        # only the files of this run are shipped
+        finished_files = Queue()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            import_job = executor.submit(
+                prepare_bulk_import, on_bulk_file=finished_files.put, metrics_file=METRICS_REPORT_PATH
             )
-            time.sleep(10)
+            while not (import_job.done() and finished_files.empty()):
+                try:
+                    ship_bulk_file(scheduler, finished_files.get(timeout=BULK_IMPORT_POLL_INTERVAL))
+                except Empty:
+                    pass
+                scheduler.tick()
+            import_job.result()
+        with ASSETS_MANIFEST.open("rb") as f:
+            upload_to_storage(
+                bucket_id=BULK_CSV_BUCKET_ID, client=gcs_client(), file=f, remote_fname=ASSETS_MANIFEST.name
+            )
+        logger.info("Assets saved and bulk import files prepared. Waiting for the indexing to finish.")
+
+        progress = scheduler.run()
+        if progress["failed"]:
+            raise Exception(f"{progress['failed']} bulk imports have failed")
         logger.info("Done, it's a success!")
     except Exception as e:
         logger.exception(f"Job run has failed because of {str(e)}")
         sys.exit(1)
     finally:
-        if LOGFILE_PATH.exists():
-            logger.info(f"Uploading job log file to {BULK_CSV_BUCKET_ID}")
-            upload_to_storage(
-                bucket_id=BULK_CSV_BUCKET_ID,
-                client=GCS_CLIENT,
-                file=LOGFILE_PATH.open(encoding="utf8"),
-                remote_fname=LOGFILE_PATH.name,
+        for fpath in (LOGFILE_PATH, METRICS_REPORT_PATH):
+            if fpath.exists():
+                logger.info(f"Uploading {fpath.name} to {BULK_CSV_BUCKET_ID}")
+                upload_to_storage(
+                    bucket_id=BULK_CSV_BUCKET_ID,
+                    client=gcs_client(),
+                    file=fpath.open(encoding="utf8"),
+                    remote_fname=fpath.name,
                 )
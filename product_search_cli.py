@@ -1,8 +1,16 @@
+import argparse
+import functools
+import json
 import logging
 import os
 import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from distutils.util import strtobool
+from itertools import islice
 from pathlib import Path
-from typing import Tuple
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 from dotenv import load_dotenv
@@ -10,13 +18,27 @@ from PIL.Image import Image
 
 load_dotenv()
 
-from utils.google_cloud import ANNOTATION_CLIENT, VISION_CLIENT, get_similar_products  # noqa: E402
+from utils.batching import MicroBatcher  # noqa: E402
+from utils.cache import MISS, DiskCache, TwoTierCache  # noqa: E402
+from utils.fetcher import ImageFetcher  # noqa: E402
+from utils.google_cloud import (  # noqa: E402
+    MAX_BATCH_IMAGES,
+    annotation_client,
+    batch_get_similar_products,
+    get_similar_products,
+    vision_client,
+)
 from utils.image import (  # noqa: E402
+    bounding_boxes_overlay,
     draw_bounding_boxes_on_image,
-    encode_image_as_png_str,
+    encode_query_image,
+    exif_upright,
     get_pil_image_from_uri,
+    image_digest,
     save_image_as_png,
 )
+from utils.pipeline import Pipeline, Stage  # noqa: E402
+from utils.search_cache import SearchResultCache  # noqa: E402
 
 logging.basicConfig(level=logging.INFO, format="%(name)s - %(asctime)s %(levelname)s:%(message)s")
 logger = logging.getLogger(__name__)
@@ -24,32 +46,308 @@ logger = logging.getLogger(__name__)
 
 PROJECT_ID = os.environ.get("PROJECT_ID")
 PROJECT_REGION = os.environ.get("PROJECT_REGION")
+PRODUCT_SET_ID = "bahag_products"
+PRODUCT_CATEGORY = "homegoods-v2"
+
+# the query image is sent downscaled to QUERY_IMAGE_MAX_SIDE pixels (0 keeps the full size),
+# as QUERY_IMAGE_FORMAT (PNG, JPEG or WEBP) of QUERY_IMAGE_QUALITY
+QUERY_IMAGE_MAX_SIDE = int(os.environ.get("QUERY_IMAGE_MAX_SIDE", 1024))
+QUERY_IMAGE_FORMAT = os.environ.get("QUERY_IMAGE_FORMAT", "JPEG")
+QUERY_IMAGE_QUALITY = int(os.environ.get("QUERY_IMAGE_QUALITY", 85))
+
+# search results of the same images (by their pixels), in memory and in SEARCH_CACHE_FILE if set,
+# until SEARCH_CACHE_TTL passes or the product set is reindexed
+SEARCH_CACHE = bool(strtobool(os.environ.get("SEARCH_CACHE", "True")))
+SEARCH_CACHE_FILE = os.environ.get("SEARCH_CACHE_FILE")
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 24 * 3600))
+SEARCH_CACHE_MAX_SIZE = int(os.environ.get("SEARCH_CACHE_MAX_SIZE", 256 * 1024**2))
+# seconds between the checks of the product set index time
+SEARCH_CACHE_INDEX_CHECK_INTERVAL = float(os.environ.get("SEARCH_CACHE_INDEX_CHECK_INTERVAL", 300))
 
+# batch mode, the query images are fetched and encoded by FETCH_THREADS and searched
+# MAX_BATCH_IMAGES per request with up to SEARCH_THREADS requests in flight, bypassing the cache
+FETCH_THREADS = int(os.environ.get("FETCH_THREADS", 16))
+SEARCH_THREADS = int(os.environ.get("SEARCH_THREADS", 4))
 
-def get_relevant_products(image_uri: str = None, image_src: Image = None) -> Tuple[Image, dict]:
-    pil_image = image_uri and get_pil_image_from_uri(image_uri=image_uri) or image_src
-    image_bytes = encode_image_as_png_str(pil_image)
-    results = get_similar_products(
-        search_client=VISION_CLIENT,
-        annotation_client=ANNOTATION_CLIENT,
+# the query images are downloaded over pooled connections within IMAGE_FETCH_TIMEOUT seconds
+# (IMAGE_FETCH_CONNECT_TIMEOUT/IMAGE_FETCH_READ_TIMEOUT per socket operation) up to IMAGE_FETCH_MAX_SIZE bytes,
+# and kept in IMAGE_CACHE_FILE if set, revalidated by their ETag
+IMAGE_FETCH_CONNECT_TIMEOUT = float(os.environ.get("IMAGE_FETCH_CONNECT_TIMEOUT", 5))
+IMAGE_FETCH_READ_TIMEOUT = float(os.environ.get("IMAGE_FETCH_READ_TIMEOUT", 15))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", 30))
+IMAGE_FETCH_MAX_SIZE = int(os.environ.get("IMAGE_FETCH_MAX_SIZE", 32 * 1024**2))
+IMAGE_CACHE_FILE = os.environ.get("IMAGE_CACHE_FILE")
+IMAGE_CACHE_TTL = float(os.environ.get("IMAGE_CACHE_TTL", 7 * 24 * 3600))
+IMAGE_CACHE_MAX_SIZE = int(os.environ.get("IMAGE_CACHE_MAX_SIZE", 1024**3))
+
+
+@functools.lru_cache(maxsize=None)
+def search_cache() -> Optional[SearchResultCache]:
+    """The search results cache of the process, built on the first search, None if not SEARCH_CACHE."""
+    if not SEARCH_CACHE:
+        return
+    disk = SEARCH_CACHE_FILE and DiskCache(
+        Path(SEARCH_CACHE_FILE), ttl=SEARCH_CACHE_TTL, max_size_b=SEARCH_CACHE_MAX_SIZE
+    )
+    return SearchResultCache(
+        client=vision_client(),
         project_id=PROJECT_ID,
         location=PROJECT_REGION,
-        product_set_id="bahag_products",
-        product_category="homegoods-v2",
-        image=image_bytes,
+        cache=TwoTierCache(maxsize=1024, ttl=SEARCH_CACHE_TTL, disk=disk or None),
+        index_check_interval=SEARCH_CACHE_INDEX_CHECK_INTERVAL,
+    )
+
+
+IMAGE_FETCHER = ImageFetcher(
+    connect_timeout=IMAGE_FETCH_CONNECT_TIMEOUT,
+    read_timeout=IMAGE_FETCH_READ_TIMEOUT,
+    total_timeout=IMAGE_FETCH_TIMEOUT,
+    max_bytes=IMAGE_FETCH_MAX_SIZE,
+    cache=IMAGE_CACHE_FILE
+    and DiskCache(Path(IMAGE_CACHE_FILE), ttl=IMAGE_CACHE_TTL, max_size_b=IMAGE_CACHE_MAX_SIZE)
+    or None,
+    pool_maxsize=max(FETCH_THREADS, 10),
+)
+
+
+def fetch_image(image_uri: str) -> Image:
+    # a JPEG is decoded just large enough for the query image
+    return get_pil_image_from_uri(image_uri, fetcher=IMAGE_FETCHER, draft_size=QUERY_IMAGE_MAX_SIDE or None)
+
+
+def search_batcher(
+    max_batch_size: int = MAX_BATCH_IMAGES, max_wait: float = 0.0, max_queue: int = 64, workers: int = 4
+):
+    """Searches the images of concurrent get_relevant_products calls together, see utils.batching.MicroBatcher."""
+    return MicroBatcher(
+        lambda images: batch_get_similar_products(
+            search_client=vision_client(),
+            annotation_client=annotation_client(),
+            project_id=PROJECT_ID,
+            location=PROJECT_REGION,
+            product_set_id=PRODUCT_SET_ID,
+            product_category=PRODUCT_CATEGORY,
+            images=images,
+        ),
+        max_batch_size=min(max_batch_size, MAX_BATCH_IMAGES),
+        max_wait=max_wait,
+        max_queue=max_queue,
+        workers=workers,
+        name="search",
     )
 
+
+def get_relevant_products(
+    image_uri: str = None, image_src: Image = None, overlay: bool = False, batcher: MicroBatcher = None
+) -> Tuple[Union[Image, dict], dict]:
+    """The image annotated with the detected objects and the matches of every object.
+
+    With `overlay`, the image is left as it is and the annotations are returned
+    as a JSON overlay for the client to draw instead, see bounding_boxes_overlay.
+    With a `batcher` (see search_batcher), the image is searched along with the ones of the concurrent calls.
+    """
+    # the boxes are drawn on the image as it was searched, upright
+    pil_image = exif_upright(image_uri and fetch_image(image_uri) or image_src)
+    search_results = search_cache()
+    key = search_results and search_results.key(
+        image_digest(pil_image),
+        PRODUCT_SET_ID,
+        PRODUCT_CATEGORY,
+        encoding=f"{QUERY_IMAGE_FORMAT}:{QUERY_IMAGE_MAX_SIDE}:{QUERY_IMAGE_QUALITY}",
+    )
+    results = key and search_results.get(key) or MISS
+    if results is MISS:
+        image = encode_query_image(
+            pil_image, max_side=QUERY_IMAGE_MAX_SIDE, image_format=QUERY_IMAGE_FORMAT, quality=QUERY_IMAGE_QUALITY
+        )
+        if batcher:
+            results = batcher(image)
+            if results is None:
+                raise RuntimeError("Product search has failed")
+        else:
+            results = get_similar_products(
+                search_client=vision_client(),
+                annotation_client=annotation_client(),
+                project_id=PROJECT_ID,
+                location=PROJECT_REGION,
+                product_set_id=PRODUCT_SET_ID,
+                product_category=PRODUCT_CATEGORY,
+                image=image,
+            )
+        if key:
+            search_results.set(key, results)
+
     bboxes = np.array([bbox["vertices"] for bbox in results["bboxes"]])
     captions = [[bbox["annotations"].pop()] for bbox in results["bboxes"] if bbox["annotations"] or ""]
+    if overlay:
+        annotations = bounding_boxes_overlay(
+            pil_image.size, boxes=bboxes, display_str_list_list=captions, color="green", thickness=2
+        )
+        return annotations, results["matches"]
     draw_bounding_boxes_on_image(pil_image, boxes=bboxes, display_str_list_list=captions, color="green", thickness=2)
     return pil_image, results["matches"]
 
 
+def read_queries(path: Path, limit: int = None):
+    """The bahag_id,url lines of a mood shots file, see import_assets SAVE_MOODSHOTS."""
+    with path.open(encoding="utf8") as queries_file:
+        lines = (line.rstrip("\n") for line in queries_file if line.strip())
+        for line in islice(lines, limit):
+            bahag_id, url = line.split(",", 1)
+            yield {"bahag_id": bahag_id, "url": url}
+
+
+def fetch_query(query: dict):
+    """Fetch stage: download and encode the query image, a failed query is passed on with its error."""
+    start = time.perf_counter()
+    try:
+        pil_image = exif_upright(fetch_image(query["url"]))
+        query = {
+            **query,
+            "image": encode_query_image(
+                pil_image, max_side=QUERY_IMAGE_MAX_SIDE, image_format=QUERY_IMAGE_FORMAT, quality=QUERY_IMAGE_QUALITY
+            ),
+        }
+    except Exception as e:
+        query = {**query, "error": f"fetch failed: {e}"}
+    return [{**query, "fetch_s": time.perf_counter() - start}]
+
+
+def match_rank(matches: dict, bahag_id: str) -> Optional[int]:
+    """Best position (from 1) of the product among the matches of all the objects, None if it's not there."""
+    ranks = [
+        rank
+        for object_matches in matches.values()
+        for rank, match in enumerate(object_matches, 1)
+        if match["product"].split("/").pop() == bahag_id
+    ]
+    return min(ranks, default=None)
+
+
+def search_queries(queries: List[dict], top_k: int = 10) -> List[dict]:
+    """Search the fetched queries in a single request, returns the result of every query."""
+    fetched = [query for query in queries if "image" in query]
+    start = time.perf_counter()
+    try:
+        outputs = fetched and batch_get_similar_products(
+            search_client=vision_client(),
+            annotation_client=annotation_client(),
+            project_id=PROJECT_ID,
+            location=PROJECT_REGION,
+            product_set_id=PRODUCT_SET_ID,
+            product_category=PRODUCT_CATEGORY,
+            images=[query["image"] for query in fetched],
+            max_results=top_k,
+        )
+    except Exception as e:
+        logger.warning(f"Search request of {len(fetched)} images has failed: {e}")
+        outputs = [None] * len(fetched)
+    search_s = time.perf_counter() - start
+
+    results = dict(zip((id(query) for query in fetched), outputs))
+    for query in queries:
+        # the queries failed to fetch have their error already
+        if "image" not in query:
+            continue
+        del query["image"]
+        query["search_s"] = search_s
+        if output := results.get(id(query)):
+            query.update(matches=output["matches"], rank=match_rank(output["matches"], query["bahag_id"]))
+        else:
+            query["error"] = "search failed"
+    return queries
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values and values[min(int(q * len(values)), len(values) - 1)] or 0.0
+
+
+def search_batch(queries_file: Path, out_file: Path, top_k: int = 10, limit: int = None) -> dict:
+    """Search all the queries of a mood shots file, streaming the results to a JSONL file.
+
+    Returns the throughput, latency percentiles and the share of the queries
+    their own product is found for in the top 1 and top_k matches.
+    """
+    fetch_times, search_times, ranks, errors = [], [], [], 0
+    start = time.perf_counter()
+
+    def _write(future: Future) -> None:
+        nonlocal errors
+        results = future.result()
+        # a single request for all of them
+        search_times.extend({result["search_s"] for result in results if "search_s" in result})
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+            fetch_times.append(result["fetch_s"])
+            if "error" in result:
+                errors += 1
+            else:
+                ranks.append(result["rank"])
+
+    pipeline = Pipeline(
+        source=read_queries(queries_file, limit),
+        stages=[Stage("fetch", fetch_query, workers=FETCH_THREADS)],
+        report_interval=0,
+    )
+    with ThreadPoolExecutor(SEARCH_THREADS) as searches, out_file.open("w", encoding="utf8") as out:
+        pending = deque()
+        queries = iter(pipeline)
+        while batch := list(islice(queries, MAX_BATCH_IMAGES)):
+            pending.append(searches.submit(search_queries, batch, top_k))
+            # the results are written in order, as soon as the oldest request is done
+            while len(pending) > SEARCH_THREADS or (pending and pending[0].done()):
+                _write(pending.popleft())
+        while pending:
+            _write(pending.popleft())
+
+    elapsed = time.perf_counter() - start
+    searched = len(ranks)
+    return {
+        "queries": len(fetch_times),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "queries_per_s": round(len(fetch_times) / elapsed, 2),
+        "fetch_p50_s": round(percentile(fetch_times, 0.5), 3),
+        "fetch_p95_s": round(percentile(fetch_times, 0.95), 3),
+        "search_request_p50_s": round(percentile(search_times, 0.5), 3),
+        "search_request_p95_s": round(percentile(search_times, 0.95), 3),
+        "hit@1": searched and round(sum(rank == 1 for rank in ranks) / searched, 4),
+        f"hit@{top_k}": searched and round(sum(rank is not None for rank in ranks) / searched, 4),
+    }
+
+
 if __name__ == "__main__":
-    input_img_uri = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Search the products similar to an image, or a file of them.")
+    parser.add_argument("image_uri", nargs="?", help="image to search the similar products to")
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        metavar="FILE",
+        help="search the bahag_id,url lines of the file instead, e.g. OUTPUT/test_mood_shots.out",
+    )
+    parser.add_argument("--out", type=Path, default=Path("search_results.jsonl"), help="JSONL results of --batch")
+    parser.add_argument("--top-k", type=int, default=10, help="matches per object, the hit rate is counted in")
+    parser.add_argument("--limit", type=int, help="search only the first queries of --batch")
+    parser.add_argument(
+        "--overlay", action="store_true", help="print the boxes as a JSON overlay instead of saving output.png"
+    )
+    args = parser.parse_args()
+    if bool(args.image_uri) == bool(args.batch):
+        parser.error("either an image URI or --batch is required")
+
+    if args.batch:
+        report = search_batch(args.batch, args.out, top_k=args.top_k, limit=args.limit)
+        logger.info(f"Results saved to {args.out}")
+        print(json.dumps(report, indent=2), file=sys.stdout)
+        sys.exit(0)
+
     try:
-        annotated_image, matches = get_relevant_products(image_uri=input_img_uri)
-        save_image_as_png(annotated_image, Path("output.png"))
+        annotated_image, matches = get_relevant_products(image_uri=args.image_uri, overlay=args.overlay)
+        if args.overlay:
+            print(json.dumps(annotated_image), file=sys.stdout)
+        else:
+            save_image_as_png(annotated_image, Path("output.png"))
         print(matches, file=sys.stdout)
     except Exception as e:
         logger.exception(e)
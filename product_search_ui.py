@@ -1,14 +1,36 @@
+import os
 from typing import Tuple
 
 import gradio as gr
 from PIL.Image import Image
 
-from product_search_cli import get_relevant_products
+from product_search_cli import get_relevant_products, search_batcher
+from utils.batching import QueueFull
+
+# UI_CONCURRENCY users are served at once, up to UI_QUEUE_SIZE more wait in the gradio queue;
+# the searches arriving together are sent in one request of up to SEARCH_BATCH_SIZE images,
+# held SEARCH_BATCH_WAIT seconds for more (0: none, the batches only form while
+# all SEARCH_BATCH_WORKERS requests are in flight) with at most SEARCH_QUEUE_SIZE images waiting
+UI_CONCURRENCY = int(os.environ.get("UI_CONCURRENCY", 16))
+UI_QUEUE_SIZE = int(os.environ.get("UI_QUEUE_SIZE", 64))
+SEARCH_BATCH_SIZE = int(os.environ.get("SEARCH_BATCH_SIZE", 16))
+SEARCH_BATCH_WAIT = float(os.environ.get("SEARCH_BATCH_WAIT", 0))
+SEARCH_BATCH_WORKERS = int(os.environ.get("SEARCH_BATCH_WORKERS", 4))
+SEARCH_QUEUE_SIZE = int(os.environ.get("SEARCH_QUEUE_SIZE", 64))
+
+SEARCH_BATCHER = search_batcher(
+    max_batch_size=SEARCH_BATCH_SIZE,
+    max_wait=SEARCH_BATCH_WAIT,
+    max_queue=SEARCH_QUEUE_SIZE,
+    workers=SEARCH_BATCH_WORKERS,
+)
 
 
 def match_image(image_uri: str = None, image_src: Image = None) -> Tuple[Image, str]:
     try:
-        annotated_image, matches = get_relevant_products(image_uri, image_src)
+        annotated_image, matches = get_relevant_products(image_uri, image_src, batcher=SEARCH_BATCHER)
+    except QueueFull:
+        return None, "Too many searches at the moment, please try again."
     except Exception:
         return None, "Nothing found :/"
 
@@ -32,5 +54,7 @@ if __name__ == "__main__":
         fn=match_image,
         inputs=[gr.Textbox(label="Input Image URI"), gr.Image(label="Input Image", type="pil")],
         outputs=[gr.Image(label="Annotated Image"), gr.Markdown(label="Relevant Products")],
+        concurrency_limit=UI_CONCURRENCY,
     )
+    ui.queue(max_size=UI_QUEUE_SIZE)
     ui.launch()
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from distutils.util import strtobool
+
+import grpc
+import httpx
+import PIL
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from google.api_core import exceptions
+from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcAsyncIOTransport
+
+load_dotenv()
+
+from utils.google_cloud import GCP_SA_JSON, async_get_similar_products, grpc_channel_options  # noqa: E402
+from utils.image import encode_query_image, exif_upright, open_image  # noqa: E402
+from utils.metrics import Metrics  # noqa: E402
+from utils.transfer import FileTooBig, capped_chunks  # noqa: E402
+
+logging.basicConfig(level=logging.INFO, format="%(name)s - %(asctime)s %(levelname)s:%(message)s")
+logger = logging.getLogger(__name__)
+
+
+PROJECT_ID = os.environ.get("PROJECT_ID")
+PROJECT_REGION = os.environ.get("PROJECT_REGION")
+PRODUCT_SET_ID = "bahag_products"
+PRODUCT_CATEGORY = "homegoods-v2"
+
+# the searches go round robin over SEARCH_CHANNELS gRPC channels (HTTP/2 connections) to VISION_API_ENDPOINT,
+# opened at the start and kept alive with a ping every GRPC_KEEPALIVE_MS of idleness (see utils.google_cloud);
+# VISION_API_INSECURE=True connects without TLS and credentials, to a local fake of the API
+VISION_API_ENDPOINT = os.environ.get("VISION_API_ENDPOINT", "vision.googleapis.com")
+VISION_API_INSECURE = bool(strtobool(os.environ.get("VISION_API_INSECURE", "False")))
+SEARCH_CHANNELS = int(os.environ.get("SEARCH_CHANNELS", 4))
+# seconds a search may take with its retries
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 10))
+
+# same meaning as in product_search_cli
+QUERY_IMAGE_MAX_SIDE = int(os.environ.get("QUERY_IMAGE_MAX_SIDE", 1024))
+QUERY_IMAGE_FORMAT = os.environ.get("QUERY_IMAGE_FORMAT", "JPEG")
+QUERY_IMAGE_QUALITY = int(os.environ.get("QUERY_IMAGE_QUALITY", 85))
+IMAGE_FETCH_CONNECT_TIMEOUT = float(os.environ.get("IMAGE_FETCH_CONNECT_TIMEOUT", 5))
+IMAGE_FETCH_READ_TIMEOUT = float(os.environ.get("IMAGE_FETCH_READ_TIMEOUT", 15))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", 30))
+IMAGE_FETCH_MAX_SIZE = int(os.environ.get("IMAGE_FETCH_MAX_SIZE", 32 * 1024**2))
+# threads decoding and encoding the query images, off the event loop
+PREPROCESS_THREADS = int(os.environ.get("PREPROCESS_THREADS", os.cpu_count() or 4))
+
+
+class ChannelPool:
+    """ImageAnnotator asyncio clients on their own gRPC channels, handed out round robin.
+
+    A channel is a single HTTP/2 connection, the concurrent searches are spread
+    over a few of them instead of queueing on the stream limit of one.
+
+    Args:
+        size: Number of channels.
+        endpoint: host[:port] of the Vision API.
+        insecure: Plain text channels without credentials, for a local fake of the API.
+    """
+
+    def __init__(self, size: int, endpoint: str, insecure: bool = False):
+        self.channels = [self._channel(endpoint, insecure) for _ in range(size)]
+        self.clients = [
+            vision.ImageAnnotatorAsyncClient(transport=ImageAnnotatorGrpcAsyncIOTransport(channel=channel))
+            for channel in self.channels
+        ]
+        self._next = itertools.cycle(self.clients)
+
+    @staticmethod
+    def _channel(endpoint: str, insecure: bool) -> grpc.aio.Channel:
+        if insecure:
+            return grpc.aio.insecure_channel(endpoint, options=grpc_channel_options())
+        return ImageAnnotatorGrpcAsyncIOTransport.create_channel(
+            host=endpoint, credentials_file=GCP_SA_JSON, options=grpc_channel_options()
+        )
+
+    async def warm_up(self, timeout: float = 10.0) -> None:
+        """Connects all the channels (TCP, TLS and HTTP/2 handshakes) before the first search."""
+        await asyncio.wait_for(asyncio.gather(*(channel.channel_ready() for channel in self.channels)), timeout)
+
+    def client(self) -> vision.ImageAnnotatorAsyncClient:
+        return next(self._next)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(channel.close() for channel in self.channels))
+        # grpc.aio objects left for the interpreter shutdown, with their event loop gone, fail to clean up
+        self.channels, self.clients, self._next = [], [], None
+
+
+def preprocess(image_bytes: bytes) -> bytes:
+    """Decode (a JPEG just large enough), rotate upright and encode the query image."""
+    pil_image = exif_upright(open_image(image_bytes, draft_size=QUERY_IMAGE_MAX_SIDE or None))
+    return encode_query_image(
+        pil_image, max_side=QUERY_IMAGE_MAX_SIDE, image_format=QUERY_IMAGE_FORMAT, quality=QUERY_IMAGE_QUALITY
+    )
+
+
+async def fetch(http: httpx.AsyncClient, url: str) -> bytes:
+    async with http.stream("GET", url) as response:
+        response.raise_for_status()
+        chunks = [chunk async for chunk in capped_chunks(response.aiter_bytes(), IMAGE_FETCH_MAX_SIZE)]
+    return b"".join(chunks)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.metrics = Metrics()
+    app.state.channels = ChannelPool(SEARCH_CHANNELS, VISION_API_ENDPOINT, insecure=VISION_API_INSECURE)
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(IMAGE_FETCH_READ_TIMEOUT, connect=IMAGE_FETCH_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        follow_redirects=True,
+    )
+    app.state.preprocess = ThreadPoolExecutor(max_workers=PREPROCESS_THREADS, thread_name_prefix="preprocess")
+    try:
+        await app.state.channels.warm_up()
+    except asyncio.TimeoutError:
+        logger.warning(f"Couldn't connect to {VISION_API_ENDPOINT} yet, the channels will keep trying")
+    logger.info(f"{SEARCH_CHANNELS} channels to {VISION_API_ENDPOINT} open")
+    yield
+    await app.state.http.aclose()
+    await app.state.channels.close()
+    app.state.preprocess.shutdown()
+
+
+app = FastAPI(title="Product search", lifespan=lifespan)
+
+
+@app.post("/search")
+async def search(request: Request, image: UploadFile = File(None), url: str = Form(None), max_results: int = 10):
+    """Products similar to the uploaded `image` or the one at `url`: {"bboxes": [...], "matches": {...}}."""
+    if bool(image) == bool(url):
+        raise HTTPException(status_code=422, detail="Either an image or a url is required")
+    state = request.app.state
+    with state.metrics.time("request"):
+        try:
+            with state.metrics.time("fetch"):
+                if url:
+                    image_bytes = await asyncio.wait_for(fetch(state.http, url), IMAGE_FETCH_TIMEOUT)
+                else:
+                    image_bytes = await image.read(IMAGE_FETCH_MAX_SIZE + 1)
+                    if len(image_bytes) > IMAGE_FETCH_MAX_SIZE:
+                        raise FileTooBig(f"Image is bigger than {IMAGE_FETCH_MAX_SIZE} bytes")
+            with state.metrics.time("preprocess"):
+                content = await asyncio.get_running_loop().run_in_executor(state.preprocess, preprocess, image_bytes)
+            with state.metrics.time("search"):
+                return await async_get_similar_products(
+                    annotation_client=state.channels.client(),
+                    project_id=PROJECT_ID,
+                    location=PROJECT_REGION,
+                    product_set_id=PRODUCT_SET_ID,
+                    product_category=PRODUCT_CATEGORY,
+                    image=content,
+                    max_results=max_results,
+                    timeout=SEARCH_TIMEOUT,
+                )
+        except FileTooBig as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            raise HTTPException(status_code=400, detail=f"Couldn't fetch {url}: {e!r}")
+        except PIL.UnidentifiedImageError:
+            raise HTTPException(status_code=415, detail="Not an image")
+        except exceptions.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        except exceptions.GoogleAPICallError as e:
+            logger.warning(f"Product search has failed: {e}")
+            raise HTTPException(status_code=502, detail=str(e))
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Latency histograms of the requests and their stages, in seconds."""
+    return {"time": time.time(), "latency": request.app.state.metrics.snapshot()}
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the product search over HTTP.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -1,17 +1,199 @@
+import asyncio
+import hashlib
+import json
 import logging
-from datetime import datetime
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
 from urllib.parse import urljoin
 
+import httpx
 from pyrfc6266 import requests_response_to_filename
 from requests import Session, adapters
 from requests.auth import HTTPBasicAuth
 
+from utils.cache import MISS, TwoTierCache
+from utils.concurrency import THROTTLING_STATUS_CODES, AdaptiveLimiter, AsyncAdaptiveLimiter, Slot, unlimited
+from utils.metrics import Metrics
 
-class BahagAssetsAPI:
-    def __init__(self, user: str, password: str, base_url: str):
+TOKEN_CACHE_DIR = Path(os.environ.get("ASSETS_TOKEN_CACHE_DIR", Path.home() / ".cache" / "bahag_assets_api"))
+
+_AUTH_DATA = {"grant_type": "client_credentials"}
+
+# yielded by stream_asset_file if the file matches the given validators
+NOT_MODIFIED = "not modified"
+
+# the throttled and transient server errors, retried with backoff in the limiter slot
+_RETRIABLE_STATUS_CODES = (429, 500, 502, 503)
+
+
+class AssetsUnavailable(Exception):
+    """No definitive answer of the assets API or CDN, e.g. it kept throttling until the retries ran out."""
+
+
+def conditional_headers(validators: dict = None) -> dict:
+    """If-None-Match/If-Modified-Since headers from the etag/last_modified of a previous response."""
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(headers) -> dict:
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+
+class TokenManager:
+    """Keeps a valid access token for all the threads of a process.
+
+    Only one refresh runs at a time, the callers needing a new token meanwhile
+    wait for its result. Once started, a background thread renews the token
+    `refresh_margin` seconds before it expires, and a still valid token is
+    reused from the `cache_file` so short runs don't need an auth round-trip.
+
+    Args:
+        fetch: Callable returning the auth endpoint json response.
+        cache_file: Where to keep the token between the runs, None to disable.
+        refresh_margin: Seconds before the expiry to renew the token at.
+    """
+
+    def __init__(self, fetch: Callable[[], dict], cache_file: Path = None, refresh_margin: float = 60.0):
+        self.fetch = fetch
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
         self.access_token = None
-        self.token_issued_at = datetime.fromtimestamp(0)
-        self.token_expires_in = 0
+        self.expires_at = 0.0
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    @property
+    def lifetime(self) -> float:
+        return self.expires_at - time.time()
+
+    def start(self) -> None:
+        if not self._load():
+            self.refresh()
+        if not self._refresher:
+            self._stop.clear()
+            self._refresher = threading.Thread(target=self._refresh_ahead, name="token-refresh", daemon=True)
+            self._refresher.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._refresher:
+            self._refresher.join()
+            self._refresher = None
+
+    def get(self, min_lifetime: float = 5.0) -> str:
+        token = self.access_token
+        if token and self.lifetime >= min_lifetime:
+            return token
+        return self.refresh(stale_token=token)
+
+    def refresh(self, stale_token: str = None) -> str:
+        """Get a new token, unless another caller has replaced the stale one meanwhile."""
+        with self._lock:
+            if self.access_token and self.access_token != stale_token and self.lifetime >= 5:
+                return self.access_token
+
+            r_json = self.fetch()
+            access_token = r_json.get("access_token")
+            if not access_token:
+                raise Exception("Unable to get auth token, check the credentials.")
+
+            # the expiry is counted from the local receipt time, so the clock skew
+            # to the auth server doesn't matter
+            self.expires_at = time.time() + int(r_json["expires_in"])
+            self.access_token = access_token
+            self._save()
+            return access_token
+
+    def _refresh_ahead(self) -> None:
+        retry_in = 1.0
+        # tokens living shorter than the margin are renewed at the half of their lifetime
+        while not self._stop.wait(max(self.lifetime - self.refresh_margin, self.lifetime / 2, 1.0)):
+            try:
+                self.refresh(stale_token=self.access_token)
+                retry_in = 1.0
+            except Exception as e:
+                self.logger.warning(f"Token refresh failed, retrying in {retry_in}s: {e}")
+                if self._stop.wait(retry_in):
+                    break
+                retry_in = min(retry_in * 2, 60.0)
+
+    def _load(self) -> bool:
+        if not self.cache_file or not self.cache_file.exists():
+            return False
+        try:
+            cached = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return False
+        if cached.get("expires_at", 0) - time.time() < self.refresh_margin:
+            return False
+        self.access_token, self.expires_at = cached["access_token"], cached["expires_at"]
+        self.logger.info(f"Reusing the cached auth token from {self.cache_file}")
+        return True
+
+    def _save(self) -> None:
+        if not self.cache_file:
+            return
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix(".tmp")
+            # the token is a secret, keep it readable for the owner only
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"access_token": self.access_token, "expires_at": self.expires_at}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            self.logger.warning(f"Can't cache the auth token in {self.cache_file}: {e}")
+
+
+def metadata_cache_key(bahag_id: str, country_code: str, language_id: str) -> str:
+    return f"{country_code}/{language_id}/{bahag_id}"
+
+
+def token_cache_file(auth_url: str, user: str) -> Path:
+    key = hashlib.sha256(f"{auth_url}|{user}".encode()).hexdigest()[:16]
+    return TOKEN_CACHE_DIR / f"token_{key}.json"
+
+
+class BahagAssetsAPI:
+    """Client of the assets masterdata API and its CDN.
+
+    Args:
+        max_retries: Retries of a request answered with a retriable status code.
+        retry_delay: Upper bound of the first random backoff delay in seconds, doubled by every retry up to a minute.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        base_url: str,
+        cache_token: bool = True,
+        metadata_cache: TwoTierCache = None,
+        metadata_limiter: AdaptiveLimiter = None,
+        download_limiter: AdaptiveLimiter = None,
+        metrics: Metrics = None,
+        max_retries: int = 6,
+        retry_delay: float = 1.0,
+    ):
+        self.metadata_cache = metadata_cache
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.metrics = metrics or Metrics()
+        self.metadata_limiter = metadata_limiter or unlimited("metadata")
+        self.download_limiter = download_limiter or unlimited("download")
         self.auth = HTTPBasicAuth(user, password)
         self.session = Session()
         self.auth_url = urljoin(base_url, "/oauth2/accesstoken")
@@ -20,33 +202,70 @@ class BahagAssetsAPI:
         self.adapter = adapters.HTTPAdapter(pool_connections=64, pool_maxsize=128)
         self.session.mount("http://", self.adapter)
         self.session.mount("https://", self.adapter)
+        self.tokens = TokenManager(
+            fetch=self._fetch_token, cache_file=cache_token and token_cache_file(self.auth_url, user) or None
+        )
 
     def __enter__(self):
         self.auth_session()
         return self
 
     def __exit__(self, type, value, traceback):
+        self.tokens.close()
         self.session.close()
 
-    # noinspection PyDefaultArgument
-    def auth_session(self, data: dict = {"grant_type": "client_credentials"}):
+    def _fetch_token(self) -> dict:
+        r = self.session.post(url=self.auth_url, auth=self.auth, data=_AUTH_DATA)
+        if r.ok:
+            self.logger.info(f"Authenticated to {self.auth_url} successfully")
+        return r.json()
+
+    def auth_session(self):
         """Open a session"""
-        r = self.session.post(url=self.auth_url, auth=self.auth, data=data)
-        r_json = r.json()
-        self.access_token = r_json.get("access_token")
-        if not self.access_token:
-            raise Exception("Unable to get auth token, check the credentials.")
+        self.tokens.start()
 
-        self.logger.info(f"Authenticated to {self.auth_url} successfully")
-        self.token_issued_at = datetime.fromtimestamp(int(r_json["issued_at"]) / 1e3)
-        self.token_expires_in = int(r_json["expires_in"])
-        self.session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+    @property
+    def access_token(self):
+        return self.tokens.access_token
 
     @property
     def token_lifetime(self):
-        return self.token_expires_in - (datetime.now() - self.token_issued_at).seconds
+        return self.tokens.lifetime
+
+    def _get(self, url: str, headers: dict = None, **kwargs):
+        # the token goes with every request instead of the shared session headers,
+        # on 401 it's refreshed once (by one thread only) and the request is repeated
+        token = self.tokens.get()
+        r = self.session.get(url=url, headers={**(headers or {}), "Authorization": f"Bearer {token}"}, **kwargs)
+        if r.status_code == 401:
+            r.close()
+            token = self.tokens.refresh(stale_token=token)
+            r = self.session.get(url=url, headers={**(headers or {}), "Authorization": f"Bearer {token}"}, **kwargs)
+        return r
+
+    def _get_retried(self, slot: Slot, name: str, url: str, headers: dict = None, **kwargs):
+        """_get retrying the retriable status codes with capped exponential backoff, the limiter slot
+        is held meanwhile and throttled by 429/503. Returns the last response once the retries run out.
+        """
+        delay = self.retry_delay
+        for retry in range(self.max_retries + 1):
+            r = self._get(url=url, headers=headers, **kwargs)
+            if r.status_code in THROTTLING_STATUS_CODES:
+                slot.throttle()
+            if r.status_code not in _RETRIABLE_STATUS_CODES or retry == self.max_retries:
+                return r
+            r.close()
+            self.metrics.count(f"{name}.retries")
+            # exponential backoff with jitter, like the default api_core Retry
+            time.sleep(random.uniform(0.0, delay))
+            delay = min(delay * 2, 60.0)
 
     def get_assets_data(self, bahag_id: str, country_code: str = "de", language_id: str = "de-DE"):
+        """The assets masterdata of the product, None if it has none (404).
+
+        Raises:
+          AssetsUnavailable: if the API has answered with another error, after the retries of the retriable ones.
+        """
         try:
             if not self.access_token:
                 raise Exception(
@@ -55,24 +274,275 @@ class BahagAssetsAPI:
                     "call 'self.auth_session()' explicitly"
                 )
 
-            if not self.token_lifetime >= 5:
-                self.auth_session()
+            cache_key = metadata_cache_key(bahag_id, country_code, language_id)
+            if self.metadata_cache and (api_data := self.metadata_cache.get(cache_key)) is not MISS:
+                self.metrics.count("metadata.cache_hits")
+                return api_data
+
             q_url = urljoin(
                 self.api_url, f"2/{country_code}/assets/articlenumbers/{bahag_id}?language_id={language_id}"
             )
-            r = self.session.get(url=q_url)
+            with self.metadata_limiter.slot() as slot, self.metrics.time("metadata"):
+                r = self._get_retried(slot, "metadata", url=q_url)
+            self.metrics.count("metadata.requests")
             if r.ok:
-                return r.json()
-            self.logger.warning(f"Can't get API data, id={bahag_id}, status: {r.status_code}")
+                api_data = r.json()
+                if self.metadata_cache:
+                    self.metadata_cache.set(cache_key, api_data)
+                return api_data
+            self.metrics.count("metadata.failed")
+            # no assets for the id, cached as a negative entry
+            if r.status_code == 404:
+                if self.metadata_cache:
+                    self.metadata_cache.set(cache_key, None)
+                self.logger.warning(f"Can't get API data, id={bahag_id}, status: {r.status_code}")
+                return
+            if r.status_code in _RETRIABLE_STATUS_CODES:
+                self.metrics.count("metadata.gave_up")
+                self.logger.error(
+                    f"Can't get API data, id={bahag_id}, status: {r.status_code} after {self.max_retries} retries"
+                )
+            else:
+                self.logger.warning(f"Can't get API data, id={bahag_id}, status: {r.status_code}")
+            raise AssetsUnavailable(f"No API data for id={bahag_id}, status: {r.status_code}")
+        except AssetsUnavailable:
+            raise
+        except Exception as e:
+            self.logger.exception(e)
+            raise e
+
+    @contextmanager
+    def stream_asset_file(self, url: str, validators: dict = None):
+        """Yields (filename, filesize, raw body stream, validators) before the body is read,
+        filesize is 0 if the server doesn't send Content-Length. Yields None if the file isn't available,
+        raises AssetsUnavailable if it's still throttled or failing after the retries.
+
+        With the etag/last_modified validators of a previous download the request is conditional,
+        NOT_MODIFIED is yielded if the file hasn't changed since.
+        The download limiter slot is held until the body is consumed.
+        The "download" latency is the one of the response headers (retries included), the body is read by the caller.
+        """
+        with self.download_limiter.slot() as slot:
+            start = time.perf_counter()
+            with self._get_retried(
+                slot, "download", url=url, headers=conditional_headers(validators), stream=True
+            ) as r:
+                self.metrics.observe("download", time.perf_counter() - start)
+                filesize = r.headers.get("Content-length")
+                if r.status_code == 304:
+                    self.metrics.count("download.not_modified")
+                    yield NOT_MODIFIED
+                elif r.ok and filesize != "0":
+                    r.raw.decode_content = True
+                    try:
+                        yield (
+                            requests_response_to_filename(r),
+                            filesize and int(filesize) or 0,
+                            r.raw,
+                            response_validators(r.headers),
+                        )
+                    finally:
+                        self.metrics.count("download.files")
+                        # the bytes received, as sent (compressed)
+                        self.metrics.count("download.bytes", r.raw.tell())
+                elif r.status_code in _RETRIABLE_STATUS_CODES:
+                    self.metrics.count("download.gave_up")
+                    self.logger.error(
+                        f"Can't get remote file because of {r.status_code} after {self.max_retries} retries"
+                    )
+                    raise AssetsUnavailable(f"Can't get {url}, status: {r.status_code}")
+                else:
+                    self.logger.warning(f"Can't get remote file because of {r.status_code}")
+                    yield
+
+
+class AsyncBahagAssetsAPI:
+    """asyncio counterpart of BahagAssetsAPI built on httpx.
+
+    Args:
+        max_connections: Upper limit of the concurrently open connections.
+        max_retries, retry_delay: see BahagAssetsAPI.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        base_url: str,
+        max_connections: int = 1000,
+        cache_token: bool = True,
+        metadata_cache: TwoTierCache = None,
+        metadata_limiter: AsyncAdaptiveLimiter = None,
+        download_limiter: AsyncAdaptiveLimiter = None,
+        metrics: Metrics = None,
+        max_retries: int = 6,
+        retry_delay: float = 1.0,
+    ):
+        self.metadata_cache = metadata_cache
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.metrics = metrics or Metrics()
+        self.metadata_limiter = metadata_limiter or unlimited("metadata", AsyncAdaptiveLimiter)
+        self.download_limiter = download_limiter or unlimited("download", AsyncAdaptiveLimiter)
+        self.auth = (user, password)
+        self.auth_url = urljoin(base_url, "/oauth2/accesstoken")
+        self.api_url = urljoin(base_url, "/v1/assets-masterdata/")
+        self.logger = logging.getLogger(__name__)
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.tokens = TokenManager(
+            fetch=self._fetch_token, cache_file=cache_token and token_cache_file(self.auth_url, user) or None
+        )
+
+    async def __aenter__(self):
+        await self.auth_session()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await asyncio.to_thread(self.tokens.close)
+        await self.client.aclose()
+
+    def _fetch_token(self) -> dict:
+        # runs in the token manager threads, not in the event loop
+        r = httpx.post(self.auth_url, auth=self.auth, data=_AUTH_DATA)
+        if not r.is_error:
+            self.logger.info(f"Authenticated to {self.auth_url} successfully")
+        return r.json()
+
+    async def auth_session(self):
+        """Open a session"""
+        await asyncio.to_thread(self.tokens.start)
+
+    @property
+    def access_token(self):
+        return self.tokens.access_token
+
+    @property
+    def token_lifetime(self):
+        return self.tokens.lifetime
+
+    async def _token(self, stale_token: str = None) -> str:
+        # the background refresh keeps the token valid, the blocking fallback rarely runs
+        if stale_token is None and self.tokens.access_token and self.tokens.lifetime >= 5:
+            return self.tokens.access_token
+        return await asyncio.to_thread(self.tokens.refresh, stale_token or self.tokens.access_token)
+
+    @asynccontextmanager
+    async def _stream(self, url: str, headers: dict = None):
+        token = await self._token()
+        headers = {**(headers or {}), "Authorization": f"Bearer {token}"}
+        async with self.client.stream("GET", url=url, headers=headers) as r:
+            if r.status_code != 401:
+                yield r
+                return
+        token = await self._token(stale_token=token)
+        headers["Authorization"] = f"Bearer {token}"
+        async with self.client.stream("GET", url=url, headers=headers) as r:
+            yield r
+
+    @asynccontextmanager
+    async def _stream_retried(self, slot: Slot, name: str, url: str, headers: dict = None):
+        """Same as BahagAssetsAPI._get_retried, the response body is streamed."""
+        delay = self.retry_delay
+        for retry in range(self.max_retries + 1):
+            async with self._stream(url=url, headers=headers) as r:
+                if r.status_code in THROTTLING_STATUS_CODES:
+                    slot.throttle()
+                if r.status_code not in _RETRIABLE_STATUS_CODES or retry == self.max_retries:
+                    yield r
+                    return
+            self.metrics.count(f"{name}.retries")
+            await asyncio.sleep(random.uniform(0.0, delay))
+            delay = min(delay * 2, 60.0)
+
+    async def _get(self, slot: Slot, name: str, url: str) -> httpx.Response:
+        async with self._stream_retried(slot, name, url=url) as r:
+            await r.aread()
+            return r
+
+    async def get_assets_data(self, bahag_id: str, country_code: str = "de", language_id: str = "de-DE"):
+        """Same as BahagAssetsAPI.get_assets_data."""
+        try:
+            if not self.access_token:
+                raise Exception(
+                    "Client instance is not authenticated. "
+                    "Use context manager 'async with' statement or "
+                    "call 'await self.auth_session()' explicitly"
+                )
+
+            cache_key = metadata_cache_key(bahag_id, country_code, language_id)
+            if self.metadata_cache and (api_data := self.metadata_cache.get(cache_key)) is not MISS:
+                self.metrics.count("metadata.cache_hits")
+                return api_data
+
+            q_url = urljoin(
+                self.api_url, f"2/{country_code}/assets/articlenumbers/{bahag_id}?language_id={language_id}"
+            )
+            async with self.metadata_limiter.slot() as slot:
+                with self.metrics.time("metadata"):
+                    r = await self._get(slot, "metadata", url=q_url)
+            self.metrics.count("metadata.requests")
+            if not r.is_error:
+                api_data = r.json()
+                if self.metadata_cache:
+                    self.metadata_cache.set(cache_key, api_data)
+                return api_data
+            self.metrics.count("metadata.failed")
+            # no assets for the id, cached as a negative entry
+            if r.status_code == 404:
+                if self.metadata_cache:
+                    self.metadata_cache.set(cache_key, None)
+                self.logger.warning(f"Can't get API data, id={bahag_id}, status: {r.status_code}")
+                return
+            if r.status_code in _RETRIABLE_STATUS_CODES:
+                self.metrics.count("metadata.gave_up")
+                self.logger.error(
+                    f"Can't get API data, id={bahag_id}, status: {r.status_code} after {self.max_retries} retries"
+                )
+            else:
+                self.logger.warning(f"Can't get API data, id={bahag_id}, status: {r.status_code}")
+            raise AssetsUnavailable(f"No API data for id={bahag_id}, status: {r.status_code}")
+        except AssetsUnavailable:
+            raise
         except Exception as e:
             self.logger.exception(e)
             raise e
 
-    def get_asset_file(self, url: str):
-        r = self.session.get(url=url, stream=True)
-        filename = requests_response_to_filename(r)
-        filesize = r.headers.get("Content-length")
-        if r.ok and r.content:
-            filesize = filesize and int(filesize) or 0
-            return (filename, filesize, r.content)
-        self.logger.warning(f"Can't get remote file because of {r.status_code}")
+    @asynccontextmanager
+    async def stream_asset_file(self, url: str, chunk_size: int = 1024 * 1024, validators: dict = None):
+        """Yields (filename, filesize, async iterator of body chunks, validators) before the body is read,
+        same as BahagAssetsAPI.stream_asset_file.
+        """
+        async with self.download_limiter.slot() as slot:
+            start = time.perf_counter()
+            async with self._stream_retried(slot, "download", url=url, headers=conditional_headers(validators)) as r:
+                self.metrics.observe("download", time.perf_counter() - start)
+                filesize = r.headers.get("Content-length")
+                if r.status_code == 304:
+                    self.metrics.count("download.not_modified")
+                    yield NOT_MODIFIED
+                elif not r.is_error and filesize != "0":
+                    # pyrfc6266 expects a requests-like response with a plain string url
+                    filename = requests_response_to_filename(SimpleNamespace(headers=r.headers, url=str(r.url)))
+                    try:
+                        yield (
+                            filename,
+                            filesize and int(filesize) or 0,
+                            r.aiter_bytes(chunk_size),
+                            response_validators(r.headers),
+                        )
+                    finally:
+                        self.metrics.count("download.files")
+                        self.metrics.count("download.bytes", r.num_bytes_downloaded)
+                elif r.status_code in _RETRIABLE_STATUS_CODES:
+                    self.metrics.count("download.gave_up")
+                    self.logger.error(
+                        f"Can't get remote file because of {r.status_code} after {self.max_retries} retries"
+                    )
+                    raise AssetsUnavailable(f"Can't get {url}, status: {r.status_code}")
+                else:
+                    self.logger.warning(f"Can't get remote file because of {r.status_code}")
+                    yield
@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class MicroBatcher:
+    """Collects the items submitted by concurrent callers into batches for a single call of `fn`.
+
+    A batch is sent as soon as a worker is free, with all the items queued by then (up to
+    `max_batch_size`), so a lone caller waits for no one and the batches grow with the load,
+    while the workers are busy. `max_wait` > 0 holds every batch open that long for more items.
+    Every caller gets the result of its own item from the list `fn` returns for the batch,
+    an exception of `fn` goes to all the callers of the batch.
+
+    Args:
+        fn: Processes a list of items, returns the list of their results in the same order.
+        max_batch_size: Largest batch.
+        max_wait: Seconds a batch waits for more items after its first one.
+        max_queue: Items waiting for a batch, once reached `submit` raises QueueFull.
+        workers: Batches processed concurrently.
+        name: Name of the worker threads and used in the logs.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List], List],
+        max_batch_size: int = 16,
+        max_wait: float = 0.0,
+        max_queue: int = 64,
+        workers: int = 4,
+        name: str = "batcher",
+    ):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self.stats = {"items": 0, "batches": 0}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._free_workers = threading.Semaphore(workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._dispatcher = threading.Thread(target=self._dispatch, name=f"{name}-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Processes the items queued so far and stops."""
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future))
+        except queue.Full:
+            raise QueueFull(f"{self.name} has {self._queue.maxsize} items queued already")
+        return future
+
+    def __call__(self, item):
+        """Result of the item, blocks until its batch is processed."""
+        return self.submit(item).result()
+
+    def _dispatch(self) -> None:
+        closed = False
+        while not closed:
+            first = self._queue.get()
+            if first is None:
+                break
+            self._free_workers.acquire()
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    pending = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    closed = True
+                    break
+                batch.append(pending)
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch: list) -> None:
+        futures = [future for _, future in batch]
+        try:
+            results = self.fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"{self.name} got {len(results)} results of {len(batch)} items")
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            logger.warning(f"Batch of {len(batch)} items has failed: {e}")
+            for future in futures:
+                future.set_exception(e)
+        finally:
+            self._free_workers.release()
+            with self._lock:
+                self.stats["items"] += len(batch)
+                self.stats["batches"] += 1
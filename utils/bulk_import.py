@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict
+
+from google.api_core import exceptions
+from google.api_core.operation import Operation
+from google.cloud import vision
+
+from utils.google_cloud import RETRY_POLICY, attach_bulk_import, log_bulk_import_result, submit_bulk_import
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class BulkImportScheduler:
+    """Runs up to `max_running` Vision bulk import operations at once and polls them without blocking.
+
+    The operation names are persisted in `state_file` after every change, so a run interrupted
+    meanwhile reattaches to the operations still running instead of importing the files again.
+    A file is identified by its URI and `version` (e.g. a content hash), a new version is imported anew.
+
+    Args:
+        client: Vision product search client.
+        project_id: Id of the project.
+        location: A compute region name.
+        state_file: JSON file keeping the operations between the runs.
+        max_running: Upper limit of the concurrently running operations, lowered while the quota is exhausted.
+        poll_interval: Seconds between the operation status checks.
+        submit_interval: Seconds between two submissions.
+        checkpoint: Called with the state file after the steps changing it, e.g. to upload it.
+    """
+
+    def __init__(
+        self,
+        client: vision.ProductSearchClient,
+        project_id: str,
+        location: str,
+        state_file: Path,
+        max_running: int = 4,
+        poll_interval: float = 30.0,
+        submit_interval: float = 10.0,
+        checkpoint: Callable[[Path], None] = None,
+    ):
+        self.client = client
+        self.project_id = project_id
+        self.location = location
+        self.state_file = state_file
+        self.max_running = self._max_running = max_running
+        self.poll_interval = poll_interval
+        self.submit_interval = submit_interval
+        self.checkpoint = checkpoint
+        # the operations still running are polled, the finished ones only skip the same files added again
+        self._previous = self._load()
+        self.imports = {csv_uri: entry for csv_uri, entry in self._previous.items() if entry["status"] == RUNNING}
+        self._queue = deque()
+        self._operations: Dict[str, Operation] = {}
+        self._last_submit = 0.0
+        self._started_at = time.monotonic()
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def add(self, csv_uri: str, version: str = None) -> None:
+        """Schedule a file for importing, unless the same version is running or done already."""
+        with self._lock:
+            known = self.imports.get(csv_uri) or self._previous.get(csv_uri)
+            if known and known["version"] == version and known["status"] in (RUNNING, DONE):
+                logger.info(f"{csv_uri} is {known['status']} already ({known['operation']})")
+                self.imports[csv_uri] = known
+                self._save()
+                return
+            self.imports[csv_uri] = {
+                "version": version,
+                "status": QUEUED,
+                "operation": None,
+                "indexed": 0,
+                "failed": 0,
+            }
+            self._queue.append(csv_uri)
+            self._save()
+
+    def pending(self) -> bool:
+        return any(entry["status"] in (QUEUED, RUNNING) for entry in self.imports.values())
+
+    def step(self) -> None:
+        """Check the running operations once and submit the queued files there's room for."""
+        for csv_uri, entry in list(self.imports.items()):
+            if entry["status"] == RUNNING:
+                self._poll(csv_uri, entry)
+
+        while self._queue and self._running() < self.max_running:
+            wait = self._last_submit + self.submit_interval - time.monotonic()
+            if wait > 0:
+                break
+            if not self._submit(self._queue[0]):
+                break
+            self._queue.popleft()
+
+    def tick(self) -> None:
+        """Step, log the progress and checkpoint the state if it has changed."""
+        self.step()
+        logger.info(self.report())
+        if self.checkpoint and self._changed:
+            self._changed = False
+            self.checkpoint(self.state_file)
+
+    def run(self) -> Dict[str, int]:
+        """Tick until all the added files are imported, returns the progress counts."""
+        while True:
+            self.tick()
+            if not self.pending():
+                break
+            time.sleep(self.poll_interval)
+        return self.progress()
+
+    def _running(self) -> int:
+        return sum(entry["status"] == RUNNING for entry in self.imports.values())
+
+    def _submit(self, csv_uri: str) -> bool:
+        try:
+            op = submit_bulk_import(self.client, self.project_id, self.location, csv_uri)
+        except exceptions.ResourceExhausted as e:
+            # RETRY_POLICY gave up, fewer operations at once and the next try after a poll
+            self.max_running = max(self._running(), 1)
+            self._last_submit = time.monotonic() + self.poll_interval
+            logger.warning(f"Quota exhausted submitting {csv_uri}, max {self.max_running} running imports now: {e}")
+            return False
+        self._last_submit = time.monotonic()
+        with self._lock:
+            self.imports[csv_uri].update(status=RUNNING, operation=op.operation.name)
+            self._operations[csv_uri] = op
+            self._save()
+        return True
+
+    def _poll(self, csv_uri: str, entry: dict) -> None:
+        op = self._operations.get(csv_uri)
+        try:
+            if op is None:
+                op = self._operations[csv_uri] = attach_bulk_import(self.client, entry["operation"])
+                logger.info(f"Reattached to {entry['operation']} importing {csv_uri}")
+            if not op.done(retry=RETRY_POLICY):
+                return
+            exception = op.exception()
+        except exceptions.NotFound as e:
+            # the operation has expired, the file has to be imported again
+            logger.warning(f"Operation {entry['operation']} of {csv_uri} is gone, importing it again: {e}")
+            with self._lock:
+                entry.update(status=QUEUED, operation=None)
+                self._operations.pop(csv_uri, None)
+                self._queue.append(csv_uri)
+                self._save()
+            return
+
+        with self._lock:
+            if exception:
+                logger.error(f"Import of {csv_uri} has failed: {exception}")
+                entry["status"] = FAILED
+            else:
+                entry["indexed"], entry["failed"] = log_bulk_import_result(op.result(), csv_uri)
+                entry["status"] = DONE
+                # a finished import frees some quota
+                self.max_running = min(self.max_running + 1, self._max_running)
+            self._operations.pop(csv_uri, None)
+            self._save()
+
+    def progress(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, "indexed": 0, "not_indexed": 0}
+        for entry in self.imports.values():
+            counts[entry["status"]] += 1
+            counts["indexed"] += entry["indexed"]
+            counts["not_indexed"] += entry["failed"]
+        return counts
+
+    def report(self) -> str:
+        counts = self.progress()
+        elapsed = time.monotonic() - self._started_at
+        return (
+            f"Bulk imports: {counts[DONE]}/{len(self.imports)} done, {counts[RUNNING]} running "
+            f"(max {self.max_running}), {counts[QUEUED]} queued, {counts[FAILED]} failed; "
+            f"{counts['indexed']} images indexed, {counts['not_indexed']} not; {elapsed / 60:.1f} min elapsed"
+        )
+
+    def _load(self) -> Dict[str, dict]:
+        if not self.state_file.exists():
+            return {}
+        try:
+            imports = json.loads(self.state_file.read_text())
+        except ValueError as e:
+            logger.warning(f"Ignoring the unreadable bulk import state {self.state_file}: {e}")
+            return {}
+        # the queued and failed files of the previous run are imported again if added again
+        return {csv_uri: entry for csv_uri, entry in imports.items() if entry["status"] in (RUNNING, DONE)}
+
+    def _save(self) -> None:
+        tmp_file = self.state_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(self.imports, indent=2))
+        os.replace(tmp_file, self.state_file)
+        self._changed = True
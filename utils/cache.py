@@ -0,0 +1,155 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from cachetools import TLRUCache
+
+logger = logging.getLogger(__name__)
+
+# returned by the caches for the keys they don't have, None is a valid (negative) value
+MISS = object()
+
+
+class DiskCache:
+    """SQLite key/value store with a TTL and size-based eviction of the oldest entries.
+
+    Args:
+        path: SQLite database file.
+        ttl: Seconds an entry is valid for.
+        max_size_b: Upper limit of the stored values size, the oldest entries
+            are dropped once it's exceeded.
+    """
+
+    def __init__(self, path: Path, ttl: float, max_size_b: int = 1024**3):
+        self.path = path
+        self.ttl = ttl
+        self.max_size_b = max_size_b
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # a cache can afford to lose the last commits on a power loss
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        self._conn.commit()
+        self.size_b = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def get(self, key: str):
+        entry = self.get_entry(key)
+        if entry is MISS:
+            return MISS
+        return entry[0]
+
+    def get_entry(self, key: str):
+        """(value, expires_at) of the key, MISS if it's missing or expired."""
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if not row or row[1] < time.time():
+            return MISS
+        return row[0], row[1]
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        size = value and len(value) or 0
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, size, time.time() + (ttl or self.ttl))
+            )
+            self.size_b += size - (old and old[0] or 0)
+            if self.size_b > self.max_size_b:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # expired entries first, then the ones expiring soonest (i.e. the oldest) down to 90% of the limit
+        self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        self.size_b = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        excess = self.size_b - int(self.max_size_b * 0.9)
+        if excess <= 0:
+            return
+        dropped, dropped_b = 0, 0
+        for key, size in self._conn.execute("SELECT key, size FROM cache ORDER BY expires_at").fetchall():
+            if dropped_b >= excess:
+                break
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            dropped, dropped_b = dropped + 1, dropped_b + size
+        self.size_b -= dropped_b
+        logger.info(f"Evicted {dropped} entries ({dropped_b} bytes) from {self.path}")
+
+
+class TwoTierCache:
+    """In-process LRU with a TTL on top of an optional DiskCache, for json serializable values.
+
+    Args:
+        maxsize: Max number of entries in memory.
+        ttl: Seconds an entry is valid for.
+        negative_ttl: Seconds a None (negative) entry is valid for, defaults to ttl.
+        disk: Second tier, shared between the runs.
+        read: If False, the cache is only written to (refreshed), never read from.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float = None, disk: DiskCache = None, read: bool = True):
+        # (value, expires_at) entries, an entry read from the disk expires when it does there
+        self.memory = TLRUCache(maxsize=maxsize, ttu=lambda key, entry, now: entry[1], timer=time.time)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl or ttl
+        self.disk = disk
+        self.read = read
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        if self.disk:
+            self.disk.close()
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key: str):
+        if not self.read:
+            return MISS
+
+        with self._lock:
+            entry = self.memory.get(key, MISS)
+        if entry is not MISS:
+            value = entry[0]
+            self._count("memory_hits")
+        elif self.disk and (entry := self.disk.get_entry(key)) is not MISS:
+            value = json.loads(entry[0])
+            self._remember(key, value, min(entry[1], time.time() + self.ttl))
+            self._count("disk_hits")
+        else:
+            self._count("misses")
+            return MISS
+
+        if value is None:
+            self._count("negative_hits")
+        return value
+
+    def _remember(self, key: str, value, expires_at: float) -> None:
+        # negative entries don't go to the memory tier if they'd outlive their ttl there
+        if value is not None or self.negative_ttl >= self.ttl:
+            with self._lock:
+                self.memory[key] = (value, expires_at)
+
+    def set(self, key: str, value) -> None:
+        self._remember(key, value, time.time() + self.ttl)
+        if self.disk:
+            self.disk.set(key, json.dumps(value).encode(), ttl=value is None and self.negative_ttl or self.ttl)
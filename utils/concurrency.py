@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable
+
+THROTTLING_STATUS_CODES = (429, 503)
+
+
+class Slot:
+    """Handle of a running call, used to report the call was throttled by the server."""
+
+    def __init__(self):
+        self.throttled = False
+
+    def throttle(self) -> None:
+        self.throttled = True
+
+
+class AdaptiveLimiter:
+    """AIMD limit of the concurrently running calls to a service.
+
+    The limit grows by one per `limit` calls completed without congestion (additive increase)
+    and is cut by `backoff` (multiplicative decrease) at most once per average call latency when:
+      - a call is throttled by the server (429/503, see Slot.throttle and throttle_current),
+      - an exception `is_throttling` escapes the call,
+      - the recent average latency exceeds `latency_tolerance` x the long-term one.
+
+    Args:
+        name: Name used in the reports.
+        initial: Starting limit.
+        min_limit: Lower bound of the limit.
+        max_limit: Upper bound of the limit, e.g. the number of worker threads.
+        backoff: Factor the limit is multiplied by on congestion.
+        latency_tolerance: Recent/long-term average latency ratio considered congestion, None to ignore
+            the latency, e.g. of the calls whose latency depends on the payload size.
+        is_throttling: Predicate for the exceptions meaning the server is throttling.
+        enabled: If False, the limit stays at max_limit and only the stats are collected.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        backoff: float = 0.75,
+        latency_tolerance: float = 2.5,
+        is_throttling: Callable[[BaseException], bool] = None,
+        enabled: bool = True,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(enabled and min(max(initial, min_limit), max_limit) or max_limit)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.is_throttling = is_throttling
+        self.enabled = enabled
+        self.in_flight = 0
+        self.completed = 0
+        self.throttled = 0
+        self.avg_latency = None
+        self.baseline_latency = None
+        self._last_decrease = 0.0
+        self._last_report = (time.monotonic(), 0)
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _record(self, latency: float, throttled: bool) -> None:
+        self.in_flight -= 1
+        self.completed += 1
+        self.throttled += throttled
+        # rejections are usually fast, they'd make the service look quicker than it is
+        if not throttled:
+            self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+            # the baseline follows the lasting changes of the service only
+            self.baseline_latency = (
+                latency if self.baseline_latency is None else 0.99 * self.baseline_latency + 0.01 * latency
+            )
+        if not self.enabled:
+            return
+
+        congested = throttled or bool(
+            self.latency_tolerance and self.avg_latency > self.latency_tolerance * self.baseline_latency
+        )
+        now = time.monotonic()
+        if not congested:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+        elif now - self._last_decrease > (self.avg_latency or 0):
+            # a burst of throttled calls from the same window counts once
+            self.limit = max(self.limit * self.backoff, self.min_limit)
+            self._last_decrease = now
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            self._cond.wait_for(self._has_room)
+            self.in_flight += 1
+        slot = self._local.slot = Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException as e:
+            if self.is_throttling and self.is_throttling(e):
+                slot.throttle()
+            raise
+        finally:
+            self._local.slot = None
+            with self._cond:
+                self._record(time.monotonic() - start, slot.throttled)
+                self._cond.notify_all()
+
+    def throttle_current(self) -> None:
+        """Mark the slot held by the calling thread as throttled, for the code without access to it."""
+        slot = getattr(self._local, "slot", None)
+        if slot:
+            slot.throttle()
+
+    def report(self) -> str:
+        now, completed = time.monotonic(), self.completed
+        last_time, last_completed = self._last_report
+        self._last_report = (now, completed)
+        rate = (completed - last_completed) / max(now - last_time, 1e-9)
+        return (
+            f"{self.name}: limit={int(self.limit)}, in flight={self.in_flight}, {rate:.1f} calls/s, "
+            f"avg latency={self.avg_latency or 0:.3f}s, throttled={self.throttled}"
+        )
+
+
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    """Same as AdaptiveLimiter, for the coroutines of a single event loop."""
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(self._has_room)
+            self.in_flight += 1
+        slot = Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException as e:
+            if self.is_throttling and self.is_throttling(e):
+                slot.throttle()
+            raise
+        finally:
+            async with self._cond:
+                self._record(time.monotonic() - start, slot.throttled)
+                self._cond.notify_all()
+
+
+def unlimited(name: str, limiter_class=AdaptiveLimiter) -> AdaptiveLimiter:
+    """A limiter that never blocks, for the clients created without one."""
+    return limiter_class(name, max_limit=2**31, enabled=False)
@@ -0,0 +1,64 @@
+import logging
+import threading
+from queue import Empty, Full, Queue
+from typing import Iterator, List
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+# yields the first column of an already executed cursor page by page,
+# while a background thread is fetching the next page(s) from the server.
+def iter_pages(cursor, batch_size: int, prefetch: int = 1) -> Iterator[List]:
+    """Stream a result set in pages of fixed size.
+
+    Args:
+        cursor: DB-API cursor with the query already executed.
+            A psycopg2 named (server-side) cursor keeps the per-page cost constant.
+        batch_size: Number of rows per page.
+        prefetch: Number of pages fetched ahead of the consumer.
+    """
+    pages = Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _fetch():
+        try:
+            while not stop.is_set():
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if not _put([row[0] for row in rows]):
+                    return
+            _put(_DONE)
+        except BaseException as e:
+            _put(e)
+
+    fetcher = threading.Thread(target=_fetch, name="db-page-prefetch", daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                break
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        # unblock the fetcher if it waits on a full queue
+        try:
+            while True:
+                pages.get_nowait()
+        except Empty:
+            pass
+        fetcher.join()
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from requests import Session, Timeout, adapters
+
+from utils.cache import MISS, DiskCache
+from utils.transfer import FileTooBig
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageFetcher:
+    """Downloads images over a shared pool of keep-alive connections.
+
+    Every download is bounded by the connect/read timeouts of a single socket operation
+    and by `total_timeout` overall (checked between the chunks), the body is streamed and dropped with FileTooBig
+    once it's bigger than `max_bytes`. The bodies are kept in the optional disk cache
+    by URL along with their ETag, a cached image with an ETag is revalidated with
+    If-None-Match (a 304 costs no transfer), one without is served until the cache TTL passes.
+
+    Args:
+        connect_timeout: Seconds to establish a connection.
+        read_timeout: Seconds to wait for every chunk of the response.
+        total_timeout: Seconds a whole download may take.
+        max_bytes: Largest image accepted.
+        cache: Downloaded images, bounded in size, shared between the runs.
+        pool_maxsize: Connections kept open per host.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+        total_timeout: float = 30.0,
+        max_bytes: int = 32 * 1024**2,
+        cache: DiskCache = None,
+        pool_maxsize: int = 32,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.session = Session()
+        self.adapter = adapters.HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.stats = {"downloads": 0, "revalidated": 0, "cache_hits": 0}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _cached(self, url: str):
+        raw = self.cache and self.cache.get(url) or MISS
+        if raw is MISS:
+            return None, None
+        etag, body = raw.split(b"\n", 1)
+        return etag.decode(), body
+
+    def fetch(self, url: str) -> bytes:
+        """The image file at the url, from the cache if it's still current."""
+        etag, body = self._cached(url)
+        if body is not None and not etag:
+            self._count("cache_hits")
+            return body
+
+        headers = etag and {"If-None-Match": etag} or {}
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304 and body is not None:
+                self._count("revalidated")
+                self.cache.set(url, f"{etag}\n".encode() + body)
+                return body
+            response.raise_for_status()
+            body = self._read(url, response)
+
+        self._count("downloads")
+        etag = response.headers.get("ETag", "")
+        # the ETag is stored on the first line, in front of the body
+        if self.cache and "\n" not in etag:
+            self.cache.set(url, f"{etag}\n".encode() + body)
+        return body
+
+    def _read(self, url: str, response) -> bytes:
+        if int(response.headers.get("Content-Length") or 0) > self.max_bytes:
+            raise FileTooBig(f"{url} is bigger than {self.max_bytes} bytes")
+        deadline = time.monotonic() + self.total_timeout
+        chunks, size = [], 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise FileTooBig(f"{url} is bigger than {self.max_bytes} bytes")
+            if time.monotonic() > deadline:
+                raise Timeout(f"{url} took longer than {self.total_timeout}s to download")
+            chunks.append(chunk)
+        return b"".join(chunks)
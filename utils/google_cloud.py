@@ -1,10 +1,30 @@
+import asyncio
+import functools
 import logging
 import os
-from typing import IO
+import random
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, AsyncIterator, Iterator, List, Optional, Tuple
 
+import google.auth
 from google.api_core import exceptions
-from google.api_core.retry import Retry
+from google.api_core.operation import Operation, from_gapic
+from google.api_core.retry import AsyncRetry, Retry
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.cloud import storage, vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+from google.cloud.vision_v1.services.product_search.transports import ProductSearchGrpcTransport
+from google.oauth2 import service_account
+from requests import adapters
+
+from utils.concurrency import AdaptiveLimiter, AsyncAdaptiveLimiter, Slot, unlimited
+from utils.metrics import Metrics
+
+if TYPE_CHECKING:
+    import httpx
 
 _RETRIABLE_TYPES = [
     exceptions.TooManyRequests,  # 429
@@ -15,40 +35,337 @@ _RETRIABLE_TYPES = [
 
 
 def is_retryable(exc):
-    return isinstance(exc, _RETRIABLE_TYPES)
+    return isinstance(exc, tuple(_RETRIABLE_TYPES))
 
 
 RETRY_POLICY = Retry(predicate=is_retryable)
+ASYNC_RETRY_POLICY = AsyncRetry(predicate=is_retryable)
+
+# same codes for the plain http calls
+_RETRIABLE_STATUS_CODES = (429, 500, 502, 503)
 
 
 GCP_SA_JSON = os.environ.get("GCP_SA_JSON")
 
-if GCP_SA_JSON:
-    GCS_CLIENT = storage.Client.from_service_account_json(GCP_SA_JSON)
-    VISION_CLIENT = vision.ProductSearchClient.from_service_account_json(GCP_SA_JSON)
-    ANNOTATION_CLIENT = vision.ImageAnnotatorClient.from_service_account_json(GCP_SA_JSON)
-else:
-    GCS_CLIENT = storage.Client()
-    VISION_CLIENT = vision.ProductSearchClient()
-    ANNOTATION_CLIENT = vision.ImageAnnotatorClient()
+# gRPC channel options of the Vision clients: a keepalive ping every GRPC_KEEPALIVE_MS
+# of idleness (0 turns them off) and the largest message sent or received
+GRPC_KEEPALIVE_MS = int(os.environ.get("GRPC_KEEPALIVE_MS", 30_000))
+GRPC_MAX_MESSAGE_SIZE = int(os.environ.get("GRPC_MAX_MESSAGE_SIZE", 64 * 1024**2))
 
 
 logger = logging.getLogger(__name__)
 
 
+def grpc_channel_options(keepalive_ms: int = GRPC_KEEPALIVE_MS, max_message_size: int = GRPC_MAX_MESSAGE_SIZE):
+    options = (
+        ("grpc.max_send_message_length", max_message_size),
+        ("grpc.max_receive_message_length", max_message_size),
+    )
+    if keepalive_ms:
+        options += (
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", 10_000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        )
+    return options
+
+
+# the clients are built on their first use and shared by the whole process,
+# a tool only pays for the credentials lookup and the channel of the ones it uses
+@functools.lru_cache(maxsize=None)
+def gcs_client() -> storage.Client:
+    return GCP_SA_JSON and storage.Client.from_service_account_json(GCP_SA_JSON) or storage.Client()
+
+
+@functools.lru_cache(maxsize=None)
+def vision_client(channel_options: tuple = None) -> vision.ProductSearchClient:
+    channel = ProductSearchGrpcTransport.create_channel(
+        host=f"{vision.ProductSearchClient.DEFAULT_ENDPOINT}:443",
+        credentials_file=GCP_SA_JSON,
+        options=list(channel_options or grpc_channel_options()),
+    )
+    return vision.ProductSearchClient(transport=ProductSearchGrpcTransport(channel=channel))
+
+
+@functools.lru_cache(maxsize=None)
+def annotation_client(channel_options: tuple = None) -> vision.ImageAnnotatorClient:
+    channel = ImageAnnotatorGrpcTransport.create_channel(
+        host=f"{vision.ImageAnnotatorClient.DEFAULT_ENDPOINT}:443",
+        credentials_file=GCP_SA_JSON,
+        options=list(channel_options or grpc_channel_options()),
+    )
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+
 def upload_to_storage(
     client: storage.Client,
     bucket_id: str,
     file: IO,
     remote_fname: str,
+    size: int = None,
+    chunk_size: int = None,
+    metrics: Metrics = None,
 ):
+    """Upload a file-like object, with chunk_size set (multiple of 256 KiB) the upload
+    is resumable and only reads chunk_size bytes of the file at a time.
+    """
     bucket = client.bucket(bucket_id)
-    blob = bucket.blob(remote_fname)
-    blob.upload_from_file(file, timeout=1800.0, retry=RETRY_POLICY)
+    blob = bucket.blob(remote_fname, chunk_size=chunk_size)
+    with metrics and metrics.time("upload") or nullcontext():
+        blob.upload_from_file(file, size=size, timeout=1800.0, retry=RETRY_POLICY)
+    if metrics:
+        metrics.count("upload.files")
+        metrics.count("upload.bytes", blob.size or 0)
     logger.info(f"Uploaded {remote_fname} to the storage bucket.")
     return f"gs://{bucket_id}/{remote_fname}"
 
 
+def download_from_storage(client: storage.Client, bucket_id: str, remote_fname: str, local_path: Path) -> bool:
+    """Download a file from the bucket, False if there's no such file."""
+    blob = client.bucket(bucket_id).blob(remote_fname)
+    try:
+        blob.download_to_filename(str(local_path), timeout=1800.0, retry=RETRY_POLICY)
+    except exceptions.NotFound:
+        logger.info(f"No {remote_fname} in the storage bucket.")
+        return False
+    logger.info(f"Downloaded {remote_fname} from the storage bucket.")
+    return True
+
+
+def get_storage_credentials():
+    scopes = ["https://www.googleapis.com/auth/devstorage.read_write"]
+    # like the storage client, no credentials for an emulator
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        return AnonymousCredentials()
+    if GCP_SA_JSON:
+        return service_account.Credentials.from_service_account_file(GCP_SA_JSON, scopes=scopes)
+    credentials, _ = google.auth.default(scopes=scopes)
+    return credentials
+
+
+class StorageUploader:
+    """Uploads files through the GCS JSON API from the calling thread, an upload holds a limiter slot.
+
+    Every request is retried by RETRY_POLICY, its retries throttle the slot of the upload (the on_error
+    of the Retry) and are counted as "upload.retries".
+
+    Args:
+        credentials: google.auth credentials, defaults to get_storage_credentials().
+        max_connections: Upper limit of the pooled connections, e.g. the number of uploading threads.
+        limiter: Adaptive limit of the concurrent uploads.
+        metrics: Where the upload latencies, counts and bytes are recorded.
+    """
+
+    def __init__(
+        self, credentials=None, max_connections: int = 64, limiter: AdaptiveLimiter = None, metrics: Metrics = None
+    ):
+        self.session = AuthorizedSession(credentials or get_storage_credentials())
+        adapter = adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.limiter = limiter or unlimited("upload")
+        self.metrics = metrics or Metrics()
+        self.base_url = os.environ.get("STORAGE_EMULATOR_HOST", "https://storage.googleapis.com")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.session.close()
+
+    def _retry(self, slot: Slot) -> Retry:
+        def _on_error(e):
+            slot.throttle()
+            self.metrics.count("upload.retries")
+
+        return Retry(predicate=is_retryable, on_error=_on_error)
+
+    def _send(self, retry: Retry, method: str, url: str, **kwargs):
+        def _request():
+            # a resumable upload answers 308 to every chunk but the last one, it isn't a redirect
+            r = self.session.request(method, url, allow_redirects=False, timeout=(10.0, 1800.0), **kwargs)
+            if r.status_code >= 400:
+                raise exceptions.from_http_response(r)
+            return r
+
+        return retry(_request)()
+
+    def upload(self, bucket_id: str, content: bytes, remote_fname: str) -> str:
+        with self.limiter.slot() as slot, self.metrics.time("upload"):
+            self._send(
+                self._retry(slot),
+                "POST",
+                f"{self.base_url}/upload/storage/v1/b/{bucket_id}/o",
+                params={"uploadType": "media", "name": remote_fname},
+                headers={"Content-Type": "application/octet-stream"},
+                data=content,
+            )
+        self.metrics.count("upload.files")
+        self.metrics.count("upload.bytes", len(content))
+        logger.info(f"Uploaded {remote_fname} to the storage bucket.")
+        return f"gs://{bucket_id}/{remote_fname}"
+
+    def upload_stream(self, bucket_id: str, chunks: Iterator[bytes], remote_fname: str, size: int = None) -> str:
+        """Resumable upload of the chunks as they come, same as AsyncStorageUploader.upload_stream."""
+        headers = {"X-Upload-Content-Type": "application/octet-stream"}
+        if size:
+            headers["X-Upload-Content-Length"] = str(size)
+        with self.limiter.slot() as slot, self.metrics.time("upload"):
+            retry = self._retry(slot)
+            r = self._send(
+                retry,
+                "POST",
+                f"{self.base_url}/upload/storage/v1/b/{bucket_id}/o",
+                params={"uploadType": "resumable", "name": remote_fname},
+                headers=headers,
+            )
+            session_url = r.headers["Location"]
+
+            offset = 0
+            chunks = iter(chunks)
+            chunk = next(chunks, b"")
+            while True:
+                # look ahead one chunk to know whether this one is the last
+                next_chunk = next(chunks, None)
+                end = offset + len(chunk)
+                total = "*" if next_chunk is not None else end
+                content_range = f"bytes {offset}-{end - 1}/{total}" if chunk else f"bytes */{total}"
+                r = self._send(retry, "PUT", session_url, data=chunk, headers={"Content-Range": content_range})
+                if next_chunk is None:
+                    break
+                if r.status_code != 308:
+                    raise ValueError(f"Unexpected status {r.status_code} of a resumable upload chunk to {remote_fname}")
+                offset, chunk = end, next_chunk
+        self.metrics.count("upload.files")
+        self.metrics.count("upload.bytes", end)
+        logger.info(f"Uploaded {remote_fname} to the storage bucket.")
+        return f"gs://{bucket_id}/{remote_fname}"
+
+
+class AsyncStorageUploader:
+    """Uploads files through the GCS JSON API without blocking the event loop.
+
+    Args:
+        credentials: google.auth credentials, defaults to get_storage_credentials().
+        max_connections: Upper limit of the concurrently open connections.
+        max_retries: Retries of an upload failing with a retriable status code.
+        limiter: Adaptive limit of the concurrent requests, throttled by the retriable status codes.
+        metrics: Where the upload latencies, counts and bytes are recorded.
+    """
+
+    def __init__(
+        self,
+        credentials=None,
+        max_connections: int = 1000,
+        max_retries: int = 6,
+        limiter: AsyncAdaptiveLimiter = None,
+        metrics: Metrics = None,
+    ):
+        # only the async uploads need httpx, a third of this module's import time
+        import httpx
+
+        self.credentials = credentials or get_storage_credentials()
+        self.limiter = limiter or unlimited("upload", AsyncAdaptiveLimiter)
+        self.metrics = metrics or Metrics()
+        self.base_url = os.environ.get("STORAGE_EMULATOR_HOST", "https://storage.googleapis.com")
+        self.max_retries = max_retries
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(1800.0, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._auth_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.client.aclose()
+
+    async def _auth_headers(self) -> dict:
+        if not self.credentials.valid:
+            async with self._auth_lock:
+                if not self.credentials.valid:
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def _send(self, method: str, url: str, headers: dict = None, **kwargs) -> "httpx.Response":
+        delay = 1.0
+        for _ in range(self.max_retries):
+            auth_headers = await self._auth_headers()
+            async with self.limiter.slot() as slot:
+                r = await self.client.request(method, url, headers={**auth_headers, **(headers or {})}, **kwargs)
+                if r.status_code in _RETRIABLE_STATUS_CODES:
+                    slot.throttle()
+            if r.status_code not in _RETRIABLE_STATUS_CODES:
+                break
+            # exponential backoff with jitter, like the default api_core Retry
+            await asyncio.sleep(random.uniform(0.0, delay))
+            delay = min(delay * 2, 60.0)
+        return r
+
+    async def upload(self, bucket_id: str, content: bytes, remote_fname: str) -> str:
+        with self.metrics.time("upload"):
+            r = await self._send(
+                "POST",
+                f"{self.base_url}/upload/storage/v1/b/{bucket_id}/o",
+                params={"uploadType": "media", "name": remote_fname},
+                headers={"Content-Type": "application/octet-stream"},
+                content=content,
+            )
+        r.raise_for_status()
+        self.metrics.count("upload.files")
+        self.metrics.count("upload.bytes", len(content))
+        logger.info(f"Uploaded {remote_fname} to the storage bucket.")
+        return f"gs://{bucket_id}/{remote_fname}"
+
+    async def upload_stream(
+        self, bucket_id: str, chunks: AsyncIterator[bytes], remote_fname: str, size: int = None
+    ) -> str:
+        """Resumable upload of the chunks as they come, every chunk but the last one
+        must be a multiple of 256 KiB. At most two chunks (the one being sent and the next one)
+        are held in memory at a time.
+        """
+        start = time.perf_counter()
+        headers = {"X-Upload-Content-Type": "application/octet-stream"}
+        if size:
+            headers["X-Upload-Content-Length"] = str(size)
+        r = await self._send(
+            "POST",
+            f"{self.base_url}/upload/storage/v1/b/{bucket_id}/o",
+            params={"uploadType": "resumable", "name": remote_fname},
+            headers=headers,
+        )
+        r.raise_for_status()
+        session_url = r.headers["Location"]
+
+        offset = 0
+        chunks = aiter(chunks)
+        chunk = await anext(chunks, b"")
+        while True:
+            # look ahead one chunk to know whether this one is the last
+            next_chunk = await anext(chunks, None)
+            end = offset + len(chunk)
+            total = "*" if next_chunk is not None else end
+            content_range = f"bytes {offset}-{end - 1}/{total}" if chunk else f"bytes */{total}"
+            r = await self._send("PUT", session_url, content=chunk, headers={"Content-Range": content_range})
+            if next_chunk is None:
+                break
+            if r.status_code != 308:
+                r.raise_for_status()
+                raise ValueError(f"Unexpected status {r.status_code} of a resumable upload chunk to {remote_fname}")
+            offset, chunk = end, next_chunk
+        r.raise_for_status()
+        # along with the download the chunks come from
+        self.metrics.observe("upload", time.perf_counter() - start)
+        self.metrics.count("upload.files")
+        self.metrics.count("upload.bytes", end)
+        logger.info(f"Uploaded {remote_fname} to the storage bucket.")
+        return f"gs://{bucket_id}/{remote_fname}"
+
+
 # almost reference implementation from the docs
 # https://cloud.google.com/vision/product-search/docs/create-product-set
 def bulk_import_product_sets(
@@ -61,7 +378,16 @@ def bulk_import_product_sets(
         csv_bulk_gcs_uri: Google Cloud Storage URI.
             Target files must be in Product Search CSV format.
     """
+    response = submit_bulk_import(client, project_id, location, csv_bulk_gcs_uri)
+    # synchronous check of operation status
+    result = response.result(timeout=1800.0, retry=RETRY_POLICY)
+    log_bulk_import_result(result, csv_bulk_gcs_uri)
 
+
+def submit_bulk_import(
+    client: vision.ProductSearchClient, project_id: str, location: str, csv_bulk_gcs_uri: str
+) -> Operation:
+    """Start importing a bulk CSV file, returns the long-running operation without waiting for it."""
     # A resource that represents Google Cloud Platform location.
     location_path = f"projects/{project_id}/locations/{location}"
 
@@ -70,22 +396,72 @@ def bulk_import_product_sets(
     input_config = vision.ImportProductSetsInputConfig(gcs_source=gcs_source)
 
     # Import the product sets from the input URI.
-    response = client.import_product_sets(parent=location_path, input_config=input_config, timeout=1800.0, retry=RETRY_POLICY)
-
+    response = client.import_product_sets(
+        parent=location_path, input_config=input_config, timeout=1800.0, retry=RETRY_POLICY
+    )
     logger.info(f"Processing operation name: {response.operation.name}")
-    # synchronous check of operation status
-    result = response.result(timeout=1800.0, retry=RETRY_POLICY)
+    return response
 
+
+def attach_bulk_import(client: vision.ProductSearchClient, operation_name: str) -> Operation:
+    """The operation of an import started earlier, e.g. by an interrupted run."""
+    operations_client = client.transport.operations_client
+    return from_gapic(
+        operations_client.get_operation(operation_name, retry=RETRY_POLICY),
+        operations_client,
+        vision.ImportProductSetsResponse,
+        metadata_type=vision.BatchOperationMetadata,
+    )
+
+
+def log_bulk_import_result(result: vision.ImportProductSetsResponse, csv_bulk_gcs_uri: str) -> Tuple[int, int]:
+    """Log the status of every imported reference image, returns the (indexed, failed) counts."""
+    indexed, failed = 0, 0
     for idx, status in enumerate(result.statuses):
         # Check the status of reference image
         # `0` is the code for OK in google.rpc.Code.
         if status.code == 0:
             reference_image = result.reference_images[idx]
             logger.info(f"Indexed entry {idx}, {reference_image}")
+            indexed += 1
         else:
             logger.warning(f"Status code not OK: {status.message}")
+            failed += 1
 
     logger.info(f"Processing done. Indexed {csv_bulk_gcs_uri}")
+    return indexed, failed
+
+
+# images per batch_annotate_images request
+MAX_BATCH_IMAGES = 16
+
+
+def product_search_request(
+    search_client: vision.ProductSearchClient,
+    project_id: str,
+    location: str,
+    product_set_id: str,
+    product_category: str,
+    image: bytes,
+    _filter: str = "",
+    max_results: int = 10,
+) -> vision.AnnotateImageRequest:
+    """Product search request of an image, see get_similar_products for the args."""
+
+    # product search specific parameters
+    product_set_path = search_client.product_set_path(project=project_id, location=location, product_set=product_set_id)
+    product_search_params = vision.ProductSearchParams(
+        product_set=product_set_path,
+        product_categories=[product_category],
+        filter=_filter,
+    )
+    image_context = vision.ImageContext(product_search_params=product_search_params)
+
+    return vision.AnnotateImageRequest(
+        image=vision.Image(content=image),
+        features=[vision.Feature(type_=vision.Feature.Type.PRODUCT_SEARCH, max_results=max_results)],
+        image_context=image_context,
+    )
 
 
 def get_similar_products(
@@ -114,19 +490,78 @@ def get_similar_products(
         max_results: The maximum number of results (matches) to return.
     """
 
-    image = vision.Image(content=image)
-
-    # product search specific parameters
-    product_set_path = search_client.product_set_path(project=project_id, location=location, product_set=product_set_id)
-    product_search_params = vision.ProductSearchParams(
-        product_set=product_set_path,
-        product_categories=[product_category],
-        filter=_filter,
+    request = product_search_request(
+        search_client, project_id, location, product_set_id, product_category, image, _filter, max_results
     )
-    image_context = vision.ImageContext(product_search_params=product_search_params)
 
     # Search products similar to the image.
-    response = annotation_client.product_search(image, image_context=image_context, max_results=max_results)
+    response = annotation_client.annotate_image(request)
+    return parse_product_search_response(response)
+
+
+async def async_get_similar_products(
+    annotation_client: vision.ImageAnnotatorAsyncClient,
+    project_id: str,
+    location: str,
+    product_set_id: str,
+    product_category: str,
+    image: bytes,
+    _filter: str = "",
+    max_results: int = 10,
+    timeout: float = None,
+) -> dict:
+    """Same search as get_similar_products on an asyncio client, retried within `timeout` seconds if set.
+    See get_similar_products for the other args.
+    """
+
+    request = product_search_request(
+        vision.ProductSearchClient, project_id, location, product_set_id, product_category, image, _filter, max_results
+    )
+    retry = timeout and ASYNC_RETRY_POLICY.with_timeout(timeout) or ASYNC_RETRY_POLICY
+    response = await annotation_client.batch_annotate_images(requests=[request], retry=retry, timeout=timeout)
+    image_response = response.responses[0]
+    if image_response.error.message:
+        raise exceptions.from_grpc_status(image_response.error.code, image_response.error.message)
+    return parse_product_search_response(image_response)
+
+
+def batch_get_similar_products(
+    search_client: vision.ProductSearchClient,
+    annotation_client: vision.ImageAnnotatorClient,
+    project_id: str,
+    location: str,
+    product_set_id: str,
+    product_category: str,
+    images: List[bytes],
+    _filter: str = "",
+    max_results: int = 10,
+) -> List[Optional[dict]]:
+    """Search similar products to up to MAX_BATCH_IMAGES images in a single request.
+    Args:
+        images: Byte strings of the images to be searched, the other args are the same as of get_similar_products.
+    Returns:
+        The results of every image, None for the images the search has failed for.
+    """
+
+    requests = [
+        product_search_request(
+            search_client, project_id, location, product_set_id, product_category, image, _filter, max_results
+        )
+        for image in images
+    ]
+    response = annotation_client.batch_annotate_images(requests=requests, retry=RETRY_POLICY)
+    outputs = []
+    for image_response in response.responses:
+        if image_response.error.message:
+            logger.warning(f"Product search has failed: {image_response.error.message}")
+            outputs.append(None)
+        else:
+            outputs.append(parse_product_search_response(image_response))
+    return outputs
+
+
+def parse_product_search_response(response: vision.AnnotateImageResponse) -> dict:
+    """Bounding boxes and matches of the objects found by a product search."""
     results = response.product_search_results.product_grouped_results
 
     if not results:
@@ -174,6 +609,17 @@ def list_product_sets(project_id: str, location: str, client: vision.ProductSear
         logger.info(f"Product set index time: {product_set.index_time}")
 
 
+def get_product_set_index_time(project_id: str, location: str, product_set_id: str, client: vision.ProductSearchClient):
+    """Time the product set was last indexed at, in ISO format.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Id of the product set.
+    """
+    product_set_path = client.product_set_path(project=project_id, location=location, product_set=product_set_id)
+    return client.get_product_set(name=product_set_path).index_time.isoformat()
+
+
 def purge_products_in_product_set(
     project_id: str, location: str, product_set_id: str, client: vision.ProductSearchClient, force: bool
 ):
@@ -1,18 +1,48 @@
+import functools
+import hashlib
 import io
 from pathlib import Path
 
 import numpy as np
+import PIL.ExifTags as ExifTags
 import PIL.Image as Image
 import PIL.ImageDraw as ImageDraw
 import PIL.ImageFont as ImageFont
-import requests
+import PIL.ImageOps as ImageOps
 
+from utils.fetcher import ImageFetcher
 
-def get_pil_image_from_uri(image_uri: str):
-    response = requests.get(image_uri, stream=True)
-    response.raw.decode_content = True
-    image_bytes = response.raw
-    pil_image = Image.open(image_bytes)
+_FETCHER = None
+
+
+def default_fetcher() -> ImageFetcher:
+    global _FETCHER
+    if _FETCHER is None:
+        _FETCHER = ImageFetcher()
+    return _FETCHER
+
+
+def get_pil_image_from_uri(image_uri: str, fetcher: ImageFetcher = None, draft_size: int = None):
+    """Downloads an image into a PIL Image.
+
+    Args:
+      image_uri: http(s) URL of the image.
+      fetcher: ImageFetcher to download with, a shared one without a cache by default.
+      draft_size: if set, a JPEG is decoded at the smallest 1/2, 1/4 or 1/8 scale
+        still covering draft_size x draft_size pixels, a fraction of the full decode.
+
+    Returns:
+      PIL.Image object.
+    """
+    image_bytes = (fetcher or default_fetcher()).fetch(image_uri)
+    return open_image(image_bytes, draft_size=draft_size)
+
+
+def open_image(image_bytes: bytes, draft_size: int = None):
+    """Opens an image file, see get_pil_image_from_uri for draft_size."""
+    pil_image = Image.open(io.BytesIO(image_bytes))
+    if draft_size and pil_image.format == "JPEG":
+        pil_image.draft("RGB", (draft_size, draft_size))
     return pil_image
 
 
@@ -43,8 +73,127 @@ def encode_image_as_png_str(image: Image):
     return png_string
 
 
+def image_digest(image: Image) -> str:
+    """Hashes the decoded pixels of a PIL Image.
+
+    The same picture gets the same digest whatever file or URL it was loaded from.
+
+    Args:
+      image: PIL.Image object.
+
+    Returns:
+      SHA-256 hex digest of the mode, size and pixel data.
+    """
+    sha256 = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    sha256.update(image.tobytes())
+    return sha256.hexdigest()
+
+
+def perceptual_hash(image: Image, hash_size: int = 8) -> int:
+    """Difference hash of a PIL Image, unlike image_digest it survives small crops,
+    resizing, recompression and retouching.
+
+    Args:
+      image: PIL.Image object.
+      hash_size: the hash has hash_size**2 bits.
+
+    Returns:
+      A bit per pixel of a grayscale (hash_size + 1) x hash_size thumbnail, set if it's brighter than the next one.
+    """
+    thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), "big")
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+
+def image_fingerprint(image_bytes: bytes, hash_size: int = 8):
+    """Perceptual hash and quality of an image file, for telling near duplicates apart.
+
+    Args:
+      image_bytes: the encoded image.
+      hash_size: see perceptual_hash.
+
+    Returns:
+      {"phash": hex perceptual hash, "pixels": width * height, "size": bytes}, None if it isn't an image.
+    """
+    try:
+        pil_image = Image.open(io.BytesIO(image_bytes))
+        pixels = pil_image.width * pil_image.height
+        # a JPEG is decoded at 1/8 of its size at most, plenty for the thumbnail
+        pil_image.draft("L", (hash_size * 8, hash_size * 8))
+        phash = perceptual_hash(pil_image, hash_size)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    return {"phash": f"{phash:0{hash_size**2 // 4}x}", "pixels": pixels, "size": len(image_bytes)}
+
+
+def exif_upright(image: Image) -> Image:
+    """Rotates a PIL Image upright according to its EXIF orientation.
+
+    Args:
+      image: PIL.Image object.
+
+    Returns:
+      The image itself if it's upright already, otherwise a transposed copy.
+    """
+    if image.getexif().get(ExifTags.Base.Orientation, 1) == 1:
+        return image
+    return ImageOps.exif_transpose(image)
+
+
+def encode_query_image(image: Image, max_side: int = 1024, image_format: str = "JPEG", quality: int = 85):
+    """Encodes a PIL Image for a product search request, downscaled to max_side.
+
+    The bounding boxes of the search results are normalized, so they apply
+    to the full resolution image as well.
+
+    Args:
+      image: an upright PIL.Image object, see exif_upright.
+      max_side: longest side in pixels the image is downscaled to, 0 keeps its size.
+      image_format: PNG (lossless), JPEG or WEBP.
+      quality: JPEG/WebP quality, 1-100.
+
+    Returns:
+      Encoded image string.
+    """
+    if max_side and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+        # box reduced by an integer factor first, then resampled, a fraction of a plain resize time
+        image = image.resize(size, Image.Resampling.BICUBIC, reducing_gap=1.5)
+    if image_format.upper() == "PNG":
+        return encode_image_as_png_str(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(size: int = 12):
+    """Arial of the given size if it's installed, else the PIL default font, looked up once."""
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except IOError:
+        return ImageFont.load_default()
+
+
 def draw_bounding_box_on_image(
-    image, ymin, xmin, ymax, xmax, color="red", thickness=4, display_str_list=(), use_normalized_coordinates=True
+    image,
+    ymin,
+    xmin,
+    ymax,
+    xmax,
+    color="red",
+    thickness=4,
+    display_str_list=(),
+    use_normalized_coordinates=True,
+    draw=None,
+    font=None,
 ):
     """Adds a bounding box to an image.
 
@@ -69,8 +218,11 @@ def draw_bounding_box_on_image(
       use_normalized_coordinates: If True (default), treat coordinates
         ymin, xmin, ymax, xmax as relative to the image.  Otherwise treat
         coordinates as absolute.
+      draw: ImageDraw.Draw of the image to reuse, a new one by default.
+      font: font of the strings, see load_font.
     """
-    draw = ImageDraw.Draw(image)
+    draw = draw or ImageDraw.Draw(image)
+    font = font or load_font()
     im_width, im_height = image.size
     if use_normalized_coordinates:
         (left, right, top, bottom) = (xmin * im_width, xmax * im_width, ymin * im_height, ymax * im_height)
@@ -80,15 +232,12 @@ def draw_bounding_box_on_image(
         draw.line(
             [(left, top), (left, bottom), (right, bottom), (right, top), (left, top)], width=thickness, fill=color
         )
-    try:
-        font = ImageFont.truetype("arial.ttf", 12)
-    except IOError:
-        font = ImageFont.load_default()
 
     # If the total height of the display strings added to the top of the bounding
     # box exceeds the top of the image, stack the strings below the bounding box
     # instead of above.
-    display_str_heights = [font.getbbox(ds)[3] for ds in display_str_list]
+    text_bboxes = [font.getbbox(ds) for ds in display_str_list]
+    display_str_heights = [bbox[3] for bbox in text_bboxes]
     # Each display_str has a top and bottom margin of 0.05x.
     total_display_str_height = (1 + 2 * 0.05) * sum(display_str_heights)
 
@@ -97,8 +246,7 @@ def draw_bounding_box_on_image(
     else:
         text_bottom = bottom + total_display_str_height
     # Reverse list and print from bottom to top.
-    for display_str in display_str_list[::-1]:
-        bbox = font.getbbox(display_str)
+    for display_str, bbox in zip(display_str_list[::-1], text_bboxes[::-1]):
         text_width, text_height = bbox[2], bbox[3]
         margin = np.ceil(0.05 * text_height)
         draw.rectangle([(left, text_bottom - text_height - 2 * margin), (left + text_width, text_bottom)], fill=color)
@@ -129,10 +277,58 @@ def draw_bounding_boxes_on_image(image, boxes, color="red", thickness=4, display
         return
     if len(boxes_shape) != 2 or boxes_shape[1] != 4:
         raise ValueError("Input must be of size [N, 4]")
+    # a single drawing context and font for all the boxes
+    draw, font = ImageDraw.Draw(image), load_font()
     for i in range(boxes_shape[0]):
         display_str_list = ()
         if display_str_list_list:
             display_str_list = display_str_list_list[i]
         draw_bounding_box_on_image(
-            image, boxes[i, 0], boxes[i, 1], boxes[i, 2], boxes[i, 3], color, thickness, display_str_list
+            image,
+            boxes[i, 0],
+            boxes[i, 1],
+            boxes[i, 2],
+            boxes[i, 3],
+            color,
+            thickness,
+            display_str_list,
+            draw=draw,
+            font=font,
         )
+
+
+def bounding_boxes_overlay(image_size, boxes, color="red", thickness=4, display_str_list_list=()) -> dict:
+    """Describes the bounding boxes for a client to draw over the image, a JSON serializable dict.
+
+    Same arguments as draw_bounding_boxes_on_image, without the image itself to modify and re-encode.
+
+    Args:
+      image_size: (width, height) of the image in pixels.
+      boxes: a 2 dimensional numpy array of [N, 4]: (ymin, xmin, ymax, xmax).
+             The coordinates are in normalized format between [0, 1].
+      color: color of the boxes.
+      thickness: line thickness in pixels.
+      display_str_list_list: list of list of strings, the labels of each bounding box.
+
+    Returns:
+      {"width", "height", "color", "thickness", "boxes": [{"ymin", "xmin", "ymax", "xmax", "labels"}]}
+
+    Raises:
+      ValueError: if boxes is not a [N, 4] array
+    """
+    boxes = np.asarray(boxes, dtype=float)
+    if boxes.size and (boxes.ndim != 2 or boxes.shape[1] != 4):
+        raise ValueError("Input must be of size [N, 4]")
+    return {
+        "width": image_size[0],
+        "height": image_size[1],
+        "color": color,
+        "thickness": thickness,
+        "boxes": [
+            {
+                **dict(zip(("ymin", "xmin", "ymax", "xmax"), map(float, box))),
+                "labels": list(display_str_list_list and display_str_list_list[i] or ()),
+            }
+            for i, box in enumerate(boxes.reshape(-1, 4))
+        ],
+    }
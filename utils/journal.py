@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+
+# progress of an import run, so a resumed run skips the finished products
+# and continues the bulk import files where the last checkpoint left them.
+# A product is finished once all its outputs are ready and written together,
+# the finished products and the writer state are committed in one transaction.
+class ImportJournal:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._outstanding = {}
+        self._finished = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS products (bahag_id TEXT PRIMARY KEY)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS writer (id INTEGER PRIMARY KEY CHECK (id = 0), state TEXT)")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def reset(self) -> None:
+        """Forget the previous run."""
+        with self._lock:
+            self._conn.execute("DELETE FROM products")
+            self._conn.execute("DELETE FROM writer")
+            self._conn.commit()
+
+    def writer_state(self) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM writer").fetchone()
+        return row and json.loads(row[0]) or None
+
+    def unfinished(self, bahag_ids: List[str]) -> List[str]:
+        """The ids of the batch not finished by the previous runs."""
+        finished = set()
+        with self._lock:
+            # below the default SQLite limit of the query parameters
+            for idx in range(0, len(bahag_ids), 900):
+                chunk = bahag_ids[idx : idx + 900]
+                finished.update(
+                    row[0]
+                    for row in self._conn.execute(
+                        f"SELECT bahag_id FROM products WHERE bahag_id IN ({','.join('?' * len(chunk))})", chunk
+                    )
+                )
+        return [bahag_id for bahag_id in bahag_ids if bahag_id not in finished]
+
+    def add(self, bahag_id: str, outputs: int) -> None:
+        """A product with `outputs` items to be written, it's finished once all of them are done."""
+        with self._lock:
+            if outputs:
+                self._outstanding[bahag_id] = self._outstanding.get(bahag_id, 0) + outputs
+            else:
+                self._finished.append(bahag_id)
+
+    def done(self, bahag_id: str, finished: bool = True) -> bool:
+        """One output of the product is ready, returns True if it was the last one.
+
+        If not `finished` when the last one is, the product isn't recorded and a resumed run imports it again.
+        """
+        with self._lock:
+            self._outstanding[bahag_id] -= 1
+            if self._outstanding[bahag_id]:
+                return False
+            del self._outstanding[bahag_id]
+            if finished:
+                self._finished.append(bahag_id)
+            return True
+
+    @property
+    def uncommitted(self) -> int:
+        return len(self._finished)
+
+    def commit(self, writer_state: dict) -> None:
+        """Record the products finished since the last commit, along with the state of the flushed writer."""
+        with self._lock:
+            finished, self._finished = self._finished, []
+            with self._conn:
+                self._conn.executemany("INSERT OR IGNORE INTO products VALUES (?)", ((i,) for i in finished))
+                self._conn.execute("INSERT OR REPLACE INTO writer VALUES (0, ?)", (json.dumps(writer_state),))
@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+# local record of the imported assets, so the next run can ask the CDN
+# whether an asset has changed instead of downloading and uploading it again.
+# The url and gcs_url indexes find the assets shared by several products.
+class AssetManifest:
+    def __init__(self, path: Path, commit_every: int = 1000) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS assets (
+                bahag_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                filename TEXT,
+                gcs_url TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                phash TEXT,
+                pixels INTEGER,
+                PRIMARY KEY (bahag_id, url)
+            )""")
+        # the perceptual hash columns came later than the manifests of the previous runs
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(assets)")}
+        for column, column_type in (("phash", "TEXT"), ("pixels", "INTEGER")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE assets ADD COLUMN {column} {column_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS assets_url ON assets (url)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS assets_gcs_url ON assets (gcs_url)")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def get(self, bahag_id: str, url: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM assets WHERE bahag_id = ? AND url = ?", (bahag_id, url)).fetchone()
+        return row and dict(row) or None
+
+    def get_by_url(self, url: str) -> Optional[dict]:
+        """The latest entry of the url, whichever product it was transferred for."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM assets WHERE url = ? ORDER BY updated_at DESC LIMIT 1", (url,)
+            ).fetchone()
+        return row and dict(row) or None
+
+    def has_gcs_url(self, gcs_url: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM assets WHERE gcs_url = ? LIMIT 1", (gcs_url,)).fetchone()
+        return row is not None
+
+    def put(
+        self,
+        bahag_id: str,
+        url: str,
+        gcs_url: str,
+        etag: str = None,
+        last_modified: str = None,
+        size: int = None,
+        sha256: str = None,
+        filename: str = None,
+        phash: str = None,
+        pixels: int = None,
+    ) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO assets"
+                " (bahag_id, url, etag, last_modified, size, sha256, filename, gcs_url, updated_at, phash, pixels)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (bahag_id, url, etag, last_modified, size, sha256, filename, gcs_url, time.time(), phash, pixels),
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
@@ -0,0 +1,142 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# upper bounds in seconds of the latency buckets, from the local disk writes to the slowest requests
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2, 5, 10, 30, math.inf)
+
+
+class LatencyHistogram:
+    """Counts of the observed latencies per bucket, the quantiles are interpolated within their bucket.
+
+    Args:
+        buckets: Ascending upper bounds in seconds, the last one should be math.inf.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[min(idx, len(self.counts) - 1)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, seen = q * count, 0
+        for idx, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = idx and self.buckets[idx - 1] or 0.0
+                upper = self.buckets[idx]
+                # the open last bucket is reported at its lower bound
+                return upper == math.inf and lower or lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-2]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        return {
+            "count": count,
+            "mean_s": count and round(total / count, 6) or 0.0,
+            "p50_s": round(self.quantile(0.5), 6),
+            "p95_s": round(self.quantile(0.95), 6),
+            "p99_s": round(self.quantile(0.99), 6),
+            "buckets": {f"le_{bound:g}": n for bound, n in zip(self.buckets, counts)},
+        }
+
+
+class Metrics:
+    """Counters and latency histograms by name, created on their first use.
+
+    report() is the periodic log line of the rates (a utils.pipeline.Pipeline reporter),
+    write_report() the JSON summary of a whole run. An observation is a lock and a few
+    arithmetic operations, about a microsecond.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._reported = (self._start, {})
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram(self.buckets)
+            return self.histograms[name]
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histogram(name).observe(seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def time(self, name: str):
+        """Observes the time the block takes, also the ones raising."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = dict(self.histograms)
+        return {name: histogram.snapshot() for name, histogram in histograms.items()}
+
+    def report(self) -> str:
+        """The counters with their rates since the previous report and the latency quantiles so far."""
+        now = time.perf_counter()
+        with self._lock:
+            counters, histograms = dict(self.counters), dict(self.histograms)
+            (reported_at, reported), self._reported = self._reported, (now, counters)
+        interval = max(now - reported_at, 1e-9)
+        parts = []
+        for name, value in sorted(counters.items()):
+            rate = (value - reported.get(name, 0)) / interval
+            if name.endswith("bytes"):
+                parts.append(f"{name} {value / 1024**2:.1f} MiB ({rate / 1024**2:.2f} MiB/s)")
+            else:
+                parts.append(f"{name} {value} ({rate:.1f}/s)")
+        for name, histogram in sorted(histograms.items()):
+            parts.append(
+                f"{name} p50 {histogram.quantile(0.5) * 1000:.1f} ms p95 {histogram.quantile(0.95) * 1000:.1f} ms"
+            )
+        return f"Metrics: {', '.join(parts)}"
+
+    def write_report(self, path: Path, **extra) -> dict:
+        """Writes the counters, their average rates and the latency histograms since the start as JSON,
+        along with the `extra` fields.
+        """
+        seconds = time.perf_counter() - self._start
+        with self._lock:
+            counters = dict(self.counters)
+        report = {
+            **extra,
+            "started_at": self.started_at,
+            "seconds": round(seconds, 3),
+            "counters": counters,
+            "rates_per_s": {name: round(value / seconds, 3) for name, value in counters.items()},
+            "latency": self.snapshot(),
+        }
+        path.write_text(json.dumps(report, indent=2))
+        return report
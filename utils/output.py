@@ -1,8 +1,17 @@
+import asyncio
+import os
 from pathlib import Path
+from typing import Callable, List
+
+import aiofiles
 
 
 # wrapper for writing output files
-# in parts of fixed size.
+# in parts of fixed size, `on_rollover` is called
+# with the path of every finished part.
+# With `buffer_size` set the lines are written in blocks of that size,
+# the part size is counted in memory and every part is fsync'ed once complete.
+# checkpoint() flushes the current part and returns the state restore() continues from.
 class RotatingTextWriter:
     def __init__(
         self,
@@ -13,8 +22,10 @@ class RotatingTextWriter:
         rollover_prefix: str = "part",
         max_size_b: int = None,
         max_lines: int = None,
+        on_rollover: Callable[[Path], None] = None,
+        buffer_size: int = None,
     ) -> None:
-        self._file = file
+        self._file = self.first_file = file
         self.fname = file.stem
         self.fext = file.suffix
         self.mode = mode
@@ -23,8 +34,12 @@ class RotatingTextWriter:
         self.rollover_prefix = rollover_prefix and f"_{rollover_prefix}_" or ""
         self.max_size_b = max_size_b
         self.max_lines = max_lines
+        self.on_rollover = on_rollover
+        self.buffer_size = buffer_size
+        self.files = []
         self.rollover_count = 0
         self.curr_lines_written = 0
+        self.curr_bytes_written = 0
         self.total_lines_written = 0
         self.stream = None
 
@@ -33,21 +48,89 @@ class RotatingTextWriter:
 
     def __exit__(self, type, value, traceback):
         if self.stream:
-            self.stream.close()
+            self._close()
+        # an interrupted run doesn't ship its last part
+        if type is None and self.curr_lines_written:
+            self._finished()
 
     def _open_file(self):
-        self.stream = self._file.open(mode=self.mode, encoding=self.encoding, newline=self.newline, buffering=1)
+        self.stream = self._file.open(
+            mode=self.mode, encoding=self.encoding, newline=self.newline, buffering=self.buffer_size or 1
+        )
+        # appending to an existing file
+        self.curr_bytes_written = self.buffer_size and self.stream.tell() or 0
 
-    def do_rollover(self) -> None:
+    def _close(self) -> None:
+        if self.buffer_size:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
         self.stream.close()
+
+    def do_rollover(self) -> None:
+        self._close()
+        self._finished()
+        self._next_file()
+
+    def _finished(self) -> None:
+        self.files.append(self._file)
+        if self.on_rollover:
+            self.on_rollover(self._file)
+
+    def _next_file(self) -> None:
         self.stream = None
         self.rollover_count += 1
-        self._file = Path(self._file.parent / f"{self.fname}{self.rollover_prefix}{self.rollover_count}{self.fext}")
+        self._file = self._part_file(self.rollover_count)
         self.curr_lines_written = 0
 
+    def _part_file(self, idx: int) -> Path:
+        if not idx:
+            return self.first_file
+        return Path(self.first_file.parent / f"{self.fname}{self.rollover_prefix}{idx}{self.fext}")
+
+    def parts(self) -> List[Path]:
+        """The parts on the disk, in order."""
+        parts = []
+        while (fpath := self._part_file(len(parts))).exists():
+            parts.append(fpath)
+        return parts
+
+    def state(self, offset: int) -> dict:
+        return {
+            "files": [str(fpath) for fpath in self.files],
+            "rollover_count": self.rollover_count,
+            "curr_lines_written": self.curr_lines_written,
+            "total_lines_written": self.total_lines_written,
+            "offset": offset,
+        }
+
+    def checkpoint(self) -> dict:
+        """Flush the current part to the disk, returns the state to restore the writer to."""
+        if not self.stream:
+            return self.state(self.curr_fsize)
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        return self.state(self.stream.tell())
+
+    def restore(self, state: dict) -> None:
+        """Continue writing from a checkpoint, the lines written after it are truncated."""
+        self.files = [Path(fpath) for fpath in state["files"]]
+        self.rollover_count = state["rollover_count"]
+        self.curr_lines_written = state["curr_lines_written"]
+        self.total_lines_written = state["total_lines_written"]
+        self._file = self._part_file(self.rollover_count)
+        if self._file.exists():
+            os.truncate(self._file, state["offset"])
+        idx = self.rollover_count + 1
+        while self._part_file(idx).exists():
+            self._part_file(idx).unlink()
+            idx += 1
+
     @property
     def curr_fsize(self) -> int:
-        return self._file.stat().st_size
+        # the buffered data isn't in the file yet
+        if self.buffer_size and self.stream:
+            return self.curr_bytes_written
+        return self._file.exists() and self._file.stat().st_size or 0
 
     @property
     def rollover_needed(self) -> bool:
@@ -55,14 +138,99 @@ class RotatingTextWriter:
             self.max_lines and self.curr_lines_written == self.max_lines
         )
 
-    def count_written(self) -> None:
-        self.curr_lines_written += 1
-        self.total_lines_written += 1
+    def count_written(self, n_lines: int = 1, data: str = None) -> None:
+        self.curr_lines_written += n_lines
+        self.total_lines_written += n_lines
+        if self.buffer_size and self.max_size_b:
+            self.curr_bytes_written += len(data.encode(self.encoding))
 
     def write(self, line: str) -> None:
         if not self.stream:
             self._open_file()
         self.stream.write(line)
-        self.count_written()
+        self.count_written(data=line)
         if self.rollover_needed:
             self.do_rollover()
+
+    def batches(self, lines: List[str]):
+        """Split the lines into the batches going into the same part."""
+        start = 0
+        while start < len(lines):
+            end = len(lines)
+            if self.max_lines:
+                end = min(end, start + self.max_lines - self.curr_lines_written)
+            if self.max_size_b:
+                # up to and including the line the single writes would roll over after
+                room, size_end = self.max_size_b - 2048 - self.curr_fsize, start
+                while size_end < end and (room > 0 or size_end == start):
+                    room -= len(lines[size_end].encode(self.encoding))
+                    size_end += 1
+                end = size_end
+            yield lines[start:end]
+            start = end
+
+    def write_many(self, lines: List[str]) -> None:
+        """Write the lines in as few calls as possible, rolling over the same way as line by line."""
+        for batch in self.batches(lines):
+            if not self.stream:
+                self._open_file()
+            data = "".join(batch)
+            self.stream.write(data)
+            self.count_written(len(batch), data)
+            if self.rollover_needed:
+                self.do_rollover()
+
+
+# same as above, but writes with aiofiles
+# so the event loop isn't blocked by the disk.
+class AsyncRotatingTextWriter(RotatingTextWriter):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        if self.stream:
+            await self._close()
+        if type is None and self.curr_lines_written:
+            self._finished()
+
+    async def _open_file(self):
+        self.stream = await aiofiles.open(
+            self._file, mode=self.mode, encoding=self.encoding, newline=self.newline, buffering=self.buffer_size or 1
+        )
+        self.curr_bytes_written = self.buffer_size and await self.stream.tell() or 0
+
+    async def _close(self) -> None:
+        if self.buffer_size:
+            await self.stream.flush()
+            await asyncio.to_thread(os.fsync, self.stream.fileno())
+        await self.stream.close()
+
+    async def do_rollover(self) -> None:
+        await self._close()
+        self._finished()
+        self._next_file()
+
+    async def checkpoint(self) -> dict:
+        if not self.stream:
+            return self.state(self.curr_fsize)
+        await self.stream.flush()
+        await asyncio.to_thread(os.fsync, self.stream.fileno())
+        return self.state(await self.stream.tell())
+
+    async def write(self, line: str) -> None:
+        if not self.stream:
+            await self._open_file()
+        await self.stream.write(line)
+        self.count_written(data=line)
+        if self.rollover_needed:
+            await self.do_rollover()
+
+    async def write_many(self, lines: List[str]) -> None:
+        for batch in self.batches(lines):
+            if not self.stream:
+                await self._open_file()
+            data = "".join(batch)
+            await self.stream.write(data)
+            self.count_written(len(batch), data)
+            if self.rollover_needed:
+                await self.do_rollover()
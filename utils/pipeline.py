@@ -0,0 +1,156 @@
+import logging
+import threading
+from queue import Empty, Full, Queue
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    """A pool of long-lived worker threads applying `fn` to every item of its input queue.
+
+    Args:
+        name: Stage name used in the queue depth reports.
+        fn: Callable taking one item and returning an iterable of items
+            for the next stage, or None if the item has been dropped.
+        workers: Number of worker threads.
+        queue_size: Capacity of the (bounded) input queue, defaults to 2 x workers.
+    """
+
+    def __init__(self, name: str, fn: Callable[..., Optional[Iterable]], workers: int = 1, queue_size: int = None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size or workers * 2)
+        self.processed = 0
+        self.accepted = 0
+        self._alive = 0
+        self._lock = threading.Lock()
+
+
+# wrapper for running stages connected with bounded queues,
+# a slow stage blocks the upstream ones instead of growing the memory.
+class Pipeline:
+    def __init__(
+        self,
+        source: Iterable,
+        stages: List[Stage],
+        output_size: int = None,
+        report_interval: float = 60.0,
+        reporters: List = None,
+    ) -> None:
+        self.source = source
+        self.stages = stages
+        self.output = Queue(maxsize=output_size or stages[-1].workers * 2)
+        self.report_interval = report_interval
+        # objects with a report() -> str method, logged along with the queue depths
+        self.reporters = reporters or []
+        self.fed_count = 0
+        self._stop = threading.Event()
+        self._error = None
+        self._threads = []
+
+    def _put(self, q: Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, q: Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except Empty:
+                continue
+        return _DONE
+
+    def _fail(self, e: BaseException) -> None:
+        if self._error is None:
+            self._error = e
+        self._stop.set()
+
+    def _feed(self) -> None:
+        source = iter(self.source)
+        try:
+            for item in source:
+                if not self._put(self.stages[0].queue, item):
+                    return
+                self.fed_count += 1
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            getattr(source, "close", lambda: None)()
+            self._put(self.stages[0].queue, _DONE)
+
+    def _work(self, stage: Stage, next_queue: Queue) -> None:
+        try:
+            while True:
+                item = self._get(stage.queue)
+                if item is _DONE:
+                    break
+                result = stage.fn(item)
+                with stage._lock:
+                    stage.processed += 1
+                    stage.accepted += result is not None
+                for out_item in result or ():
+                    if not self._put(next_queue, out_item):
+                        return
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with stage._lock:
+                stage._alive -= 1
+                last = stage._alive == 0
+            # the last worker standing tells the next stage that the input is exhausted
+            self._put(next_queue if last else stage.queue, _DONE)
+
+    def _report(self) -> None:
+        while not self._stop.wait(self.report_interval):
+            logger.info(
+                "Queue depths: "
+                + ", ".join(f"{name}={depth}" for name, depth in self.depths().items())
+                + f"; fed {self.fed_count} items"
+            )
+            for reporter in self.reporters:
+                logger.info(reporter.report())
+
+    def depths(self) -> Dict[str, str]:
+        depths = {stage.name: f"{stage.queue.qsize()}/{stage.queue.maxsize}" for stage in self.stages}
+        depths["output"] = f"{self.output.qsize()}/{self.output.maxsize}"
+        return depths
+
+    def _start(self) -> None:
+        self._threads.append(threading.Thread(target=self._feed, name="pipeline-source", daemon=True))
+        next_queues = [stage.queue for stage in self.stages[1:]] + [self.output]
+        for stage, next_queue in zip(self.stages, next_queues):
+            stage._alive = stage.workers
+            for idx in range(stage.workers):
+                self._threads.append(
+                    threading.Thread(
+                        target=self._work, args=(stage, next_queue), name=f"pipeline-{stage.name}-{idx}", daemon=True
+                    )
+                )
+        if self.report_interval:
+            self._threads.append(threading.Thread(target=self._report, name="pipeline-report", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def __iter__(self) -> Iterator:
+        self._start()
+        try:
+            while True:
+                item = self._get(self.output)
+                if item is _DONE:
+                    break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,87 @@
+import copy
+import json
+import logging
+import threading
+import time
+
+from google.cloud import vision
+
+from utils.cache import MISS, TwoTierCache
+from utils.google_cloud import get_product_set_index_time
+
+logger = logging.getLogger(__name__)
+
+
+class SearchResultCache:
+    """Results of get_similar_products keyed by the image digest (see utils.image.image_digest)
+    and all the search parameters.
+
+    The key includes the index_time of the product set, so the results of an older index
+    are never served once the set is reindexed, they expire with the cache TTL.
+    The index_time is fetched at most every `index_check_interval` seconds per product set.
+    Results without any match are not cached, they may come from an error response.
+
+    Args:
+        client: Vision product search client.
+        project_id: Id of the project.
+        location: A compute region name.
+        cache: The results cache.
+        index_check_interval: Seconds an index_time is reused for.
+    """
+
+    def __init__(
+        self,
+        client: vision.ProductSearchClient,
+        project_id: str,
+        location: str,
+        cache: TwoTierCache,
+        index_check_interval: float = 300.0,
+    ):
+        self.client = client
+        self.project_id = project_id
+        self.location = location
+        self.cache = cache
+        self.index_check_interval = index_check_interval
+        self._index_times = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.cache.close()
+
+    def index_time(self, product_set_id: str) -> str:
+        with self._lock:
+            index_time, checked_at = self._index_times.get(product_set_id, (None, 0.0))
+        if time.monotonic() - checked_at < self.index_check_interval:
+            return index_time
+        index_time = get_product_set_index_time(self.project_id, self.location, product_set_id, self.client)
+        with self._lock:
+            self._index_times[product_set_id] = (index_time, time.monotonic())
+        return index_time
+
+    def key(
+        self,
+        digest: str,
+        product_set_id: str,
+        product_category: str,
+        _filter: str = "",
+        max_results: int = 10,
+        encoding: str = "",
+    ) -> str:
+        """Key of the search, `encoding` describes how the image is encoded for the request."""
+        index_time = self.index_time(product_set_id)
+        return json.dumps([digest, encoding, product_set_id, index_time, product_category, _filter, max_results])
+
+    def get(self, key: str):
+        """Cached results or MISS, a copy the caller may change."""
+        results = self.cache.get(key)
+        return results is MISS and MISS or copy.deepcopy(results)
+
+    def set(self, key: str, results: dict) -> None:
+        if results["bboxes"]:
+            self.cache.set(key, copy.deepcopy(results))
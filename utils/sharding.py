@@ -0,0 +1,36 @@
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+
+# deterministic partition of the products between `count` import processes,
+# by a stable hash of the id, so every shard gets about the same number of products
+# and a restarted shard gets the same ones. Shard(0, 1) is the whole catalog.
+class Shard(NamedTuple):
+    index: int = 0
+    count: int = 1
+
+    @classmethod
+    def parse(cls, spec: str) -> "Shard":
+        """Shard from "i/N", e.g. "0/4" is the first of four shards."""
+        try:
+            index, count = (int(part) for part in spec.split("/"))
+        except ValueError:
+            raise ValueError(f"Invalid shard {spec!r}, expected i/N")
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid shard {spec!r}, expected 0 <= i < N")
+        return cls(index, count)
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def owns(self, bahag_id: str) -> bool:
+        return self.count == 1 or zlib.crc32(bahag_id.encode()) % self.count == self.index
+
+    def path(self, path: Path) -> Path:
+        """The shard's own copy of an output file, in a directory of the shard created if missing."""
+        if self.count == 1:
+            return path
+        shard_dir = path.parent / f"shard_{self.index}_of_{self.count}"
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        return shard_dir / path.name
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Tuple
+
+# resumable upload chunks must be multiples of 256 KiB
+CHUNK_SIZE_UNIT = 256 * 1024
+
+
+class FileTooBig(ValueError):
+    pass
+
+
+class Digest:
+    """Running sha256 and byte count of a transferred stream."""
+
+    def __init__(self):
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data: bytes) -> None:
+        self._sha256.update(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+
+class ByteBudget:
+    """Caps the bytes held in memory by all the running transfers together.
+
+    Args:
+        max_bytes: The budget, a single reservation is capped to it
+            so a large file waits for the others instead of blocking forever.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n_bytes: int):
+        n_bytes = min(n_bytes, self.max_bytes)
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight + n_bytes <= self.max_bytes)
+            self.in_flight += n_bytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= n_bytes
+                self._cond.notify_all()
+
+
+class AsyncByteBudget(ByteBudget):
+    """Same as ByteBudget, for the coroutines of a single event loop."""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(max_bytes)
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, n_bytes: int):
+        n_bytes = min(n_bytes, self.max_bytes)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight + n_bytes <= self.max_bytes)
+            self.in_flight += n_bytes
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_flight -= n_bytes
+                self._cond.notify_all()
+
+
+class SingleFlight:
+    """Runs fn once per key for the concurrent callers, the others wait for its result and share it.
+
+    Args:
+        remember: The results of the last `remember` keys are shared with the later callers too.
+    """
+
+    def __init__(self, remember: int = 0):
+        self.remember = remember
+        self._running = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _done(self, key, result) -> None:
+        if self.remember:
+            self._recent[key] = result
+            if len(self._recent) > self.remember:
+                self._recent.popitem(last=False)
+
+    def _lookup(self, key):
+        """(result, True) of a recent key, (the future of its running call, False) or (None, False) otherwise."""
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            return self._recent[key], True
+        return self._running.get(key), False
+
+    def run(self, key, fn: Callable) -> Tuple:
+        """Returns (result, shared), shared is False for the call that ran fn. Its exceptions are raised to all."""
+        with self._lock:
+            found, recent = self._lookup(key)
+            if not recent and found is None:
+                future = self._running[key] = Future()
+        if recent:
+            return found, True
+        if found is not None:
+            return found.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._running[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._running[key]
+            self._done(key, result)
+        future.set_result(result)
+        return result, False
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Same as SingleFlight, for the coroutines of a single event loop."""
+
+    async def run(self, key, fn: Callable[[], Awaitable]) -> Tuple:
+        found, recent = self._lookup(key)
+        if recent:
+            return found, True
+        if found is not None:
+            return await asyncio.shield(found), True
+        future = self._running[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved, there may be nobody waiting for it
+            future.exception()
+            raise
+        finally:
+            del self._running[key]
+        self._done(key, result)
+        future.set_result(result)
+        return result, False
+
+
+# read-only file-like view on a streamed http response body.
+# Only the data of the last read is kept, seeking back to it is all
+# a resumable upload needs to recover a failed chunk.
+class CappedStream(io.RawIOBase):
+    def __init__(self, raw, max_size: int, digest: Digest = None) -> None:
+        self._raw = raw
+        self.max_size = max_size
+        self.digest = digest
+        self._pos = 0
+        self._buffer = b""
+        self._buffer_start = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can't seek from the end of a stream")
+        if not self._buffer_start <= pos <= self._buffer_start + len(self._buffer):
+            raise io.UnsupportedOperation(f"Can't seek to {pos}, only the last read chunk is kept")
+        self._pos = pos
+        return pos
+
+    def read(self, size: int = -1) -> bytes:
+        replay = b""
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._pos < buffer_end:
+            offset = self._pos - self._buffer_start
+            replay = self._buffer[offset:] if size < 0 else self._buffer[offset : offset + size]
+            self._pos += len(replay)
+            if size >= 0:
+                size -= len(replay)
+                if not size:
+                    return replay
+
+        fresh = self._raw.read() if size < 0 else self._raw.read(size)
+        if buffer_end + len(fresh) > self.max_size:
+            raise FileTooBig(f"Stream is bigger than {self.max_size} bytes")
+        if self.digest:
+            self.digest.update(fresh)
+        data = replay + fresh
+        self._pos += len(fresh)
+        if data:
+            self._buffer, self._buffer_start = data, self._pos - len(data)
+        return data
+
+
+async def capped_chunks(chunks: AsyncIterator[bytes], max_size: int, digest: Digest = None) -> AsyncIterator[bytes]:
+    """Pass the chunks through, raises FileTooBig once more than max_size bytes are seen."""
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_size:
+            raise FileTooBig(f"Stream is bigger than {max_size} bytes")
+        if digest:
+            digest.update(chunk)
+        yield chunk